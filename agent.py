@@ -1,18 +1,66 @@
+import asyncio
+import bisect
+import contextvars
+import inspect
 import os
 import json
 import platform
-import re
+import signal
 import subprocess
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from types import SimpleNamespace
+
+from context import ContextManager
+from datasets import DATASETS, DatasetError, query as query_dataset_table
+from environment import ENV_MARKER, environment
+from jobs import JobError, is_long_running, job_manager
+from metrics import metrics
+from output_store import BoundedCapture, output_store
+from policy import default_policy
+from resource_limits import command_limits, usage_from_rusage, wait_with_usage
+from shell_pool import ShellPool, ShellUnavailable, shell_pool
+from tool_cache import tool_cache
+from tool_encoding import ToolOutputEncoder
 
 class Agent:
     def __init__(self):
         # Configuración de límites para gestión de memoria
-        self.MAX_MESSAGES = 150  # Máximo de mensajes antes de limpiar
+        self.MAX_MESSAGES = 150  # Máximo de mensajes (límite de seguridad; el recorte principal es por tokens)
+        # Presupuesto de tokens del historial según el modelo activo (ver context.py)
+        self.context = ContextManager(max_messages=self.MAX_MESSAGES)
+        # Caché de resultados de herramientas de solo lectura (compartida entre sesiones)
+        self.tool_cache = tool_cache
+        # Reglas de comandos destructivos precompiladas (compartidas entre sesiones)
+        self.policy = default_policy()
+        # Codificación compacta y deduplicación de las salidas de herramientas (ver tool_encoding.py)
+        self.tool_encoder = ToolOutputEncoder()
+        # Shells calientes para los comandos (ver shell_pool.py). Con AGENT_SHELL_PERSISTENT=1 cada
+        # agente usa su propio shell y conserva cwd y variables entre comandos
+        if os.environ.get("AGENT_SHELL_PERSISTENT", "0").strip().lower() in ("1", "true", "yes"):
+            self.shell_pool = ShellPool(size=1, persistent=True)
+        else:
+            self.shell_pool = shell_pool
+        # Ámbito de la caché de comandos: con shell propio el resultado de `ls`, `pwd` o `cat ruta`
+        # depende de su cwd, así que solo se reutiliza dentro del mismo agente
+        self.cache_scope = None if self.shell_pool is shell_pool else f"shell-{uuid.uuid4().hex}"
+        # Máximo de herramientas independientes ejecutadas en paralelo dentro de una misma respuesta
+        self.MAX_PARALLEL_TOOLS = int(os.environ.get("AGENT_MAX_PARALLEL_TOOLS", "4"))
         
         self.setup_tools()
         # Estado para gestionar confirmaciones de comandos destructivos
         self.pending_confirmation = None
 
+        # Vista del historial para los clientes: cada entrada lleva `id` (estable) y `seq` (última
+        # actualización); los mensajes `tool` consecutivos se fusionan al añadirse (ver `add_message`)
+        self.display = []
+        self._seq = 0
+        # Persistencia opcional (ver conversation_store.py): se asigna con `attach_store`
+        self.store = None
+        self.session_id = None
+
         self.messages = [
             {"role": "system", "content": 
              """Eres un asistente experto en administración de sistemas y ejecución de comandos de terminal.
@@ -21,8 +69,11 @@ class Agent:
                 Si el usuario quiere cambiar el modelo, puede escribir "/models" y se le mostrará la lista de modelos disponibles.
            
                 HERRAMIENTAS DISPONIBLES:
-                1. get_system_os: Obtiene información del sistema operativo (plataforma, versión, arquitectura, hostname, Python).
+                1. get_system_os: Obtiene información del sistema operativo (plataforma, distribución, kernel, CPU, memoria y disco libres, shell, gestor de paquetes, herramientas instaladas). Lo esencial ya está en el bloque "Entorno del sistema" al final de este mensaje.
                 2. execute_terminal_command: Ejecuta comandos en el terminal del sistema operativo (ver descripción detallada abajo).
+                3. read_command_output: Lee por páginas la salida completa de un comando cuya salida se mostró truncada.
+                4. query_dataset: Consulta los datasets de la carpeta `persona/` (p. ej. `gistemp`, temperatura global mensual, estacional y anual). Úsala en lugar de leer esos ficheros con comandos: devuelve valores, series, estadísticas, medias móviles y rankings ya calculados.
+                5. job_status / cancel_job / list_jobs: Siguen, cancelan y listan los comandos lanzados en segundo plano.
 
                 IMPORTANTE — COMPORTAMIENTO Y FORMATO DE SALIDA DE `execute_terminal_command`:
                 Cuando llames a `execute_terminal_command`, la herramienta ejecutará el comando y devolverá UNA CADENA con uno de los siguientes formatos — el agente debe interpretarlos exactamente así:
@@ -41,14 +92,21 @@ class Agent:
                     - Devuelve: "Error (código N): <mensaje>" donde <mensaje> es stderr si está presente, o stdout en su defecto.
                         Significado: el comando falló. NO asumas éxito. Analiza el mensaje de error, propón una corrección del comando o solicita aclaración al usuario antes de volver a ejecutarlo.
 
+                - Salida muy larga:
+                    - Se devuelven solo el principio y el final, separados por un aviso "[... salida truncada ... output_id='<id>' ...]". Si necesitas la parte omitida, llama a `read_command_output` con ese `output_id` y un `offset`; no repitas el comando.
+
                 - Timeout:
-                    - Devuelve: "Error: El comando excedió el tiempo límite (60 o 600 segundos, depende del sistema)".
+                    - Devuelve: "Error: El comando excedió el tiempo límite (N segundos). ..." (60 segundos en Windows, 600 en el resto).
+
+                - Comando en segundo plano:
+                    - Devuelve: "🕒 Comando lanzado en segundo plano (job_id='<id>'). ...". Ocurre si pasas `background: true` o si el comando suele tardar (instalaciones de paquetes, compilaciones, descargas, `git clone`, `sleep` largos...).
+                        Significado: el comando sigue ejecutándose. Consulta su estado y las últimas líneas con `job_status` (usa `offset` para leer solo la salida nueva), cancélalo con `cancel_job` y no lo vuelvas a lanzar.
 
                 - Excepción de ejecución:
                     - Devuelve: "Error al ejecutar el comando '<comando>': <detalle>".
 
                 REGLAS OPERACIONALES PARA EL MODELO CUANDO USES `execute_terminal_command`:
-                1) Antes de ejecutar comandos que dependan de rutas, sintaxis o comportamiento del OS, llama siempre a `get_system_os` y adapta los comandos (rutas, separadores, opciones) al SO detectado.
+                1) Adapta los comandos que dependan de rutas, sintaxis o comportamiento del OS (rutas, separadores, opciones, gestor de paquetes) al bloque "Entorno del sistema" del final de este mensaje, sin llamar antes a ninguna herramienta. Llama a `get_system_os` solo si ese bloque no está o necesitas datos que cambian (memoria o disco libres; usa `refresh: true` para recogerlos de nuevo).
                 2) Si la herramienta devuelve un texto que empieza por "Error (código" o "Error:", NO asumas éxito. Analiza el contenido del error y propón una acción concreta:
                     - Si es un error de permiso, sugiere usar `sudo` o pedir al usuario permisos explícitos.
                     - Si es un error de sintaxis o ruta, propone el comando corregido y explica brevemente el cambio.
@@ -61,15 +119,23 @@ class Agent:
                 FORMATO DE MENSAJES Y SALIDAS:
                 - Cuando la herramienta se invoque, el agente agregará un mensaje `tool` cuyo `content` contiene una concatenación legible de:
                     - "== <tool_name> ==\n"
-                    - opcionalmente una línea: "Parámetros: <JSON pretty>\n" si la llamada tenía argumentos
+                    - opcionalmente una línea: "Parámetros: <JSON>\n" si la llamada tenía argumentos
                     - la salida o mensaje devuelto por la herramienta (según los formatos descritos arriba)
+                - Para ahorrar contexto, una salida repetida no se vuelve a copiar:
+                    - "[Sin cambios: la salida es idéntica a la de la llamada anterior con los mismos parámetros]" o "[Salida idéntica a la de la llamada anterior <herramienta> <parámetros>]": la salida es exactamente la que ya tienes en el historial.
+                    - "[Salida casi idéntica a la de la llamada anterior ...; solo cambian estas líneas]": la salida es la anterior con las líneas marcadas con "-" sustituidas por las marcadas con "+".
 
-                RECUERDA: Prioriza la seguridad y la confirmación del usuario antes de acciones destructivas. Usa las salidas de las herramientas como hechos (no especules) y transforma los errores en acciones concretas: analizar, corregir o pedir confirmación al usuario."""
+                RECUERDA: Prioriza la seguridad y la confirmación del usuario antes de acciones destructivas. Usa las salidas de las herramientas como hechos (no especules) y transforma los errores en acciones concretas: analizar, corregir o pedir confirmación al usuario.""" + environment.block()
              }
         ]
         self.TOOLS_FUNCTIONS = {
             "execute_terminal_command": self.execute_terminal_command,
-            "get_system_os": self.get_system_os
+            "get_system_os": self.get_system_os,
+            "read_command_output": self.read_command_output,
+            "query_dataset": self.query_dataset,
+            "job_status": self.job_status,
+            "cancel_job": self.cancel_job,
+            "list_jobs": self.list_jobs
         }
     
     def setup_tools(self):
@@ -79,13 +145,21 @@ class Agent:
                 "type": "function",
                 "function": {
                     "name": "execute_terminal_command",
-                    "description": "Ejecuta un comando en el terminal del sistema operativo y devuelve el resultado. En sistemas Unix se ejecuta dentro de un shell Bash usando `bash -lc '<command>'`, lo que permite encadenar varios pasos (por ejemplo: descarga && instalación && source) en una única llamada y así mantener el estado dentro de esa invocación. Devuelve stdout si el comando es exitoso; en caso de error devuelve 'Error (código N): <mensaje>'. Si la operación requiere múltiples pasos dependientes, agrupa los pasos en una sola llamada usando operadores como `&&` o `;`.",
+                    "description": "Ejecuta un comando en el terminal del sistema operativo y devuelve el resultado. En sistemas Unix se ejecuta dentro de un shell Bash usando `bash -lc '<command>'`, lo que permite encadenar varios pasos (por ejemplo: descarga && instalación && source) en una única llamada y así mantener el estado dentro de esa invocación. Devuelve stdout si el comando es exitoso; en caso de error devuelve 'Error (código N): <mensaje>'. Si la operación requiere múltiples pasos dependientes, agrupa los pasos en una sola llamada usando operadores como `&&` o `;`. Varias llamadas separadas en una misma respuesta se consideran independientes y se ejecutan en paralelo.",
                     "parameters": {
                         "type": "object",
                         "properties": {
                             "command": {
                                 "type": "string",
                                 "description": "El comando a ejecutar en el terminal con sus argumentos si lo requiere"
+                            },
+                            "no_cache": {
+                                "type": "boolean",
+                                "description": "Opcional. true para forzar la ejecución aunque haya un resultado reciente en caché de un comando de solo lectura"
+                            },
+                            "background": {
+                                "type": "boolean",
+                                "description": "Opcional. true para lanzar el comando en segundo plano y recibir al momento un `job_id` (para procesos que tardan minutos). Las instalaciones, compilaciones y descargas se lanzan así automáticamente"
                             }
                         },
                         "required": ["command"]
@@ -97,7 +171,107 @@ class Agent:
                 "type": "function",
                 "function": {
                     "name": "get_system_os",
-                    "description": "Devuelve información sobre el sistema operativo donde corre el programa (plataforma, versión, arquitectura, hostname, python). No se le pasan parámetros a esta función.",
+                    "description": "Devuelve información sobre el sistema donde corre el programa: plataforma, versión, arquitectura, hostname, python, distribución, kernel, CPU, memoria y disco (total y libre), shell, usuario, gestor de paquetes y herramientas de línea de comandos disponibles. Lo esencial ya está en el mensaje de sistema.",
+                    "parameters": {
+                        "type": "object",
+                        "properties": {
+                            "refresh": {
+                                "type": "boolean",
+                                "description": "Opcional. true para recoger los datos de nuevo en vez de usar la instantánea (p. ej. memoria o disco libres tras instalar algo)"
+                            }
+                        },
+                        "required": []
+                    }
+                }
+            }
+            ,
+            {
+                "type": "function",
+                "function": {
+                    "name": "read_command_output",
+                    "description": "Lee por páginas la salida completa de un comando de `execute_terminal_command` que se mostró truncada. Usa el `output_id` indicado en el aviso de truncado y avanza con `offset` (número de línea).",
+                    "parameters": {
+                        "type": "object",
+                        "properties": {
+                            "output_id": {
+                                "type": "string",
+                                "description": "Identificador de la salida guardada (aparece en el aviso de salida truncada)"
+                            },
+                            "offset": {
+                                "type": "integer",
+                                "description": "Línea desde la que empezar a leer (0 = principio)"
+                            },
+                            "limit": {
+                                "type": "integer",
+                                "description": "Número máximo de líneas a devolver (máximo 200)"
+                            }
+                        },
+                        "required": ["output_id"]
+                    }
+                }
+            }
+            ,
+            {
+                "type": "function",
+                "function": {
+                    "name": "query_dataset",
+                    "description": "Consulta un dataset tabular de la carpeta `persona/` ya indexado en memoria y devuelve una respuesta corta. `gistemp`: anomalía de temperatura global (°C respecto a 1951-1980) por año (1880-hoy); columnas Jan..Dec (también ene..dic), J-D (media anual, alias 'annual'), D-N, DJF, MAM, JJA, SON. Operaciones: info (columnas y años), value (un año), series (valores de start a end), stats (media, mínimo, máximo y tendencia por década), rolling (media móvil de `window` años), rank (los `top` valores más altos o más bajos).",
+                    "parameters": {
+                        "type": "object",
+                        "properties": {
+                            "dataset": {"type": "string", "enum": sorted(DATASETS), "description": "Nombre del dataset (por defecto gistemp)"},
+                            "operation": {"type": "string", "enum": ["info", "value", "series", "stats", "rolling", "rank"]},
+                            "column": {"type": "string", "description": "Columna: mes (Jan o ene), estación (DJF, MAM, JJA, SON) o 'annual' (J-D)"},
+                            "year": {"type": "integer", "description": "Año para la operación value"},
+                            "start": {"type": "integer", "description": "Primer año del rango (incluido)"},
+                            "end": {"type": "integer", "description": "Último año del rango (incluido)"},
+                            "window": {"type": "integer", "description": "Años de la media móvil (rolling, por defecto 10)"},
+                            "top": {"type": "integer", "description": "Número de resultados de rank (por defecto 10)"},
+                            "order": {"type": "string", "enum": ["desc", "asc"], "description": "rank: desc = más altos, asc = más bajos"},
+                            "baseline": {"type": "string", "description": "Opcional. Periodo base 'AAAA-AAAA' para expresar los valores como anomalía respecto a su media"}
+                        },
+                        "required": ["operation"]
+                    }
+                }
+            }
+            ,
+            {
+                "type": "function",
+                "function": {
+                    "name": "job_status",
+                    "description": "Estado de un comando lanzado en segundo plano (running, done, failed, cancelled o timeout), su código de salida y su salida. Sin `offset` devuelve las últimas `lines` líneas; con `offset` devuelve solo la salida nueva desde ese byte (usa el `next_offset` de la llamada anterior).",
+                    "parameters": {
+                        "type": "object",
+                        "properties": {
+                            "job_id": {"type": "string", "description": "Identificador devuelto al lanzar el comando"},
+                            "offset": {"type": "integer", "description": "Opcional. Byte desde el que leer la salida (next_offset de la consulta anterior)"},
+                            "lines": {"type": "integer", "description": "Opcional. Últimas líneas a mostrar si no se indica offset (por defecto 40)"}
+                        },
+                        "required": ["job_id"]
+                    }
+                }
+            }
+            ,
+            {
+                "type": "function",
+                "function": {
+                    "name": "cancel_job",
+                    "description": "Cancela un comando lanzado en segundo plano (termina también sus procesos hijos).",
+                    "parameters": {
+                        "type": "object",
+                        "properties": {
+                            "job_id": {"type": "string", "description": "Identificador del trabajo a cancelar"}
+                        },
+                        "required": ["job_id"]
+                    }
+                }
+            }
+            ,
+            {
+                "type": "function",
+                "function": {
+                    "name": "list_jobs",
+                    "description": "Lista los comandos lanzados en segundo plano en esta conversación con su estado y duración. No se le pasan parámetros a esta función.",
                     "parameters": {
                         "type": "object",
                         "properties": {},
@@ -107,254 +281,871 @@ class Agent:
             }
         ]
         
-    def execute_terminal_command(self, command):
-      
+    def execute_terminal_command(self, command, background=False):
+        if background or is_long_running(command):
+            return self._start_job(command)
+        timeout = 60 if platform.system().lower().startswith('win') else 600
         try:
             # Ejecutar en un shell adecuado según el SO
             if platform.system().lower().startswith('win'):
                 # En Windows usar shell por compatibilidad (cmd/powershell según disponibilidad)
-                process = subprocess.run(
-                    command,
-                    shell=True,
-                    capture_output=True,
-                    text=True,
-                    timeout=60
-                )
+                return_code, stdout, stderr, usage = self._run_captured(command, shell=True, timeout=timeout)
             else:
-                # En Unix, ejecutar mediante bash -lc para permitir encadenar y usar 'source' en la misma invocación
-                process = subprocess.run(
-                    ["bash", "-lc", command],
-                    capture_output=True,
-                    text=True,
-                    timeout=600
-                )
+                # En Unix, ejecutar en un bash de login (del pool o bash -lc) para permitir encadenar y usar 'source'
+                return_code, stdout, stderr, usage = self._run_shell(command, timeout=timeout)
 
-            # print(process)
-            stdout = process.stdout.strip()
-            stderr = process.stderr.strip()
-            return_code = process.returncode
-            
-            # Si el comando fue exitoso (código 0) pero no hay salida, indicar éxito
-            if return_code == 0:
-                if not stdout and not stderr:
-                    return f"✓ Comando ejecutado exitosamente (sin salida)"
-                elif stdout:
-                    return stdout
-                else:
-                    return f"✓ Comando ejecutado exitosamente\n{stderr}"
-            else:
-                # Comando falló
-                error_msg = f"Error (código {return_code})"
-                if stderr:
-                    error_msg += f": {stderr}"
-                elif stdout:
-                    error_msg += f": {stdout}"
-                return error_msg
+            return self._format_command_result(return_code, stdout, stderr, usage)
                 
         except subprocess.TimeoutExpired:
-            return f"Error: El comando excedió el tiempo límite (30 segundos)"
+            return self._timeout_message(timeout)
         except Exception as e:
             err = f"Error al ejecutar el comando '{command}': {str(e)}"
             print(err)
             return err
 
-    def _is_destructive_command(self, command: str):
-        """Heurística simple para detectar comandos potencialmente destructivos.
-        Devuelve (True, motivo) si coincide alguna de las reglas.
-        """
-        if not command or not isinstance(command, str):
-            return (False, None)
-
-        c = command.lower()
-        # reglas simples / patrones
-        patterns = [
-            (r"\brm\b", "uso de 'rm'"),
-            (r"rm\s+-rf", "uso de 'rm -rf'"),
-            (r"\bsudo\b", "uso de 'sudo'"),
-            (r"\bdd\b", "uso de 'dd'"),
-            (r"\bmkfs\b", "creación de sistemas de ficheros (mkfs)"),
-            (r"\breboot\b|\bshutdown\b", "reinicio/apagado del sistema"),
-            (r"curl\s+.*\|\s*bash", "descarga e ejecución remota (curl | bash)"),
-            (r"wget\s+.*\|\s*bash", "descarga e instalación remota (wget | bash)"),
-            (r"\bapt\b|\bapt-get\b|\byum\b|\bdnf\b", "gestor de paquetes del sistema"),
-            (r"\bpip\s+install\b", "instalación de paquetes con pip"),
-            (r"\bchmod\s+777\b", "permisos abiertos (chmod 777)"),
-            (r"\bshutdown\b", "apagado o shutdown"),
+    def _run_shell(self, command, timeout):
+        """Ejecuta `command` en un shell caliente del pool; si no hay pool, con un `bash -lc` nuevo."""
+        try:
+            worker = self.shell_pool.acquire()
+        except ShellUnavailable:
+            return self._run_captured(["bash", "-lc", command], shell=False, timeout=timeout)
+        captures = (BoundedCapture(), BoundedCapture())
+        start = time.monotonic()
+        try:
+            return_code = worker.run(command, timeout, *captures)
+            cpu = worker.last_cpu
+        except subprocess.TimeoutExpired:
+            self._account(start, captures, None, timed_out=True)
+            raise
+        finally:
+            self.shell_pool.release(worker)
+            for c in captures:
+                c.close()
+        usage = self._account(start, captures, return_code, cpu=cpu)
+        return return_code, captures[0].text(), captures[1].text(), usage
+
+    def _account(self, start, captures, return_code, **kwargs):
+        """Registra los recursos del comando (ver resource_limits.py) y devuelve su dict de uso."""
+        output_bytes = sum(c.total_bytes for c in captures)
+        return command_limits.account(time.monotonic() - start, output_bytes, return_code, **kwargs)
+
+    async def _run_shell_async(self, command, timeout):
+        """Versión asíncrona de `_run_shell`. Devuelve None si el pool no está disponible.
+        Si la tarea se cancela se mata el shell (y el comando en curso); el pool lo recicla."""
+        acquiring = asyncio.ensure_future(asyncio.to_thread(self.shell_pool.acquire))
+        try:
+            worker = await asyncio.shield(acquiring)
+        except ShellUnavailable:
+            return None
+        except asyncio.CancelledError:
+            # Si el shell llega a arrancar, devolverlo al pool en lugar de perderlo
+            acquiring.add_done_callback(
+                lambda f: self.shell_pool.release(f.result()) if not f.cancelled() and f.exception() is None else None
+            )
+            raise
+        captures = (BoundedCapture(), BoundedCapture())
+        start = time.monotonic()
+
+        def run():
+            # El shell se devuelve al pool desde el propio hilo, cuando termina de leer su salida
+            try:
+                return worker.run(command, timeout, *captures), worker.last_cpu
+            finally:
+                self.shell_pool.release(worker)
+                for c in captures:
+                    c.close()
+
+        try:
+            return_code, cpu = await asyncio.to_thread(run)
+        except subprocess.TimeoutExpired:
+            self._account(start, captures, None, timed_out=True)
+            raise
+        except asyncio.CancelledError:
+            worker.kill()
+            raise
+        usage = self._account(start, captures, return_code, cpu=cpu)
+        return return_code, captures[0].text(), captures[1].text(), usage
+
+    def close(self):
+        """Libera los recursos propios del agente (su shell persistente, si lo tiene)."""
+        if self.shell_pool is not shell_pool:
+            self.shell_pool.close()
+
+    def _run_captured(self, args, shell, timeout):
+        """Ejecuta un proceso leyendo stdout/stderr en streaming con memoria acotada (`BoundedCapture`).
+        Devuelve (returncode, stdout, stderr, uso); lanza `subprocess.TimeoutExpired` si se agota el tiempo
+        (tras matar todo el grupo de procesos del comando)."""
+        if not shell:
+            args = command_limits.argv(args)
+        process = subprocess.Popen(args, shell=shell, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   **command_limits.popen_kwargs())
+        command_limits.attach(process)
+        captures = (BoundedCapture(), BoundedCapture())
+        start = time.monotonic()
+
+        def pump(stream, capture):
+            with stream:
+                for chunk in iter(lambda: stream.read1(65536), b""):
+                    capture.feed(chunk)
+
+        readers = [
+            threading.Thread(target=pump, args=(process.stdout, captures[0]), daemon=True),
+            threading.Thread(target=pump, args=(process.stderr, captures[1]), daemon=True),
         ]
+        for t in readers:
+            t.start()
+        try:
+            try:
+                # wait4 da también el tiempo de CPU y el pico de memoria del comando
+                _, rusage = wait_with_usage(process, timeout, on_timeout=lambda: command_limits.kill_group(process))
+            finally:
+                for t in readers:
+                    t.join()
+                for c in captures:
+                    c.close()
+        except subprocess.TimeoutExpired:
+            self._account(start, captures, None, timed_out=True)
+            raise
+        cpu, max_rss_kb = usage_from_rusage(rusage)
+        usage = self._account(start, captures, process.returncode, cpu=cpu, max_rss_kb=max_rss_kb)
+        return process.returncode, captures[0].text(), captures[1].text(), usage
+
+    async def execute_terminal_command_async(self, command, background=False):
+        """Versión asíncrona de `execute_terminal_command` basada en `asyncio.create_subprocess_*`.
+        Si la tarea se cancela (p. ej. el cliente HTTP se desconecta) se mata el proceso y sus hijos."""
+        if background or is_long_running(command):
+            return self._start_job(command)
+        is_windows = platform.system().lower().startswith('win')
+        timeout = 60 if is_windows else 600
+        if not is_windows:
+            try:
+                result = await self._run_shell_async(command, timeout)
+            except subprocess.TimeoutExpired:
+                return self._timeout_message(timeout)
+            except Exception as e:
+                err = f"Error al ejecutar el comando '{command}': {str(e)}"
+                print(err)
+                return err
+            if result is not None:
+                return self._format_command_result(*result)
+        try:
+            if is_windows:
+                process = await asyncio.create_subprocess_shell(
+                    command,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE
+                )
+            else:
+                # Nueva sesión (para poder matar todo el grupo de procesos al cancelar) y límites de recursos
+                process = await asyncio.create_subprocess_exec(
+                    *command_limits.argv(["bash", "-lc", command]),
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                    **command_limits.popen_kwargs()
+                )
+                command_limits.attach(process)
+        except Exception as e:
+            err = f"Error al ejecutar el comando '{command}': {str(e)}"
+            print(err)
+            return err
+
+        captures = (BoundedCapture(), BoundedCapture())
+        start = time.monotonic()
 
-        for pat, reason in patterns:
-            if re.search(pat, c):
-                return (True, reason)
-        return (False, None)
+        async def pump(stream, capture):
+            while True:
+                chunk = await stream.read(65536)
+                if not chunk:
+                    break
+                capture.feed(chunk)
 
-    def get_system_os(self):
-        """Devuelve información básica del sistema operativo y entorno Python."""
         try:
-            info = {
-                "platform": platform.system(),
-                "platform_release": platform.release(),
-                "platform_version": platform.version(),
-                "architecture": platform.machine(),
-                "hostname": platform.node(),
-                "python_version": platform.python_version()
-            }
-            return info
+            await asyncio.wait_for(
+                asyncio.gather(pump(process.stdout, captures[0]), pump(process.stderr, captures[1]), process.wait()),
+                timeout=timeout
+            )
+        except asyncio.TimeoutError:
+            await self._kill_process_async(process)
+            self._account(start, captures, None, timed_out=True)
+            return self._timeout_message(timeout)
+        except asyncio.CancelledError:
+            await self._kill_process_async(process)
+            raise
+        finally:
+            for c in captures:
+                c.close()
+
+        # El proceso lo espera asyncio: aquí no hay wait4, solo tiempo real y bytes de salida
+        usage = self._account(start, captures, process.returncode)
+        return self._format_command_result(process.returncode, captures[0].text(), captures[1].text(), usage)
+
+    def _timeout_message(self, timeout):
+        return (f"Error: El comando excedió el tiempo límite ({timeout} segundos). "
+                "Si es un proceso largo, vuelve a lanzarlo con background=true y sigue su progreso con job_status.")
+
+    def _start_job(self, command):
+        """Lanza el comando en segundo plano (ver jobs.py) y devuelve al momento su identificador."""
+        try:
+            job = job_manager.start(command, owner=self.session_id)
+        except (JobError, OSError) as e:
+            return f"Error al lanzar el comando en segundo plano: {e}"
+        return (f"🕒 Comando lanzado en segundo plano (job_id='{job.id}'). Sigue ejecutándose: consulta su "
+                f"estado y salida con job_status(job_id='{job.id}') o cancélalo con cancel_job.")
+
+    async def _kill_process_async(self, process):
+        """Mata un subproceso asíncrono (y su grupo en Unix) y espera a que termine."""
+        if process.returncode is not None:
+            return
+        try:
+            if hasattr(os, "killpg"):
+                os.killpg(process.pid, signal.SIGKILL)
+            else:
+                process.kill()
+        except (ProcessLookupError, PermissionError):
+            pass
+        try:
+            await process.wait()
+        except Exception:
+            pass
+
+    def _format_command_result(self, return_code, stdout, stderr, usage=None):
+        """Convierte el resultado de un proceso en la cadena que se devuelve al modelo
+        (con una línea de recursos si el comando fue lento o topó con un límite)."""
+        return self._describe_result(return_code, stdout, stderr) + command_limits.describe(usage)
+
+    def _describe_result(self, return_code, stdout, stderr):
+        stdout = (stdout or "").strip()
+        stderr = (stderr or "").strip()
+
+        # Si el comando fue exitoso (código 0) pero no hay salida, indicar éxito
+        if return_code == 0:
+            if not stdout and not stderr:
+                return f"✓ Comando ejecutado exitosamente (sin salida)"
+            elif stdout:
+                return stdout
+            else:
+                return f"✓ Comando ejecutado exitosamente\n{stderr}"
+        else:
+            # Comando falló
+            error_msg = f"Error (código {return_code})"
+            if stderr:
+                error_msg += f": {stderr}"
+            elif stdout:
+                error_msg += f": {stdout}"
+            return error_msg
+
+    def read_command_output(self, output_id, offset=0, limit=200):
+        """Pagina la salida completa de un comando que se truncó (por líneas)."""
+        return output_store.read(output_id, offset, limit)
+
+    def query_dataset(self, operation="info", dataset="gistemp", **params):
+        """Consulta un dataset de persona/ (ver datasets.py): parseado una vez y servido desde memoria."""
+        try:
+            return query_dataset_table(dataset=dataset, operation=operation, **params)
+        except (DatasetError, OSError, ValueError) as e:
+            return f"Error en query_dataset: {e}"
+
+    def _own_job(self, job_id):
+        # Cada sesión solo ve sus propios trabajos (la CLI, sin sesión, los ve todos)
+        job = job_manager.get(job_id)
+        if self.session_id is not None and job.owner != self.session_id:
+            raise JobError(f"no existe el trabajo '{job_id}'")
+        return job
+
+    def job_status(self, job_id, offset=None, lines=40):
+        """Estado de un trabajo en segundo plano y su salida (las últimas líneas o lo nuevo desde `offset`)."""
+        try:
+            job = self._own_job(job_id)
+            output, next_offset = job_manager.read(job.id, offset, tail_lines=lines)
+        except (JobError, OSError, ValueError) as e:
+            return f"Error en job_status: {e}"
+        info = job.summary()
+        header = f"Trabajo {job.id} [{info['status']}] {info['elapsed']}s: {job.command}"
+        if info["returncode"] is not None:
+            header += f"\nCódigo de salida: {info['returncode']}"
+        if info["cpu_seconds"] is not None:
+            header += f"\nRecursos: {info['cpu_seconds']} s de CPU" + (
+                f", pico de memoria {info['max_rss_mb']} MB" if info["max_rss_mb"] else "")
+        label = "Salida nueva" if offset is not None else "Últimas líneas"
+        body = output.strip() or "(sin salida)"
+        return f"{header}\n{label}:\n{body}\n[next_offset={next_offset}]"
+
+    def cancel_job(self, job_id):
+        """Cancela un trabajo en segundo plano de esta sesión."""
+        try:
+            job = job_manager.cancel(self._own_job(job_id).id)
+        except (JobError, OSError) as e:
+            return f"Error en cancel_job: {e}"
+        return f"Trabajo {job.id} [{job.status}]: {job.command}"
+
+    def list_jobs(self):
+        """Trabajos en segundo plano de esta sesión (de todas en la CLI)."""
+        jobs = job_manager.list(owner=self.session_id)
+        if not jobs:
+            return "No hay comandos en segundo plano"
+        return "\n".join(f"{j['job_id']} [{j['status']}] {j['elapsed']}s: {j['command']}" for j in jobs)
+
+    def _is_destructive_command(self, command: str):
+        """Clasifica el comando con el motor de políticas (ver policy.py).
+        Devuelve (True, motivo) si algún comando simple coincide con una regla.
+        """
+        verdict = self.policy.evaluate(command)
+        return (verdict["destructive"], verdict["reason"])
+
+    def get_system_os(self, refresh=False):
+        """Devuelve la instantánea del entorno (ver environment.py); `refresh` la recoge de nuevo."""
+        try:
+            info = environment.get(refresh=bool(refresh))
+            if info is None:
+                raise RuntimeError("la instantánea del entorno no está disponible")
+            return dict(info)
         except Exception as e:
             err = f"Error obteniendo info del sistema operativo: {str(e)}"
             print(err)
             return err
     
+    def add_message(self, message):
+        """Añade un mensaje al historial y actualiza de forma incremental la vista de los clientes.
+        Devuelve el número de secuencia asignado."""
+        self.messages.append(message)
+        self._seq += 1
+        role = message.get("role")
+        if self.store is not None and role != "system":
+            self.store.append(self.session_id, self._seq, message, model=self.context.model)
+        if role == "user":
+            # Un prompt largo también debe caber antes de llamar al modelo
+            self._cleanup_messages()
+        if role == "system":
+            return self._seq
+
+        last = self.display[-1] if self.display else None
+        if role == "tool" and last is not None and last.get("role") == "tool":
+            # Combinar contenido de múltiples tool messages consecutivos
+            last["content"] = (last.get("content") or "") + "\n\n" + (message.get("content") or "")
+            last["seq"] = self._seq
+        else:
+            entry = dict(message)
+            entry["id"] = self._seq
+            entry["seq"] = self._seq
+            self.display.append(entry)
+        return self._seq
+
+    def messages_since(self, since=0):
+        """Entradas de la vista de clientes modificadas después del cursor `since` (coste O(nuevas))."""
+        since = since or 0
+        i = len(self.display)
+        while i > 0 and self.display[i - 1]["seq"] > since:
+            i -= 1
+        return self.display[i:]
+
+    def display_entry(self, message_id):
+        """Entrada de la vista de clientes con ese `id` o None (búsqueda binaria: los ids son crecientes)."""
+        i = bisect.bisect_left(self.display, message_id, key=lambda entry: entry["id"])
+        if i < len(self.display) and self.display[i]["id"] == message_id:
+            return self.display[i]
+        return None
+
+    @property
+    def cursor(self):
+        return self._seq
+
+    def reset_history(self):
+        """Vacía la conversación manteniendo el mensaje de sistema (el cursor sigue creciendo)."""
+        system = self.context.reset(self.messages[0])
+        # Conversación nueva: el bloque del entorno se actualiza con la instantánea vigente
+        base = (system.get("content") or "").split(ENV_MARKER)[0]
+        self.messages = [{**system, "content": base + environment.block()}]
+        self.display = []
+        self.tool_encoder.reset()
+        self.pending_confirmation = None
+        if self.store is not None:
+            self.store.mark_reset(self.session_id, self._seq, model=self.context.model)
+
+    def attach_store(self, store, session_id):
+        """Guarda cada mensaje nuevo en `store` bajo `session_id` (escritura en segundo plano)."""
+        self.store = store
+        self.session_id = session_id
+
+    def restore_history(self, entries):
+        """Reconstruye historial y vista de clientes a partir de [(seq, mensaje), ...] ya guardados.
+        Mantiene los `seq` originales para que los cursores de los clientes sigan siendo válidos."""
+        store, self.store = self.store, None
+        try:
+            for seq, message in entries:
+                self._seq = max(self._seq, seq - 1)
+                self.add_message(message)
+        finally:
+            self.store = store
+        self._cleanup_messages()
+
+    def set_model(self, model, context_tokens=None, max_tokens=None):
+        """Indica el modelo con el que se va a conversar para presupuestar el contexto.
+        `max_tokens` es lo que se reserva para la respuesta del modelo."""
+        self.context.set_model(model, context_tokens)
+        if max_tokens:
+            self.context.reserve_tokens = max_tokens
+
+    def context_usage(self):
+        """Uso actual del contexto (tokens del historial frente al presupuesto del modelo)."""
+        return {**self.context.usage(self.messages), **self.tool_encoder.stats()}
+
     def _cleanup_messages(self):
-        """Limpia el historial de mensajes si excede límites.
-        Mantiene el mensaje de sistema y las últimas N interacciones."""
-        if len(self.messages) > self.MAX_MESSAGES:
-            # Mantener: sistema + últimas N-1 mensajes
-            system_msg = self.messages[0]
-            self.messages = [system_msg] + self.messages[-(self.MAX_MESSAGES - 1):]
-            print(f"⚠️  Historial de mensajes limpiado (mantenidas últimas {self.MAX_MESSAGES - 1} interacciones)")
+        """Ajusta el historial al presupuesto de tokens del modelo (ver `ContextManager.fit`):
+        recorta salidas de herramientas antiguas y descarta turnos completos si hace falta."""
+        with metrics.span("history_trim"):
+            self.messages = self.context.fit(self.messages)
+        # La vista de clientes solo se acota por número de mensajes
+        if len(self.display) > self.MAX_MESSAGES:
+            self.display = self.display[-(self.MAX_MESSAGES - 1):]
     
-    def handle_tool_call(self, tool_name, tool_input):
-        """Ejecuta una herramienta y maneja errores.
-        Soporta un flag interno `_confirmed` en `tool_input` para indicar que el usuario ya confirmó
-        una operación potencialmente destructiva y que no debe volver a pedirse confirmación.
-        """
+    def _prepare_tool_call(self, tool_name, tool_input):
+        """Valida la llamada y aplica la puerta de confirmación de comandos destructivos.
+        Devuelve (input_args, mensaje): si `mensaje` no es None, es la respuesta a devolver sin ejecutar."""
         if tool_name not in self.TOOLS_FUNCTIONS:
-            return f"Error: Herramienta '{tool_name}' no encontrada"
+            return None, f"Error: Herramienta '{tool_name}' no encontrada"
 
-        try:
-            # Hacer una copia local de los argumentos (para no mutar estructuras externas)
-            input_args = dict(tool_input) if isinstance(tool_input, dict) else {}
-            # Extraer y eliminar el flag interno de confirmación si existe
-            confirmed = bool(input_args.pop("_confirmed", False))
+        # Hacer una copia local de los argumentos (para no mutar estructuras externas)
+        input_args = dict(tool_input) if isinstance(tool_input, dict) else {}
+        # Extraer y eliminar el flag interno de confirmación si existe
+        confirmed = bool(input_args.pop("_confirmed", False))
 
-            # Intercepción para execute_terminal_command: detectar comandos destructivos
-            if tool_name == "execute_terminal_command":
-                cmd = input_args.get("command") if isinstance(input_args, dict) else None
-                is_destructive, reason = self._is_destructive_command(cmd)
-                if is_destructive and not confirmed:
-                    # Guardar estado pendiente y pedir confirmación al usuario
-                    self.pending_confirmation = {"command": cmd, "reason": reason}
-                    print (f"\n\n⚠️ Se detectó un comando potencialmente destructivo: {reason}\nComando: {cmd}\nPor favor confirma escribiendo 'sí' para ejecutar o 'no' para cancelar.")
-                    return (f"⚠️ Se detectó un comando potencialmente destructivo: {reason}\nComando: {cmd}\nPor favor confirma escribiendo 'sí' para ejecutar o 'no' para cancelar.")
+        # Intercepción para execute_terminal_command: detectar comandos destructivos
+        if tool_name == "execute_terminal_command":
+            cmd = input_args.get("command") if isinstance(input_args, dict) else None
+            is_destructive, reason = self._is_destructive_command(cmd)
+            if is_destructive and not confirmed:
+                # Guardar estado pendiente y pedir confirmación al usuario
+                self.pending_confirmation = {"command": cmd, "reason": reason}
+                print (f"\n\n⚠️ Se detectó un comando potencialmente destructivo: {reason}\nComando: {cmd}\nPor favor confirma escribiendo 'sí' para ejecutar o 'no' para cancelar.")
+                return input_args, (f"⚠️ Se detectó un comando potencialmente destructivo: {reason}\nComando: {cmd}\nPor favor confirma escribiendo 'sí' para ejecutar o 'no' para cancelar.")
+        return input_args, None
+
+    def _cache_lookup(self, tool_name, input_args):
+        """Consulta la caché de herramientas de solo lectura.
+        Devuelve (argumentos sin `no_cache`, clave, ttl, resultado cacheado o None)."""
+        input_args = dict(input_args) if isinstance(input_args, dict) else {}
+        no_cache = bool(input_args.pop("no_cache", False))
+        key, ttl = self.tool_cache.key_for(tool_name, input_args, scope=self.cache_scope)
+        cached = None if no_cache else self.tool_cache.get(key)
+        if cached is not None:
+            print(f" ♻️ Resultado de {tool_name} servido desde caché")
+        return input_args, key, ttl, cached
 
+    def _cache_store(self, tool_name, key, ttl, result):
+        if key is not None:
+            self.tool_cache.put(key, ttl, result)
+        elif tool_name == "execute_terminal_command":
+            # Un comando que no es de solo lectura puede haber cambiado el estado del sistema
+            self.tool_cache.invalidate_commands()
+
+    def _run_tool(self, tool_name, input_args):
+        """Ejecuta una herramienta ya validada (sin pasar por la puerta de confirmación)."""
+        try:
+            input_args, key, ttl, cached = self._cache_lookup(tool_name, input_args)
+            if cached is not None:
+                return cached
             func = self.TOOLS_FUNCTIONS[tool_name]
             # Ejecutar la función con los argumentos (si los hay)
             result = func(**input_args) if isinstance(input_args, dict) else func()
+            self._cache_store(tool_name, key, ttl, result)
             return result
         except TypeError as e:
             return f"Error en argumentos de {tool_name}: {str(e)}"
         except Exception as e:
             return f"Error ejecutando {tool_name}: {str(e)}"
 
-    def process_response(self, response):
-        """Procesa respuesta de OpenAI API.
+    async def _run_tool_async(self, tool_name, input_args):
+        """Versión asíncrona de `_run_tool`: los comandos usan subprocesos asyncio y el resto
+        de herramientas (síncronas) se ejecutan en un hilo para no bloquear el event loop."""
+        try:
+            input_args, key, ttl, cached = self._cache_lookup(tool_name, input_args)
+            if cached is not None:
+                return cached
+            if tool_name == "execute_terminal_command":
+                result = await self.execute_terminal_command_async(**input_args)
+            else:
+                func = self.TOOLS_FUNCTIONS[tool_name]
+                result = await asyncio.to_thread(func, **input_args)
+            self._cache_store(tool_name, key, ttl, result)
+            return result
+        except TypeError as e:
+            return f"Error en argumentos de {tool_name}: {str(e)}"
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            return f"Error ejecutando {tool_name}: {str(e)}"
+
+    def handle_tool_call(self, tool_name, tool_input):
+        """Ejecuta una herramienta y maneja errores.
+        Soporta un flag interno `_confirmed` en `tool_input` para indicar que el usuario ya confirmó
+        una operación potencialmente destructiva y que no debe volver a pedirse confirmación.
+        """
+        try:
+            input_args, early = self._prepare_tool_call(tool_name, tool_input)
+        except Exception as e:
+            return f"Error ejecutando {tool_name}: {str(e)}"
+        if early is not None:
+            return early
+        return self._run_tool(tool_name, input_args)
+
+    async def handle_tool_call_async(self, tool_name, tool_input):
+        """Versión asíncrona de `handle_tool_call`."""
+        try:
+            input_args, early = self._prepare_tool_call(tool_name, tool_input)
+        except Exception as e:
+            return f"Error ejecutando {tool_name}: {str(e)}"
+        if early is not None:
+            return early
+        return await self._run_tool_async(tool_name, input_args)
+
+    def _emit(self, on_event, event_type, **data):
+        """Envía un evento al consumidor (si existe) sin dejar que sus errores rompan el loop."""
+        if on_event is None:
+            return
+        try:
+            on_event({"type": event_type, **data})
+        except Exception as e:
+            print(f"❌ Error emitiendo evento '{event_type}': {e}")
+
+    def _new_stream_state(self):
+        return {"content": [], "tool_calls": {}}
+
+    def _feed_stream_chunk(self, state, chunk, on_event):
+        """Acumula un fragmento de una respuesta en streaming: emite un evento `token` por cada
+        trozo de texto y reensambla los deltas de las llamadas a herramientas por su índice."""
+        # Con `stream_options={"include_usage": True}` el último fragmento trae el uso de tokens
+        if getattr(chunk, "usage", None) is not None:
+            state["usage"] = chunk.usage
+        if not getattr(chunk, "choices", None):
+            return
+        delta = chunk.choices[0].delta
+        if delta is None:
+            return
+
+        text = getattr(delta, "content", None)
+        if text:
+            state["content"].append(text)
+            self._emit(on_event, "token", content=text)
+
+        # Cada delta de tool_call trae su índice y trozos parciales de nombre/argumentos
+        tool_calls = state["tool_calls"]
+        for tc in getattr(delta, "tool_calls", None) or []:
+            idx = tc.index if getattr(tc, "index", None) is not None else len(tool_calls)
+            entry = tool_calls.setdefault(idx, {"id": None, "name": "", "arguments": ""})
+            if getattr(tc, "id", None):
+                entry["id"] = tc.id
+            fn = getattr(tc, "function", None)
+            if fn is not None:
+                if getattr(fn, "name", None):
+                    entry["name"] += fn.name
+                if getattr(fn, "arguments", None):
+                    entry["arguments"] += fn.arguments
+
+    def _stream_state_to_response(self, state):
+        """Construye un objeto con la misma forma que una respuesta no-streaming."""
+        assembled = [
+            SimpleNamespace(
+                id=entry["id"],
+                type="function",
+                function=SimpleNamespace(name=entry["name"], arguments=entry["arguments"])
+            )
+            for _, entry in sorted(state["tool_calls"].items())
+            if entry["name"]
+        ]
+        message = SimpleNamespace(content="".join(state["content"]) or None, tool_calls=assembled or None)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=state.get("usage"))
+
+    def process_stream(self, stream, on_event=None):
+        """Consume una respuesta en streaming (`stream=True`) de la API de OpenAI.
+        Emite un evento `token` por cada fragmento de texto del asistente, reensambla los
+        fragmentos (deltas) de las llamadas a herramientas por su índice y, al terminar,
+        delega en `process_response` con la respuesta completa.
         Retorna True si se ejecutó una herramienta, False si es respuesta final."""
+        state = self._new_stream_state()
         try:
-            # Manejar respuestas con tool calls
-            if response.choices[0].message.tool_calls:
-                # Primero, compactar llamadas consecutivas a execute_terminal_command en una sola llamada
-                raw_calls = response.choices[0].message.tool_calls
-                merged_calls = []
-
-                # --- NUEVA LÓGICA: parseo más robusto y deduplicado de llamadas ---
-                for tc in raw_calls:
-                    name = tc.function.name
-                    args_raw = tc.function.arguments
-                    # Try to parse JSON; tolerate some bad quoting
+            with metrics.span("llm_stream", model=self.context.model):
+                for chunk in stream:
+                    self._feed_stream_chunk(state, chunk, on_event)
+        finally:
+            # Cierra la respuesta aunque se corte a medias (Ctrl+C, error en on_event) y libera el backend
+            close = getattr(stream, "close", None)
+            if close is not None:
+                close()
+        return self.process_response(self._stream_state_to_response(state), on_event=on_event)
+
+    async def read_stream_async(self, stream, on_event=None):
+        """Consume un `AsyncStream` de `AsyncOpenAI` (emitiendo los `token`) y devuelve la respuesta
+        completa sin procesarla. Permite liberar el backend antes de ejecutar las herramientas."""
+        state = self._new_stream_state()
+        try:
+            with metrics.span("llm_stream", model=self.context.model):
+                async for chunk in stream:
+                    self._feed_stream_chunk(state, chunk, on_event)
+        finally:
+            # Cliente desconectado o tarea cancelada: cierra la respuesta y libera el backend
+            close = getattr(stream, "aclose", None) or getattr(stream, "close", None)
+            if close is not None:
+                result = close()
+                if inspect.isawaitable(result):
+                    await result
+        return self._stream_state_to_response(state)
+
+    async def process_stream_async(self, stream, on_event=None):
+        """Versión asíncrona de `process_stream` para un `AsyncStream` de `AsyncOpenAI`."""
+        response = await self.read_stream_async(stream, on_event=on_event)
+        return await self.process_response_async(response, on_event=on_event)
+
+    def _plan_tool_calls(self, raw_calls):
+        """Parsea los argumentos de las tool calls y descarta duplicados consecutivos.
+        Las llamadas restantes se consideran independientes (ver `_plan_execution`)."""
+        merged_calls = []
+
+        # --- NUEVA LÓGICA: parseo más robusto y deduplicado de llamadas ---
+        for tc in raw_calls:
+            name = tc.function.name
+            args_raw = tc.function.arguments
+            # Try to parse JSON; tolerate some bad quoting
+            args = {}
+            try:
+                args = json.loads(args_raw) if args_raw else {}
+            except Exception:
+                try:
+                    args = json.loads(args_raw.replace("'", '"'))
+                except Exception:
                     args = {}
-                    try:
-                        args = json.loads(args_raw) if args_raw else {}
-                    except Exception:
-                        try:
-                            args = json.loads(args_raw.replace("'", '"'))
-                        except Exception:
-                            args = {}
-
-                    # Sanitizar: si el dict tiene claves vacías ("" o espacios), tratarlas como {} 
-                    if isinstance(args, dict):
-                        if any((not str(k).strip()) for k in args.keys()):
-                            args = {}
-
-                    # Deduplicar llamadas consecutivas idénticas (mismo name + mismos args)
-                    if merged_calls and name == merged_calls[-1]["name"] and merged_calls[-1]["args"] == args:
-                        # Omitir duplicado
-                        continue
-
-                    # Mantener la lógica original de fusionar comandos `execute_terminal_command` consecutivos
-                    if merged_calls and name == "execute_terminal_command" and merged_calls[-1]["name"] == "execute_terminal_command":
-                        prev_cmd = merged_calls[-1]["args"].get("command", "")
-                        new_cmd = args.get("command", "")
-                        if prev_cmd and new_cmd:
-                            merged = prev_cmd + " && " + new_cmd
-                        else:
-                            merged = prev_cmd or new_cmd
-                        merged_calls[-1]["args"]["command"] = merged
-                        # Nota: no duplicamos el 'raw' aquí
+
+            # Sanitizar: si el dict tiene claves vacías ("" o espacios), tratarlas como {} 
+            if isinstance(args, dict):
+                if any((not str(k).strip()) for k in args.keys()):
+                    args = {}
+
+            # Deduplicar llamadas consecutivas idénticas (mismo name + mismos args)
+            if merged_calls and name == merged_calls[-1]["name"] and merged_calls[-1]["args"] == args:
+                # Omitir duplicado
+                continue
+
+            merged_calls.append({"name": name, "args": args, "raw": args_raw})
+        return merged_calls
+
+    def _plan_execution(self, merged_calls):
+        """Aplica en orden la puerta de confirmación de comandos destructivos.
+        Devuelve un paso por llamada; los pasos con `result` None son ejecutables (en paralelo).
+        Un comando destructivo sin confirmar detiene el plan: las llamadas posteriores se omiten."""
+        steps = []
+        blocked = False
+        for index, mc in enumerate(merged_calls):
+            tool_input = mc["args"] if isinstance(mc.get("args"), dict) else {}
+            step = {"index": index, "name": mc["name"], "input": tool_input, "raw": mc.get("raw"),
+                    "args": None, "result": None, "status": None, "elapsed": 0.0}
+            if blocked:
+                step["result"] = "⏭️ Llamada omitida: hay un comando pendiente de confirmación del usuario"
+                step["status"] = "skipped"
+            else:
+                pending_before = self.pending_confirmation
+                try:
+                    args, early = self._prepare_tool_call(mc["name"], tool_input)
+                except Exception as e:
+                    args, early = None, f"Error ejecutando {mc['name']}: {str(e)}"
+                if early is not None:
+                    step["result"] = early
+                    if self.pending_confirmation is not None and self.pending_confirmation is not pending_before:
+                        step["status"] = "confirmation"
+                        blocked = True
                     else:
-                        merged_calls.append({"name": name, "args": args, "raw": args_raw})
+                        step["status"] = "error"
+                else:
+                    step["args"] = args
+            steps.append(step)
+        return steps
+
+    def _tool_status(self, result):
+        return "error" if isinstance(result, str) and result.startswith("Error") else "ok"
 
-                combined_outputs = []
-                assistant_record = {"role": "assistant", "content": None, "tool_calls": []}
+    def _start_steps(self, steps, on_event):
+        for step in steps:
+            print(f"\n 🛠️ Herramienta llamada: {step['name']}")
+            print(f" ⚙️ Argumento: {step['input']}")
+            self._emit(on_event, "tool_start", index=step["index"], name=step["name"], args=step["input"])
 
-                # Ahora ejecutar cada llamada (ya fusionadas y deduplicadas)
-                for mc in merged_calls:
-                    tool_name = mc["name"]
-                    tool_input = mc["args"] if isinstance(mc.get("args"), dict) else {}
+    def _record_usage(self, response):
+        """Suma a las métricas los tokens que el backend informa en `usage` (si lo hace)."""
+        usage = getattr(response, "usage", None)
+        if usage is None:
+            return
+        model = self.context.model
+        prompt = getattr(usage, "prompt_tokens", None) or 0
+        completion = getattr(usage, "completion_tokens", None) or 0
+        metrics.inc("agent_llm_tokens_total", prompt, model=model, kind="prompt")
+        metrics.inc("agent_llm_tokens_total", completion, model=model, kind="completion")
+        metrics.trace("usage", model=model, prompt_tokens=prompt, completion_tokens=completion)
 
-                    print(f"\n 🛠️ Herramienta llamada: {tool_name}")
-                    print(f" ⚙️ Argumento: {tool_input}")
-                    result = self.handle_tool_call(tool_name, tool_input)
+    def _finish_step(self, step, on_event):
+        metrics.inc("agent_tool_calls_total", tool=step["name"], status=step["status"])
+        icon = {"ok": "✅", "error": "❌", "confirmation": "⏳", "skipped": "⏭️"}.get(step["status"], "")
+        print(f" {icon} {step['name']} [{step['status']}] ({step['elapsed']:.2f}s)")
+        out_text = step["result"] if isinstance(step["result"], str) else json.dumps(step["result"], ensure_ascii=False)
+        self._emit(on_event, "tool_end", index=step["index"], name=step["name"], args=step["input"],
+                   output=out_text, status=step["status"], elapsed=round(step["elapsed"], 3),
+                   pending_confirmation=step["status"] == "confirmation")
 
-                    assistant_record["tool_calls"].append({
-                        "type": "function",
-                        "function": {"name": tool_name, "arguments": mc.get("raw")}
-                    })
+    def _execute_steps(self, steps, on_event):
+        """Ejecuta los pasos ejecutables en un pool de hilos acotado y rellena su resultado."""
+        self._start_steps(steps, on_event)
+        runnable = [st for st in steps if st["status"] is None]
 
-                    out_text = result if isinstance(result, str) else json.dumps(result, ensure_ascii=False)
+        def run(step):
+            started = time.perf_counter()
+            with metrics.span("tool", tool=step["name"]):
+                step["result"] = self._run_tool(step["name"], step["args"])
+            step["elapsed"] = time.perf_counter() - started
+            step["status"] = self._tool_status(step["result"])
+            return step
 
-                    try:
-                        params_json = json.dumps(tool_input, ensure_ascii=False, indent=2) if tool_input else ""
-                    except Exception:
-                        params_json = str(tool_input) if tool_input else ""
+        # Los pasos no ejecutables (omitidos, confirmación, error previo) se notifican ya
+        for step in steps:
+            if step["status"] is not None:
+                self._finish_step(step, on_event)
 
-                    header = f"== {tool_name} ==\n"
-                    param_line = f"Parámetros: {params_json}\n" if params_json else ""
+        if len(runnable) == 1:
+            self._finish_step(run(runnable[0]), on_event)
+        elif runnable:
+            workers = max(1, min(self.MAX_PARALLEL_TOOLS, len(runnable)))
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                # Cada hilo con una copia del contexto: los spans conservan el id del turno
+                futures = [pool.submit(contextvars.copy_context().run, run, st) for st in runnable]
+                # Los eventos se emiten desde este hilo, en orden de finalización
+                for future in as_completed(futures):
+                    self._finish_step(future.result(), on_event)
 
-                    combined_outputs.append(header + param_line + out_text)
+    async def _execute_steps_async(self, steps, on_event):
+        """Versión asíncrona de `_execute_steps` (gather acotado por un semáforo)."""
+        self._start_steps(steps, on_event)
+        for step in steps:
+            if step["status"] is not None:
+                self._finish_step(step, on_event)
 
-                    # Si se generó una confirmación pendiente, detener la ejecución de llamadas subsecuentes
-                    if self.pending_confirmation is not None:
-                        print("⏳ Esperando confirmación del usuario para comando destructivo")
-                        break
+        semaphore = asyncio.Semaphore(max(1, self.MAX_PARALLEL_TOOLS))
 
-                combined_text = "\n\n".join(combined_outputs)
-                self.messages.append({
-                    "role": "tool",
-                    "content": combined_text,
-                    "display_as": "code",
-                    "tool_calls": assistant_record["tool_calls"]
-                })
+        async def run(step):
+            async with semaphore:
+                started = time.perf_counter()
+                with metrics.span("tool", tool=step["name"]):
+                    step["result"] = await self._run_tool_async(step["name"], step["args"])
+                step["elapsed"] = time.perf_counter() - started
+                step["status"] = self._tool_status(step["result"])
+            self._finish_step(step, on_event)
 
-                # Limpiar memoria si es necesario
-                self._cleanup_messages()
+        await asyncio.gather(*(run(st) for st in steps if st["status"] is None))
+
+    def _append_steps(self, steps):
+        """Añade al historial un único mensaje `tool` con los resultados en el orden de las llamadas."""
+        combined_outputs = []
+        tool_calls = []
+        for step in steps:
+            tool_calls.append({
+                "type": "function",
+                "function": {"name": step["name"], "arguments": step["raw"]}
+            })
+            _, combined = self._format_tool_output(step["name"], step["input"], step["result"])
+            combined_outputs.append(combined)
+
+        if self.pending_confirmation is not None and any(st["status"] == "confirmation" for st in steps):
+            print("⏳ Esperando confirmación del usuario para comando destructivo")
+        self._append_tool_message(combined_outputs, tool_calls)
+
+    def _format_tool_output(self, tool_name, tool_input, result):
+        """Texto del mensaje `tool`: cabecera, parámetros (si los hay) y salida, o una referencia
+        a una salida anterior idéntica o casi idéntica (ver tool_encoding.py)."""
+        out_text = result if isinstance(result, str) else json.dumps(result, ensure_ascii=False)
+        return out_text, self.tool_encoder.format(tool_name, tool_input, out_text, self._in_history)
+
+    def _in_history(self, message, length):
+        # Un mensaje solo sirve de referencia si sigue en el historial sin recortar
+        return (message is not None and len(message.get("content") or "") == length
+                and any(m is message for m in self.messages))
+
+    def _append_tool_message(self, combined_outputs, tool_calls):
+        combined_text = "\n\n".join(combined_outputs)
+        message = {
+            "role": "tool",
+            "content": combined_text,
+            "display_as": "code",
+            "tool_calls": tool_calls
+        }
+        self.add_message(message)
+        self.tool_encoder.bind(message)
+
+        # Limpiar memoria si es necesario
+        self._cleanup_messages()
+
+    def add_tool_result(self, tool_name, tool_input, result):
+        """Añade el mensaje `tool` de una llamada ejecutada fuera del loop (p. ej. un comando confirmado)."""
+        _, content = self._format_tool_output(tool_name, tool_input, result)
+        arguments = json.dumps(tool_input, ensure_ascii=False)
+        self._append_tool_message([content], [{"type": "function", "function": {"name": tool_name, "arguments": arguments}}])
+
+    def _append_final_answer(self, response, on_event):
+        # Respuesta de texto normal
+        output_text = response.choices[0].message.content
+        if output_text:
+            self.add_message({"role": "assistant", "content": output_text})
+            if on_event is None:
+                print(f"\n🤖 Asistente: {output_text}")
+            else:
+                self._emit(on_event, "assistant", content=output_text)
+
+        # Limpiar memoria si es necesario
+        self._cleanup_messages()
+
+    def _append_internal_error(self, e):
+        metrics.inc("agent_errors_total", source="process_response")
+        print(f"❌ Error procesando respuesta: {e}")
+        self.add_message({
+            "role": "system",
+            "content": f"Error interno: {str(e)}"
+        })
+
+    def process_response(self, response, on_event=None):
+        """Procesa respuesta de OpenAI API.
+        Las llamadas a herramientas independientes de una misma respuesta se ejecutan en paralelo
+        (ver `_plan_execution`) y sus resultados se guardan en el orden de las llamadas.
+        Si se pasa `on_event`, se emiten eventos `tool_start`/`tool_end` por cada herramienta
+        y `assistant` con la respuesta final (en lugar de imprimirla).
+        Retorna True si se ejecutó una herramienta, False si es respuesta final."""
+        self._record_usage(response)
+        try:
+            # Manejar respuestas con tool calls
+            if response.choices[0].message.tool_calls:
+                merged_calls = self._plan_tool_calls(response.choices[0].message.tool_calls)
+                steps = self._plan_execution(merged_calls)
+                self._execute_steps(steps, on_event)
+                self._append_steps(steps)
                 return True
                 
             else:
-                # Respuesta de texto normal
-                output_text = response.choices[0].message.content
-                if output_text:
-                    self.messages.append({"role": "assistant", "content": output_text})
-                    print(f"\n🤖 Asistente: {output_text}")
-                
-                # Limpiar memoria si es necesario
-                self._cleanup_messages()
+                self._append_final_answer(response, on_event)
                 return False
                 
         except Exception as e:
-            print(f"❌ Error procesando respuesta: {e}")
-            self.messages.append({
-                "role": "system",
-                "content": f"Error interno: {str(e)}"
-            })
+            self._append_internal_error(e)
             return False
 
+    async def process_response_async(self, response, on_event=None):
+        """Versión asíncrona de `process_response` (usa subprocesos asyncio)."""
+        self._record_usage(response)
+        try:
+            if response.choices[0].message.tool_calls:
+                merged_calls = self._plan_tool_calls(response.choices[0].message.tool_calls)
+                steps = self._plan_execution(merged_calls)
+                await self._execute_steps_async(steps, on_event)
+                self._append_steps(steps)
+                return True
+            else:
+                self._append_final_answer(response, on_event)
+                return False
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._append_internal_error(e)
+            return False
@@ -0,0 +1,409 @@
+import asyncio
+import inspect
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from openai import APIConnectionError, APIStatusError, AsyncOpenAI, OpenAI
+
+from metrics import metrics
+from model_catalog import BACKEND_RETRY, BackendUnavailable, ModelCatalog
+
+
+# Backends compatibles con OpenAI separados por comas; si no se indica, solo AGENT_LLM_BASE_URL
+LLM_BASE_URL = os.environ.get("AGENT_LLM_BASE_URL", "http://localhost:1234/v1")
+LLM_BACKENDS = [url.strip() for url in os.environ.get("AGENT_LLM_BACKENDS", "").split(",") if url.strip()] or [LLM_BASE_URL]
+LLM_API_KEY = os.environ.get("AGENT_LLM_API_KEY", "lm-studio")
+# Segundos entre sondas de salud y latencia (0 las desactiva)
+PROBE_INTERVAL = float(os.environ.get("AGENT_BACKEND_PROBE_INTERVAL", "15"))
+# Intentos por llamada al modelo (el primero más los reintentos en otro backend)
+MAX_ATTEMPTS = int(os.environ.get("AGENT_BACKEND_ATTEMPTS", "3"))
+# Presupuesto de reintentos: cada petición aporta RETRY_RATIO reintentos, acumulables hasta RETRY_BURST.
+# Con el backend caído de verdad el presupuesto se agota y no se multiplica la carga por MAX_ATTEMPTS.
+RETRY_RATIO = float(os.environ.get("AGENT_BACKEND_RETRY_RATIO", "0.2"))
+RETRY_BURST = 10
+# Peticiones en curso de más que se toleran en el backend de la sesión antes de mandarla a otro
+# (seguir en el mismo backend reutiliza la caché KV del prefijo de la conversación)
+STICKY_SLACK = int(os.environ.get("AGENT_BACKEND_STICKY_SLACK", "2"))
+# Sesiones recordadas para el enrutado fijo
+MAX_STICKY_SESSIONS = 4096
+# Espera antes de reintentar en el mismo backend cuando no queda otro
+RETRY_BACKOFF = 0.5
+# Peso de la última medida en la media móvil de latencia
+LATENCY_ALPHA = 0.3
+
+
+def _retryable(error):
+    """Errores tras los que tiene sentido probar otro backend: conexión, timeout, 5xx y 429."""
+    if isinstance(error, APIConnectionError):
+        return True
+    return isinstance(error, APIStatusError) and (error.status_code >= 500 or error.status_code == 429)
+
+
+class Backend:
+    """Un endpoint compatible con OpenAI: clientes, catálogo de modelos y estado para el enrutado."""
+
+    def __init__(self, url, api_key=LLM_API_KEY):
+        self.url = url.rstrip("/")
+        self.api_key = api_key
+        self.catalog = ModelCatalog(self.url)
+        self._async_client = None
+        self._sync_client = None
+        self.healthy = True          # según la última sonda (optimista hasta la primera)
+        self.down_until = 0.0        # tras un error de conexión no se elige hasta entonces
+        self.outstanding = 0         # peticiones en curso (hasta terminar de leer el stream)
+        self.latency = None          # media móvil hasta la respuesta HTTP (o la sonda), en segundos
+        self.requests = 0
+        self.errors = 0
+        self.last_error = None
+
+    # Los clientes no reintentan por su cuenta: los reintentos los decide el pool (en otro backend)
+    @property
+    def async_client(self):
+        if self._async_client is None:
+            self._async_client = AsyncOpenAI(base_url=self.url, api_key=self.api_key, max_retries=0)
+        return self._async_client
+
+    @property
+    def sync_client(self):
+        if self._sync_client is None:
+            self._sync_client = OpenAI(base_url=self.url, api_key=self.api_key, max_retries=0)
+        return self._sync_client
+
+    def available(self, now=None):
+        return self.healthy and (now or time.monotonic()) >= self.down_until
+
+    def serves(self, model):
+        """False solo si el backend respondió a /models y el modelo no está en la lista."""
+        models = self.catalog.known_models()
+        return not model or models is None or model in models
+
+    def observe_latency(self, seconds):
+        self.latency = seconds if self.latency is None else (1 - LATENCY_ALPHA) * self.latency + LATENCY_ALPHA * seconds
+
+    def describe(self):
+        now = time.monotonic()
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "available": self.available(now),
+            "retry_in": round(self.down_until - now, 1) if now < self.down_until else 0,
+            "outstanding": self.outstanding,
+            "latency_ms": round(self.latency * 1000, 1) if self.latency is not None else None,
+            "requests": self.requests,
+            "errors": self.errors,
+            "last_error": self.last_error,
+            "models": self.catalog.known_models(),
+        }
+
+
+class _TrackedStream:
+    """Envuelve el stream de una respuesta para contar la petición como en curso hasta que se termina
+    de leer (el backend sigue generando mientras tanto).
+
+    `release` debe poder llamarse varias veces. Se llama al agotar el stream, ante cualquier excepción
+    al leerlo (también la cancelación de la tarea), al cerrarlo (`close`/`aclose` o saliendo del
+    `with`) y, como último recurso, al recogerlo el GC si el consumidor lo abandonó a medias.
+    """
+
+    def __init__(self, stream, release):
+        self._stream = stream
+        self._release = release
+        self._iterator = None
+
+    def __iter__(self):
+        self._iterator = iter(self._stream)
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._iterator)
+        except BaseException:
+            self._release()
+            raise
+
+    def __aiter__(self):
+        self._iterator = self._stream.__aiter__()
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self._iterator.__anext__()
+        except BaseException:
+            self._release()
+            raise
+
+    def close(self):
+        """Cierra la respuesta del stream síncrono (corta la generación en el backend) y libera."""
+        try:
+            close = getattr(self._stream, "close", None)
+            if close is not None:
+                close()
+        finally:
+            self._release()
+
+    async def aclose(self):
+        """Como `close` para el stream asíncrono (`AsyncStream.close` es una corrutina)."""
+        try:
+            close = getattr(self._stream, "close", None)
+            if close is not None:
+                result = close()
+                if inspect.isawaitable(result):
+                    await result
+        finally:
+            self._release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+    def __del__(self):
+        self._release()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+class BackendPool:
+    """Varios backends compatibles con OpenAI (LM Studio, llama.cpp, vLLM...) tras una sola interfaz.
+
+    - Un hilo sondea cada backend cada `probe_interval` segundos (`/models`): salud, latencia y
+      modelos servidos (el catálogo de cada backend queda además fresco).
+    - Enrutado por modelo entre los backends sanos que lo sirven: menos peticiones en curso y, a
+      igualdad, menor latencia. Una sesión se queda en su backend mientras no tenga más de
+      `sticky_slack` peticiones en curso por encima del menos cargado, para aprovechar su caché KV.
+    - Si la llamada falla por conexión, timeout, 5xx o 429 se repite en otro backend, como mucho
+      `max_attempts` intentos y siempre que quede presupuesto de reintentos (RETRY_RATIO por petición).
+      Un fallo a mitad de un stream no se repite: el texto ya se entregó al cliente.
+    El estado se actualiza sin lock: las llamadas asíncronas corren en el event loop del servidor y
+    las síncronas en el hilo de la CLI; el hilo de sondas solo toca `healthy`, `latency` y `down_until`.
+    """
+
+    def __init__(self, urls=LLM_BACKENDS, probe_interval=PROBE_INTERVAL, max_attempts=MAX_ATTEMPTS,
+                 retry_ratio=RETRY_RATIO, sticky_slack=STICKY_SLACK):
+        self.backends = [Backend(url) for url in dict.fromkeys(urls)]
+        self.probe_interval = probe_interval
+        self.max_attempts = max(1, max_attempts)
+        self.retry_ratio = retry_ratio
+        self.sticky_slack = sticky_slack
+        self._budget = float(RETRY_BURST)
+        self._sticky = OrderedDict()
+        self._stop = threading.Event()
+        self._thread = None
+        self.retries = 0
+        self.failovers = 0
+        self.budget_exhausted = 0
+
+    @property
+    def primary(self):
+        return self.backends[0]
+
+    # --- Sondas -----------------------------------------------------------------------------
+
+    def start(self):
+        """Lanza el hilo de sondas (no hace nada si ya corre o si están desactivadas)."""
+        if self._thread is not None or self.probe_interval <= 0:
+            return
+        self._thread = threading.Thread(target=self._probe_loop, name="backend-probe", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _probe_loop(self):
+        while not self._stop.is_set():
+            self.probe()
+            self._stop.wait(self.probe_interval)
+
+    def probe(self):
+        """Consulta `/models` en cada backend y actualiza su salud y latencia."""
+        for backend in self.backends:
+            started = time.perf_counter()
+            try:
+                backend.catalog.refresh(quiet=True)
+            except BackendUnavailable as e:
+                if backend.healthy:
+                    print(f"⚠️  Backend {backend.url} no disponible: {e}")
+                backend.healthy = False
+                backend.last_error = str(e)
+                metrics.inc("agent_backend_probes_total", backend=backend.url, status="down")
+                continue
+            if not backend.healthy:
+                print(f"✅ Backend {backend.url} disponible de nuevo")
+            backend.healthy = True
+            backend.down_until = 0.0
+            if backend.latency is None:
+                backend.observe_latency(time.perf_counter() - started)
+            metrics.inc("agent_backend_probes_total", backend=backend.url, status="up")
+
+    # --- Enrutado ---------------------------------------------------------------------------
+
+    def choose(self, model=None, session_id=None, exclude=()):
+        """Backend para la siguiente llamada de la sesión, entre los disponibles que sirven el modelo
+        (o todos los disponibles si ninguno lo anuncia). Si todos están caídos se prueba el que antes
+        vuelve a estar disponible (mejor un intento que fallar sin preguntar)."""
+        now = time.monotonic()
+        candidates = [b for b in self.backends if b not in exclude] or list(self.backends)
+        live = [b for b in candidates if b.available(now)]
+        if not live:
+            live = [min(candidates, key=lambda b: (b.down_until, b.outstanding))]
+        live = [b for b in live if b.serves(model)] or live
+        best = min(live, key=lambda b: (b.outstanding, b.latency if b.latency is not None else 0.0))
+        choice = best
+        sticky = self._sticky.get(session_id) if session_id is not None else None
+        if sticky in live and sticky.outstanding <= best.outstanding + self.sticky_slack:
+            choice = sticky
+        if session_id is not None:
+            self._sticky[session_id] = choice
+            self._sticky.move_to_end(session_id)
+            while len(self._sticky) > MAX_STICKY_SESSIONS:
+                self._sticky.popitem(last=False)
+        return choice
+
+    def forget(self, session_id):
+        self._sticky.pop(session_id, None)
+
+    # --- Llamadas al modelo -----------------------------------------------------------------
+
+    async def create(self, session_id=None, **kwargs):
+        """`chat.completions.create` asíncrono con enrutado y reintento en otro backend."""
+        self._deposit()
+        tried = []
+        for attempt in range(1, self.max_attempts + 1):
+            backend = self._begin(kwargs.get("model"), session_id, tried)
+            started = time.perf_counter()
+            try:
+                response = await backend.async_client.chat.completions.create(**kwargs)
+            except BaseException as e:
+                # También CancelledError (cliente desconectado): si no, la petición quedaría en curso
+                self._release(backend)
+                if not isinstance(e, Exception) or not self._should_retry(backend, e, attempt):
+                    raise
+                if backend in tried:
+                    await asyncio.sleep(RETRY_BACKOFF * attempt)
+                tried.append(backend)
+                continue
+            return self._finish(backend, response, started, kwargs.get("stream"))
+
+    def create_sync(self, session_id=None, **kwargs):
+        """Versión síncrona de `create` (CLI)."""
+        self._deposit()
+        tried = []
+        for attempt in range(1, self.max_attempts + 1):
+            backend = self._begin(kwargs.get("model"), session_id, tried)
+            started = time.perf_counter()
+            try:
+                response = backend.sync_client.chat.completions.create(**kwargs)
+            except BaseException as e:
+                # También KeyboardInterrupt (Ctrl+C en la CLI)
+                self._release(backend)
+                if not isinstance(e, Exception) or not self._should_retry(backend, e, attempt):
+                    raise
+                if backend in tried:
+                    time.sleep(RETRY_BACKOFF * attempt)
+                tried.append(backend)
+                continue
+            return self._finish(backend, response, started, kwargs.get("stream"))
+
+    def _deposit(self):
+        self._budget = min(float(RETRY_BURST), self._budget + self.retry_ratio)
+
+    def _begin(self, model, session_id, tried):
+        backend = self.choose(model, session_id, exclude=tried)
+        if tried and backend is not tried[-1]:
+            self.failovers += 1
+            metrics.inc("agent_backend_failovers_total", source=tried[-1].url, target=backend.url)
+        backend.outstanding += 1
+        backend.requests += 1
+        return backend
+
+    def _release(self, backend):
+        backend.outstanding = max(0, backend.outstanding - 1)
+
+    def _finish(self, backend, response, started, stream):
+        backend.observe_latency(time.perf_counter() - started)
+        metrics.inc("agent_backend_requests_total", backend=backend.url, status="ok")
+        if not stream:
+            self._release(backend)
+            return response
+        released = []
+
+        def release():
+            if not released:
+                released.append(True)
+                self._release(backend)
+
+        return _TrackedStream(response, release)
+
+    def _should_retry(self, backend, error, attempt):
+        retryable = _retryable(error)
+        backend.errors += 1
+        backend.last_error = f"{type(error).__name__}: {error}"
+        metrics.inc("agent_backend_requests_total", backend=backend.url, status="retryable" if retryable else "error")
+        if isinstance(error, APIConnectionError):
+            # Caído o colgado: no se le vuelve a elegir hasta pasado BACKEND_RETRY (la sonda lo reabre antes)
+            backend.down_until = time.monotonic() + BACKEND_RETRY
+        if not retryable or attempt >= self.max_attempts:
+            return False
+        if self._budget < 1:
+            self.budget_exhausted += 1
+            metrics.inc("agent_backend_retry_budget_exhausted_total")
+            return False
+        self._budget -= 1
+        self.retries += 1
+        print(f"🔁 Reintentando la llamada al modelo tras un error en {backend.url}: {backend.last_error}")
+        return True
+
+    # --- Catálogo ---------------------------------------------------------------------------
+
+    def list(self, force=False):
+        """Modelos servidos por algún backend (unión, en orden) e info de caché del backend principal.
+        Lanza BackendUnavailable solo si no responde ninguno."""
+        models, info, errors = [], None, []
+        for backend in self.backends:
+            try:
+                backend_models, backend_info = backend.catalog.list(force=force)
+            except BackendUnavailable as e:
+                errors.append(f"{backend.url}: {e}")
+                continue
+            models.extend(m for m in backend_models if m not in models)
+            info = info or backend_info
+        if info is None:
+            raise BackendUnavailable("; ".join(errors))
+        return models, dict(info, backends_down=len(errors))
+
+    def info(self, model):
+        """Metadatos del modelo según el primer backend que lo conoce."""
+        for backend in self.backends:
+            if backend.catalog.context_tokens(model) is not None:
+                return backend.catalog.info(model)
+        return self.primary.catalog.info(model)
+
+    def describe(self):
+        return [backend.describe() for backend in self.backends]
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            "configured": len(self.backends),
+            "available": sum(1 for b in self.backends if b.available(now)),
+            "outstanding": sum(b.outstanding for b in self.backends),
+            "retries": self.retries,
+            "failovers": self.failovers,
+            "retry_budget": round(self._budget, 2),
+            "budget_exhausted": self.budget_exhausted,
+            "sticky_sessions": len(self._sticky),
+        }
+
+
+# Pool compartido por todo el proceso
+backends = BackendPool()
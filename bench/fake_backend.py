@@ -0,0 +1,204 @@
+"""Servidor falso compatible con la API de OpenAI para medir el agente sin LM Studio ni GPU.
+
+Responde a `GET /v1/models` y `POST /v1/chat/completions` (con y sin `stream`) siguiendo un guion:
+la respuesta número N de un turno es el paso N del guion (N = mensajes `tool` después del último
+mensaje `user`). Cada paso puede pedir herramientas o dar una respuesta de texto. La latencia
+hasta el primer token y la velocidad en tokens/s son configurables.
+
+Uso independiente (por ejemplo para probar `main.py` o `server.py` a mano):
+
+    python -m bench.fake_backend --port 1234 --latency-ms 200 --tokens-per-s 50
+"""
+import argparse
+import json
+import threading
+import time
+import uuid
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+DEFAULT_SCRIPT = {
+    "models": ["fake-model", "fake-gemma"],
+    # Milisegundos hasta el primer token y velocidad de generación
+    "latency_ms": 50,
+    "tokens_per_s": 400,
+    "steps": [
+        {"tool_calls": [{"name": "execute_terminal_command", "arguments": {"command": "echo hola"}}]},
+        {"content": "Listo: el comando se ejecutó correctamente y devolvió 'hola'.", "content_tokens": 40},
+    ],
+}
+
+
+def _words(step):
+    """Texto del paso dividido en 'tokens' (palabras); `content_tokens` lo rellena hasta ese tamaño."""
+    words = (step.get("content") or "").split()
+    target = int(step.get("content_tokens") or 0)
+    while len(words) < target:
+        words.append("lorem")
+    return [w + " " for w in words]
+
+
+class FakeBackend:
+    """Backend falso en un hilo propio. `service_time` acumula, por prompt de usuario, los segundos
+    que el backend dedicó a ese turno (sirve para restarlos y obtener el coste propio del agente)."""
+
+    def __init__(self, script=None, host="127.0.0.1", port=0):
+        self.script = dict(DEFAULT_SCRIPT, **(script or {}))
+        self.requests = 0
+        self.service_time = defaultdict(float)
+        self._lock = threading.Lock()
+        backend = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Sin Nagle: cabeceras y cuerpo van en escrituras separadas y el ACK retardado añadiría ~40 ms
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.rstrip("/").endswith("/models"):
+                    data = {"object": "list", "data": [{"id": m, "object": "model"} for m in backend.script["models"]]}
+                    return self._json(200, data)
+                self._json(404, {"error": "not found"})
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(length) or b"{}")
+                if not self.path.rstrip("/").endswith("/chat/completions"):
+                    return self._json(404, {"error": "not found"})
+                backend.handle_completion(self, body)
+
+            def _json(self, status, data):
+                raw = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(raw)))
+                self.end_headers()
+                self.wfile.write(raw)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    # --- Respuestas -----------------------------------------------------------------------
+
+    def _step(self, messages):
+        last_user = max((i for i, m in enumerate(messages) if m.get("role") == "user"), default=-1)
+        prompt = messages[last_user].get("content") if last_user >= 0 else ""
+        rounds = sum(1 for m in messages[last_user + 1:] if m.get("role") == "tool")
+        steps = self.script["steps"]
+        return prompt, steps[min(rounds, len(steps) - 1)]
+
+    def handle_completion(self, handler, body):
+        start = time.perf_counter()
+        prompt, step = self._step(body.get("messages") or [])
+        model = body.get("model") or self.script["models"][0]
+        delay = self.script["latency_ms"] / 1000
+        per_token = 1 / self.script["tokens_per_s"] if self.script["tokens_per_s"] else 0
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        tool_calls = [
+            {"id": f"call_{uuid.uuid4().hex[:8]}", "type": "function",
+             "function": {"name": tc["name"], "arguments": json.dumps(tc.get("arguments") or {})}}
+            for tc in step.get("tool_calls") or []
+        ]
+        words = _words(step)
+        # 'Tokens' del prompt aproximados por palabras, para que `usage` tenga valores plausibles
+        prompt_tokens = sum(len(str(m.get("content") or "").split()) for m in body.get("messages") or [])
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(words),
+                 "total_tokens": prompt_tokens + len(words)}
+        finish = "tool_calls" if tool_calls else "stop"
+
+        time.sleep(delay)
+        if body.get("stream"):
+            handler.send_response(200)
+            handler.send_header("Content-Type", "text/event-stream")
+            handler.send_header("Transfer-Encoding", "chunked")
+            handler.end_headers()
+
+            def send(delta, finish_reason=None, **extra):
+                choices = [] if delta is None else [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+                chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                         "model": model, "choices": choices, **extra}
+                data = f"data: {json.dumps(chunk)}\n\n".encode()
+                handler.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                handler.wfile.flush()
+
+            send({"role": "assistant", "content": ""})
+            for word in words:
+                time.sleep(per_token)
+                send({"content": word})
+            for i, tc in enumerate(tool_calls):
+                send({"tool_calls": [{"index": i, "id": tc["id"], "type": "function",
+                                      "function": {"name": tc["function"]["name"], "arguments": ""}}]})
+                send({"tool_calls": [{"index": i, "function": {"arguments": tc["function"]["arguments"]}}]})
+            send({}, finish)
+            if (body.get("stream_options") or {}).get("include_usage"):
+                send(None, usage=usage)
+            done = b"data: [DONE]\n\n"
+            handler.wfile.write(f"{len(done):x}\r\n".encode() + done + b"\r\n0\r\n\r\n")
+            handler.wfile.flush()
+        else:
+            time.sleep(per_token * len(words))
+            message = {"role": "assistant", "content": "".join(words).strip() or None}
+            if tool_calls:
+                message["tool_calls"] = tool_calls
+            handler._json(200, {
+                "id": completion_id, "object": "chat.completion", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "message": message, "finish_reason": finish}],
+                "usage": usage,
+            })
+
+        with self._lock:
+            self.requests += 1
+            self.service_time[prompt] += time.perf_counter() - start
+
+    def take_service_time(self, prompt):
+        """Devuelve (y olvida) los segundos de backend acumulados para un prompt."""
+        with self._lock:
+            return self.service_time.pop(prompt, 0.0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backend falso compatible con OpenAI")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1234)
+    parser.add_argument("--script", help="Fichero JSON con el guion (models, latency_ms, tokens_per_s, steps)")
+    parser.add_argument("--latency-ms", type=float)
+    parser.add_argument("--tokens-per-s", type=float)
+    args = parser.parse_args()
+
+    script = {}
+    if args.script:
+        with open(args.script, encoding="utf-8") as f:
+            script = json.load(f)
+    if args.latency_ms is not None:
+        script["latency_ms"] = args.latency_ms
+    if args.tokens_per_s is not None:
+        script["tokens_per_s"] = args.tokens_per_s
+    backend = FakeBackend(script, host=args.host, port=args.port)
+    print(f"🧪 Backend falso escuchando en {backend.url}")
+    try:
+        backend.server.serve_forever()
+    except KeyboardInterrupt:
+        backend.server.server_close()
+
+
+if __name__ == "__main__":
+    main()
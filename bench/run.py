@@ -0,0 +1,236 @@
+"""Escenarios de rendimiento del agente contra el backend falso (`bench/fake_backend.py`).
+
+    python -m bench.run                                 # todos los escenarios
+    python -m bench.run --scenario chat --turns 100
+    python -m bench.run --scenario concurrent --sessions 16 --stream --json resultados.json
+
+Cada turno es: prompt del usuario -> el modelo pide una herramienta -> respuesta final (ver el
+guion por defecto del backend). Se informa la latencia por turno (p50/p95/p99), el coste propio
+del agente (latencia menos el tiempo que el backend dedicó al turno), el rendimiento y la RSS.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from bench.fake_backend import FakeBackend  # noqa: E402
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * p / 100
+    lo, hi = int(k), min(int(k) + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+def rss_mb():
+    """RSS actual del proceso en MB (pico si /proc no está disponible)."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def summarize(name, latencies, overheads, wall):
+    ms = lambda v: round(v * 1000, 2)  # noqa: E731
+    return {
+        "scenario": name,
+        "turns": len(latencies),
+        "p50_ms": ms(percentile(latencies, 50)),
+        "p95_ms": ms(percentile(latencies, 95)),
+        "p99_ms": ms(percentile(latencies, 99)),
+        "overhead_p50_ms": ms(percentile(overheads, 50)),
+        "overhead_p95_ms": ms(percentile(overheads, 95)),
+        "overhead_mean_ms": ms(statistics.fmean(overheads)) if overheads else 0.0,
+        "throughput_turns_s": round(len(latencies) / wall, 2) if wall else 0.0,
+        "rss_mb": round(rss_mb(), 1),
+    }
+
+
+# --- Escenario: Agent.process_response / process_stream directamente ---------------------
+
+def scenario_agent(backend, args, stream=False):
+    from openai import OpenAI
+    from agent import Agent
+
+    client = OpenAI(base_url=backend.url, api_key="bench")
+    agent = Agent()
+    agent.set_model("fake-model", max_tokens=1024)
+    wait_shell_pool()
+    latencies, overheads = [], []
+    wall = time.perf_counter()
+    for i in range(args.turns):
+        prompt = f"bench agent turn {i}"
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            agent.add_message({"role": "user", "content": prompt})
+            while True:
+                response = client.chat.completions.create(
+                    model="fake-model", messages=agent.messages, tools=agent.tools, max_tokens=1024, stream=stream
+                )
+                if stream:
+                    called_tool = agent.process_stream(response, on_event=lambda event: None)
+                else:
+                    called_tool = agent.process_response(response)
+                if not called_tool:
+                    break
+        elapsed = time.perf_counter() - start
+        latencies.append(elapsed)
+        overheads.append(elapsed - backend.take_service_time(prompt))
+    agent.close()
+    return summarize("agent-stream" if stream else "agent", latencies, overheads, time.perf_counter() - wall)
+
+
+# --- Escenarios HTTP: /api/chat y /api/chat/stream sobre la app ASGI ---------------------
+
+async def _chat_turn(client, session_id, prompt, stream):
+    """Un turno; devuelve el id de sesión que asigna el servidor (el primer turno va sin él)."""
+    headers = {"X-Session-Id": session_id} if session_id else {}
+    if not stream:
+        resp = await client.post("/api/chat", json={"prompt": prompt}, headers=headers)
+        resp.raise_for_status()
+        return resp.headers.get("X-Session-Id")
+    async with client.stream("POST", "/api/chat/stream", json={"prompt": prompt}, headers=headers) as resp:
+        resp.raise_for_status()
+        async for line in resp.aiter_lines():
+            if line.startswith("data:") and '"type": "done"' in line:
+                break
+        return resp.headers.get("X-Session-Id")
+
+
+async def _run_sessions(backend, app, sessions, turns, stream):
+    import httpx
+
+    latencies, overheads = [], []
+    transport = httpx.ASGITransport(app=app)
+
+    async def run_session(s):
+        # Un cliente por sesión: la cookie de sesión de una no se mezcla con las demás
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=120) as client:
+            session_id = None
+            for i in range(turns):
+                prompt = f"bench chat s{s} turn {i}"
+                start = time.perf_counter()
+                session_id = await _chat_turn(client, session_id, prompt, stream)
+                elapsed = time.perf_counter() - start
+                latencies.append(elapsed)
+                overheads.append(elapsed - backend.take_service_time(prompt))
+
+    wall = time.perf_counter()
+    await asyncio.gather(*(run_session(s) for s in range(sessions)))
+    return latencies, overheads, time.perf_counter() - wall
+
+
+async def scenario_chat(backend, args, app, sessions=1):
+    name = "concurrent" if sessions > 1 else "chat"
+    if args.stream:
+        name += "-stream"
+    turns = args.turns if sessions == 1 else max(1, args.turns // sessions)
+    with contextlib.redirect_stdout(io.StringIO()):
+        latencies, overheads, wall = await _run_sessions(backend, app, sessions, turns, args.stream)
+    result = summarize(name, latencies, overheads, wall)
+    result["sessions"] = sessions
+    return result
+
+
+async def run_http_scenarios(backend, args, names):
+    # Un solo event loop para todos: el cliente AsyncOpenAI del servidor y los locks de sesión viven en él
+    app = load_server(backend)
+    results = []
+    for name in names:
+        print(f"▶️  {name}...", file=sys.stderr)
+        results.append(await scenario_chat(backend, args, app, sessions=1 if name == "chat" else args.sessions))
+    return results
+
+
+def load_server(backend):
+    """Importa `server` apuntando al backend falso y con la persistencia en un directorio temporal."""
+    os.environ["AGENT_LLM_BASE_URL"] = backend.url
+    os.environ.setdefault("AGENT_STORE_PATH", os.path.join(tempfile.mkdtemp(prefix="agent-bench-"), "bench.db"))
+    os.environ.setdefault("AGENT_MODEL", "fake-model")
+    with contextlib.redirect_stdout(io.StringIO()):
+        import server
+    wait_shell_pool()
+    return server.APP
+
+
+def wait_shell_pool(timeout=120):
+    """Espera a que el pool de shells esté caliente: se mide el régimen estable, no el arranque."""
+    from shell_pool import shell_pool
+    shell_pool.warm()
+    deadline = time.monotonic() + timeout
+    while shell_pool.enabled and shell_pool.stats()["idle"] < shell_pool.size and time.monotonic() < deadline:
+        time.sleep(0.1)
+
+
+def print_table(results):
+    columns = ["scenario", "turns", "p50_ms", "p95_ms", "p99_ms", "overhead_p50_ms", "overhead_p95_ms",
+               "throughput_turns_s", "rss_mb"]
+    widths = [max(len(c), *(len(str(r.get(c, ""))) for r in results)) for c in columns]
+    print("  ".join(c.ljust(w) for c, w in zip(columns, widths)))
+    for r in results:
+        print("  ".join(str(r.get(c, "")).ljust(w) for c, w in zip(columns, widths)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del agente contra un backend OpenAI falso")
+    parser.add_argument("--scenario", choices=["all", "agent", "agent-stream", "chat", "concurrent"], default="all")
+    parser.add_argument("--turns", type=int, default=50, help="Turnos por escenario (repartidos entre sesiones)")
+    parser.add_argument("--sessions", type=int, default=8, help="Sesiones simultáneas del escenario concurrent")
+    parser.add_argument("--stream", action="store_true", help="Usar /api/chat/stream en los escenarios HTTP")
+    parser.add_argument("--latency-ms", type=float, default=None, help="Latencia del backend hasta el primer token")
+    parser.add_argument("--tokens-per-s", type=float, default=None, help="Velocidad del backend")
+    parser.add_argument("--llm-concurrency", type=int, default=None,
+                        help="Llamadas simultáneas al backend en server.py (AGENT_LLM_CONCURRENCY); la espera en cola cuenta como coste del agente")
+    parser.add_argument("--script", help="Guion JSON para el backend falso")
+    parser.add_argument("--json", help="Guardar los resultados en este fichero JSON")
+    args = parser.parse_args()
+
+    script = {}
+    if args.script:
+        with open(args.script, encoding="utf-8") as f:
+            script = json.load(f)
+    if args.latency_ms is not None:
+        script["latency_ms"] = args.latency_ms
+    if args.tokens_per_s is not None:
+        script["tokens_per_s"] = args.tokens_per_s
+    if args.llm_concurrency is not None:
+        os.environ["AGENT_LLM_CONCURRENCY"] = str(args.llm_concurrency)
+    backend = FakeBackend(script).start()
+
+    results = []
+    scenarios = [args.scenario] if args.scenario != "all" else ["agent", "agent-stream", "chat", "concurrent"]
+    for name in [n for n in scenarios if n.startswith("agent")]:
+        print(f"▶️  {name}...", file=sys.stderr)
+        results.append(scenario_agent(backend, args, stream=name == "agent-stream"))
+    http = [n for n in scenarios if not n.startswith("agent")]
+    if http:
+        results.extend(asyncio.run(run_http_scenarios(backend, args, http)))
+    backend.stop()
+
+    print_table(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"script": backend.script, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
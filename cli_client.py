@@ -0,0 +1,360 @@
+import http.client
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import urlsplit
+
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+_USER = os.getuid() if hasattr(os, "getuid") else os.environ.get("USERNAME", "user")
+# Directorio privado (0700) del daemon: socket, pid y log. Nadie más puede conectarse al socket,
+# que daría acceso a ejecutar comandos con los permisos de este usuario.
+DAEMON_DIR = os.environ.get("AGENT_DAEMON_DIR") or os.path.join(
+    os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir(), f"agent-{_USER}")
+DAEMON_SOCKET = os.path.join(DAEMON_DIR, "server.sock")
+# Sin sockets Unix (Windows) el daemon escucha en este puerto local
+DAEMON_PORT = int(os.environ.get("AGENT_DAEMON_PORT", "8765"))
+USE_UDS = hasattr(socket, "AF_UNIX") and sys.platform != "win32"
+DAEMON_URL = f"unix://{DAEMON_SOCKET}" if USE_UDS else f"http://127.0.0.1:{DAEMON_PORT}"
+# Segundos que se espera a que el daemon responda tras lanzarlo
+START_TIMEOUT = 60
+SESSION_HEADER = "X-Session-Id"
+
+GREEN = "\033[92m"
+RESET = "\033[0m"
+
+
+class ServerError(Exception):
+    def __init__(self, status, detail):
+        super().__init__(f"{status}: {detail}")
+        self.status = status
+        self.detail = detail
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+class ServerClient:
+    """Sesión de chat contra un server.py ya en marcha (`unix:///ruta.sock` o `http://host:puerto`).
+
+    Solo usa la biblioteca estándar (ni `openai` ni `Agent`): el CLI arranca en decenas de
+    milisegundos y aprovecha las cachés y sesiones del servidor. Habla el mismo protocolo que la
+    interfaz Web: `POST /api/chat/stream` con eventos SSE y la sesión en la cabecera X-Session-Id.
+    Las confirmaciones de comandos destructivos se responden con un prompt "sí"/"no", como en la Web.
+    """
+
+    def __init__(self, url, session_id=None):
+        self.url = url
+        self.session_id = session_id
+        parts = urlsplit(url)
+        self._unix = parts.scheme == "unix"
+        self._address = parts.path if self._unix else parts.netloc
+        self._https = parts.scheme == "https"
+        self._prefix = "" if self._unix else parts.path.rstrip("/")
+
+    def _connection(self, timeout):
+        if self._unix:
+            return _UnixHTTPConnection(self._address, timeout=timeout)
+        cls = http.client.HTTPSConnection if self._https else http.client.HTTPConnection
+        return cls(self._address, timeout=timeout)
+
+    def _send(self, method, path, payload=None, timeout=30):
+        conn = self._connection(timeout)
+        headers = {"Accept": "application/json"}
+        if self.session_id:
+            headers[SESSION_HEADER] = self.session_id
+        body = None
+        if payload is not None:
+            body = json.dumps(payload).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+        conn.request(method, self._prefix + path, body=body, headers=headers)
+        resp = conn.getresponse()
+        self.session_id = resp.getheader(SESSION_HEADER) or self.session_id
+        if resp.status >= 400:
+            data = resp.read()
+            conn.close()
+            try:
+                detail = json.loads(data).get("detail")
+            except (ValueError, AttributeError):
+                detail = data.decode("utf-8", errors="replace")
+            raise ServerError(resp.status, detail)
+        return conn, resp
+
+    def get(self, path, timeout=30):
+        conn, resp = self._send("GET", path, timeout=timeout)
+        try:
+            data = resp.read()
+        finally:
+            conn.close()
+        if "json" in (resp.getheader("Content-Type") or ""):
+            return json.loads(data)
+        return data.decode("utf-8", errors="replace")
+
+    def post(self, path, payload, timeout=30):
+        conn, resp = self._send("POST", path, payload, timeout=timeout)
+        try:
+            return json.loads(resp.read())
+        finally:
+            conn.close()
+
+    def alive(self, timeout=1.0):
+        """True si el servidor responde (sin crear sesión)."""
+        try:
+            conn = self._connection(timeout)
+            conn.request("GET", self._prefix + "/api/queue")
+            ok = conn.getresponse().status == 200
+            conn.close()
+            return ok
+        except (OSError, http.client.HTTPException):
+            return False
+
+    def chat(self, prompt):
+        """Envía el prompt y va devolviendo los eventos SSE del turno (dicts con `type`)."""
+        conn, resp = self._send("POST", "/api/chat/stream", {"prompt": prompt}, timeout=None)
+        try:
+            data = []
+            while True:
+                line = resp.readline()
+                if not line:
+                    break
+                line = line.decode("utf-8").rstrip("\r\n")
+                if line.startswith("data:"):
+                    data.append(line[5:].lstrip())
+                elif not line and data:
+                    yield json.loads("\n".join(data))
+                    data = []
+        finally:
+            conn.close()
+
+
+# --- Interfaz de texto ----------------------------------------------------------------------
+
+def _print_event(event, state):
+    kind = event.get("type")
+    if kind == "token":
+        if not state["streaming"]:
+            print("\n🤖 Asistente: ", end="", flush=True)
+            state["streaming"] = True
+        print(event.get("content", ""), end="", flush=True)
+        state["printed"] = True
+        return
+    if state["streaming"]:
+        print()
+        state["streaming"] = False
+    if kind == "queued":
+        print(f"⏳ En cola del backend (posición {event.get('position')} de {event.get('waiting')})")
+    elif kind == "tool_start":
+        state["printed"] = False
+        print(f"\n 🛠️ Herramienta llamada: {event.get('name')}")
+        print(f" ⚙️ Argumento: {event.get('args')}")
+    elif kind == "tool_end":
+        icon = {"ok": "✅", "error": "❌", "confirmation": "⏳", "skipped": "⏭️"}.get(event.get("status"), "")
+        print(f" {icon} {event.get('name')} [{event.get('status')}] ({event.get('elapsed', 0):.2f}s)")
+    elif kind == "assistant":
+        # En streaming el texto ya llegó como tokens
+        if not state["printed"]:
+            print(f"\n🤖 Asistente: {event.get('content')}")
+            state["printed"] = True
+    elif kind == "done":
+        # Respuestas que no llegaron como tokens (confirmaciones, cancelaciones, modo sin streaming)
+        if not state["printed"] and event.get("response"):
+            print(f"\n🤖 Asistente: {event['response']}")
+        cached = event.get("cached")
+        if cached:
+            similar = f", pregunta parecida: «{cached['prompt']}»" if cached.get("kind") == "near" else ""
+            print(f"♻️  Respuesta de caché (hace {cached.get('age')} s{similar})")
+    elif kind == "error":
+        print(f"❌ Error del servidor: {event.get('detail')}")
+
+
+def _choose_model(client, current):
+    models = client.get("/api/models").get("models", [])
+    for i, m in enumerate(models):
+        activo = " (activo)" if m == current else ""
+        print(f"    {i} - {m}{GREEN}{activo}{RESET}")
+    choice = input(f"\n{GREEN}Si quiere cambiar de Modelo introduzca (0..{len(models) - 1}): {RESET}").strip()
+    if not (choice.isdigit() and 0 <= int(choice) < len(models)):
+        print("Entrada no válida, no se cambió el modelo.")
+        return current
+    model = client.post("/api/model", {"model": models[int(choice)]})["model"]
+    print(f"✅ Historial limpiado. Nueva conversación con el modelo {model}")
+    return model
+
+
+def _print_metrics(client):
+    """Contadores del servidor (los spans detallados están en /api/metrics)."""
+    text = client.get("/api/metrics")
+    lines = [l for l in text.splitlines() if l.startswith(("agent_turns_total", "agent_llm_tokens_total",
+                                                           "agent_tool_tokens_saved_total", "agent_backends_"))]
+    print("\n".join(f"    {l}" for l in lines) or "Todavía no hay métricas.")
+
+
+def run(url, session_id=None):
+    """Bucle de conversación contra el servidor (mismos comandos que el modo local)."""
+    client = ServerClient(url, session_id)
+    if not client.alive(timeout=3):
+        print(f"❌ No se pudo conectar con el servidor en {url}")
+        return 1
+    try:
+        model = client.get("/api/context").get("model")
+        if session_id and client.session_id != session_id:
+            # El servidor no adopta ids desconocidos: asigna uno nuevo
+            print(f"⚠️  La sesión {session_id} no existe en el servidor; se abre una nueva ({client.session_id})")
+        elif session_id:
+            history = client.get("/api/messages")
+            print(f"Sesión {session_id} retomada ({len(history.get('messages', []))} mensajes)")
+    except (ServerError, OSError, http.client.HTTPException) as e:
+        print(f"❌ No se pudo abrir la sesión en el servidor: {e}")
+        return 1
+    print(f"Conectado a {url} (modelo {model})")
+    while True:
+        try:
+            user_input = input(f"\n👦 {GREEN}Tú: {RESET}").strip()
+        except (EOFError, KeyboardInterrupt):
+            print()
+            break
+        if not user_input:
+            continue
+        if user_input.lower() in ("salir", "exit", "bye", "sayonara"):
+            print("Hasta luego!")
+            break
+        try:
+            if user_input == "/metrics":
+                _print_metrics(client)
+                continue
+            if user_input == "/models":
+                model = _choose_model(client, model)
+                continue
+            state = {"streaming": False, "printed": False}
+            for event in client.chat(user_input):
+                _print_event(event, state)
+                model = event.get("model", model)
+        except ServerError as e:
+            print(f"❌ {e.detail}" if e.status != 429 else f"⏳ Servidor ocupado: {e.detail}")
+        except KeyboardInterrupt:
+            # Cerrar la conexión cancela el turno en el servidor
+            print("\n⏹️  Turno cancelado")
+        except (OSError, http.client.HTTPException) as e:
+            print(f"❌ Conexión con el servidor perdida: {e}")
+            if not client.alive():
+                break
+    if client.session_id:
+        print(f"Para retomar la conversación: python main.py --session {client.session_id}")
+    return 0
+
+
+# --- Daemon ---------------------------------------------------------------------------------
+
+def _pid_path():
+    return os.path.join(DAEMON_DIR, "server.pid")
+
+
+def _daemon_pid():
+    try:
+        with open(_pid_path()) as f:
+            pid = int(f.read().strip())
+        os.kill(pid, 0)
+        return pid
+    except (OSError, ValueError):
+        return None
+
+
+def daemon(action):
+    client = ServerClient(DAEMON_URL)
+    pid = _daemon_pid()
+    if action == "status":
+        print(f"Daemon {'en marcha' if client.alive() else 'parado'} en {DAEMON_URL}" + (f" (pid {pid})" if pid else ""))
+        return 0
+    if action == "stop":
+        if pid is None:
+            print("El daemon no está en marcha")
+            return 1
+        os.kill(pid, signal.SIGTERM)
+        deadline = time.monotonic() + START_TIMEOUT
+        while _daemon_pid() is not None and time.monotonic() < deadline:
+            time.sleep(0.1)
+        if _daemon_pid() is not None:
+            print(f"⚠️  El daemon (pid {pid}) sigue en marcha tras {START_TIMEOUT}s")
+            return 1
+        os.remove(_pid_path())
+        print(f"🛑 Daemon detenido (pid {pid})")
+        return 0
+    if action != "start":
+        print(f"Acción desconocida '{action}' (start, stop o status)")
+        return 2
+    if client.alive():
+        print(f"El daemon ya está en marcha en {DAEMON_URL}")
+        return 0
+    os.makedirs(DAEMON_DIR, mode=0o700, exist_ok=True)
+    if USE_UDS:
+        info = os.stat(DAEMON_DIR)
+        if info.st_uid != os.getuid() or info.st_mode & 0o077:
+            print(f"❌ {DAEMON_DIR} no es un directorio privado de este usuario; usa AGENT_DAEMON_DIR")
+            return 1
+    address = ["--uds", DAEMON_SOCKET] if USE_UDS else ["--host", "127.0.0.1", "--port", str(DAEMON_PORT)]
+    if USE_UDS and os.path.exists(DAEMON_SOCKET):
+        os.remove(DAEMON_SOCKET)
+    log_path = os.path.join(DAEMON_DIR, "server.log")
+    with open(log_path, "ab") as log:
+        process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "server:APP", *address, "--log-level", "warning"],
+            cwd=APP_DIR, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+            start_new_session=True,
+        )
+    with open(_pid_path(), "w") as f:
+        f.write(str(process.pid))
+    deadline = time.monotonic() + START_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            print(f"❌ El daemon terminó al arrancar (código {process.returncode}); ver {log_path}")
+            return 1
+        if client.alive(timeout=0.5):
+            print(f"🚀 Daemon en marcha en {DAEMON_URL} (pid {process.pid}, log {log_path})")
+            return 0
+        time.sleep(0.1)
+    print(f"⚠️  El daemon no responde tras {START_TIMEOUT}s; ver {log_path}")
+    return 1
+
+
+def _load_env():
+    # python-dotenv solo si hay .env: importarlo cuesta más que el resto del cliente
+    if os.path.exists(".env") or os.path.exists(os.path.join(APP_DIR, ".env")):
+        from dotenv import load_dotenv
+        load_dotenv()
+        load_dotenv(os.path.join(APP_DIR, ".env"))
+
+
+def main(argv):
+    """Atiende los modos cliente y daemon. Devuelve el código de salida, o None si hay que arrancar
+    el agente local (`--local`, o sin servidor al que conectarse)."""
+    args = list(argv)
+    if "--local" in args:
+        return None
+    _load_env()
+    if "--daemon" in args:
+        i = args.index("--daemon")
+        return daemon(args[i + 1] if i + 1 < len(args) else "start")
+    session_id = args[args.index("--session") + 1] if "--session" in args[:-1] else None
+    # Servidor explícito (--attach o AGENT_SERVER_URL) o, si no, el daemon cuando está en marcha
+    url = args[args.index("--attach") + 1] if "--attach" in args[:-1] else os.environ.get("AGENT_SERVER_URL")
+    if url is None and ServerClient(DAEMON_URL).alive(timeout=0.5):
+        url = DAEMON_URL
+    if url is None:
+        if session_id:
+            print("⚠️  --session solo sirve conectado a un servidor; se arranca el agente local")
+        return None
+    return run(url, session_id)
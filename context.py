@@ -0,0 +1,300 @@
+import json
+import os
+
+from metrics import metrics
+
+
+# Longitud de contexto conocida por familia de modelo (subcadena del id, en minúsculas).
+# Se puede forzar para todos los modelos con AGENT_CONTEXT_TOKENS.
+MODEL_CONTEXT_TOKENS = {
+    "gemma": 8192,
+    "gpt-oss": 131072,
+    "qwen3": 32768,
+    "deepseek-r1": 32768,
+    "llama": 8192,
+    "mistral": 32768,
+}
+DEFAULT_CONTEXT_TOKENS = 16384
+# Al compactar se baja hasta esta fracción del presupuesto (y de max_messages): el hueco que queda
+# permite muchos turnos seguidos sin tocar el principio del prompt (caché de prefijo/KV del servidor)
+COMPACT_TARGET = float(os.environ.get("AGENT_CONTEXT_COMPACT_TARGET", "0.6"))
+# Tokens máximos del resumen de turnos descartados que se añade al mensaje de sistema
+SUMMARY_TOKENS = int(os.environ.get("AGENT_SUMMARY_TOKENS", "400"))
+SUMMARY_MARKER = "\n\n## Conversación anterior (resumen)\n"
+
+
+def model_context_length(model):
+    """Longitud de contexto según la familia del modelo (tabla MODEL_CONTEXT_TOKENS)."""
+    name = (model or "").lower()
+    for key, tokens in MODEL_CONTEXT_TOKENS.items():
+        if key in name:
+            return tokens
+    return DEFAULT_CONTEXT_TOKENS
+
+
+def estimate_tokens(text):
+    """Estimador rápido: ~4 bytes UTF-8 por token (suficiente para presupuestar)."""
+    if not text:
+        return 0
+    return (len(text.encode("utf-8")) + 3) // 4
+
+
+def default_tokenizer():
+    """Devuelve la función de conteo de tokens a usar.
+
+    Con AGENT_TOKENIZER=tiktoken se usa `tiktoken` (si está instalado); en otro caso el estimador.
+    """
+    if os.environ.get("AGENT_TOKENIZER", "").lower() == "tiktoken":
+        try:
+            import tiktoken
+            encoding = tiktoken.get_encoding("cl100k_base")
+            return lambda text: len(encoding.encode(text, disallowed_special=())) if text else 0
+        except Exception as e:
+            print(f"⚠️  No se pudo cargar tiktoken ({e}); se usa el estimador de tokens")
+    return estimate_tokens
+
+
+class ContextManager:
+    """Mantiene el historial dentro de un presupuesto de tokens por modelo.
+
+    Mientras el historial cabe, solo se añaden mensajes al final: el prompt de cada petición
+    empieza igual que el anterior y el servidor reutiliza su caché de prefijo (no repite el prefill).
+    Cuando supera el presupuesto se compacta de una vez hasta `COMPACT_TARGET` del presupuesto:
+    1) recorta las salidas de herramientas antiguas (cabeza + cola),
+    2) recorta las del último turno si ese turno por sí solo no cabe y, si no basta,
+    3) descarta los turnos más antiguos completos (un turno empieza en un mensaje `user`),
+       de modo que una llamada a herramienta nunca se separa de su resultado, y los resume en un
+       bloque fijo al final del mensaje de sistema.
+    El mensaje de sistema y el último turno se conservan siempre.
+    """
+
+    MESSAGE_OVERHEAD = 4  # tokens aproximados por mensaje (rol, separadores)
+
+    def __init__(self, tokenizer=None, reserve_tokens=4096, max_messages=None, tool_output_tokens=512,
+                 compact_target=COMPACT_TARGET, summary_tokens=SUMMARY_TOKENS):
+        self.tokenizer = tokenizer or default_tokenizer()
+        self.reserve_tokens = reserve_tokens
+        self.max_messages = max_messages
+        self.tool_output_tokens = tool_output_tokens
+        self.compact_target = min(1.0, max(0.1, compact_target))
+        self.summary_tokens = summary_tokens
+        self.model = None
+        self.context_tokens = {}
+        self._counts = {}
+        self.last_tokens = 0
+        self.truncated = 0
+        self.dropped = 0
+        self.compactions = 0
+        # Resumen de los turnos descartados (una línea por turno) y turnos resumidos en total
+        self.summary = []
+        self.summarized_turns = 0
+        # Prefijo enviado la última vez: [(mensaje, longitud del contenido)] para detectar cambios
+        self._prefix = []
+        self.prefix_checks = 0
+        self.prefix_changes = 0
+
+    def set_tokenizer(self, tokenizer):
+        self.tokenizer = tokenizer
+        self._counts = {}
+
+    def set_model(self, model, context_tokens=None):
+        """Selecciona el modelo activo; `context_tokens` fija su longitud de contexto si se conoce."""
+        self.model = model
+        if model and context_tokens:
+            self.context_tokens[model] = int(context_tokens)
+
+    def context_length(self):
+        forced = os.environ.get("AGENT_CONTEXT_TOKENS")
+        if forced:
+            return int(forced)
+        if self.model in self.context_tokens:
+            return self.context_tokens[self.model]
+        return model_context_length(self.model)
+
+    def budget(self):
+        """Tokens disponibles para el prompt (contexto menos lo reservado para la respuesta)."""
+        length = self.context_length()
+        return max(length // 2, length - self.reserve_tokens)
+
+    def message_tokens(self, message):
+        # Caché por identidad del mensaje; se invalida si cambia la longitud del contenido
+        content = message.get("content") or ""
+        if not isinstance(content, str):
+            content = json.dumps(content, ensure_ascii=False)
+        key = id(message)
+        cached = self._counts.get(key)
+        if cached is not None and cached[0] is message and cached[1] == len(content):
+            return cached[2]
+
+        tokens = self.MESSAGE_OVERHEAD + self.tokenizer(content)
+        for tc in message.get("tool_calls") or []:
+            fn = tc.get("function") or {}
+            tokens += self.tokenizer(fn.get("name") or "") + self.tokenizer(fn.get("arguments") or "")
+        self._counts[key] = (message, len(content), tokens)
+        return tokens
+
+    def count(self, messages):
+        return sum(self.message_tokens(m) for m in messages)
+
+    def _turns(self, messages):
+        """Agrupa los mensajes (sin el de sistema) en turnos que empiezan en un mensaje `user`."""
+        turns = []
+        for m in messages:
+            if m.get("role") == "user" or not turns:
+                turns.append([m])
+            else:
+                turns[-1].append(m)
+        return turns
+
+    def _truncate_tool_output(self, message):
+        content = message.get("content") or ""
+        max_chars = self.tool_output_tokens * 4
+        # Margen para no volver a recortar una salida ya recortada (el aviso añade texto)
+        if len(content) <= max_chars + 256:
+            return False
+        head = content[: max_chars * 2 // 3]
+        tail = content[-(max_chars // 3):]
+        omitted = len(content) - len(head) - len(tail)
+        message["content"] = f"{head}\n[... {omitted} caracteres omitidos para ahorrar contexto ...]\n{tail}"
+        return True
+
+    def fit(self, messages):
+        """Ajusta `messages` al presupuesto. Devuelve la lista resultante (el primer mensaje es el de sistema)."""
+        budget = self.budget()
+        total = self.count(messages)
+        too_many = self.max_messages is not None and len(messages) > self.max_messages
+
+        compacted = False
+        if total > budget or too_many:
+            messages, total = self._compact(messages, budget, total)
+            compacted = True
+
+        # Olvidar conteos de mensajes que ya no están en el historial
+        if len(self._counts) > 2 * len(messages) + 16:
+            alive = {id(m) for m in messages}
+            self._counts = {k: v for k, v in self._counts.items() if k in alive}
+
+        self.last_tokens = total if compacted else self.count(messages)
+        self._track_prefix(messages, "compaction" if compacted else "edit")
+        return messages
+
+    def _compact(self, messages, budget, total):
+        """Compacta de una vez hasta `compact_target` del presupuesto. Devuelve (mensajes, tokens)."""
+        target = int(budget * self.compact_target)
+        max_target = int(self.max_messages * self.compact_target) if self.max_messages is not None else None
+        system_msg, rest = messages[0], messages[1:]
+        turns = self._turns(rest)
+
+        # 1) Recortar salidas de herramientas antiguas (todas menos las del último turno)
+        if total > budget:
+            old_tools = (m for turn in turns[:-1] for m in turn if m.get("role") == "tool")
+            for m in old_tools:
+                if self._truncate_tool_output(m):
+                    self.truncated += 1
+                    total = self.count(messages)
+                    if total <= target:
+                        break
+
+        # 2) Si el último turno por sí solo no cabe, recortar también sus salidas de herramientas
+        if turns and self.message_tokens(system_msg) + sum(self.message_tokens(m) for m in turns[-1]) > budget:
+            for m in turns[-1]:
+                if m.get("role") == "tool" and self._truncate_tool_output(m):
+                    self.truncated += 1
+            total = self.count(messages)
+
+        # 3) Descartar turnos completos desde el más antiguo hasta dejar hueco (no solo hasta caber)
+        removed = []
+        while len(turns) > 1 and (
+            total > target
+            or (max_target is not None and 1 + sum(len(t) for t in turns) > max_target)
+        ):
+            turn = turns.pop(0)
+            total -= sum(self.message_tokens(m) for m in turn)
+            removed.append(turn)
+
+        self.compactions += 1
+        metrics.inc("agent_context_compactions_total")
+        if removed:
+            dropped = sum(len(t) for t in removed)
+            self.dropped += dropped
+            system_msg = self._summarize(system_msg, removed)
+            messages = [system_msg] + [m for turn in turns for m in turn]
+            total = self.count(messages)
+            print(f"⚠️  Historial compactado: {dropped} mensajes antiguos resumidos (~{total} tokens de {budget})")
+        return messages, total
+
+    def _digest(self, turn):
+        """Una línea de resumen por turno: inicio del prompt del usuario y herramientas usadas."""
+        prompt = next((m.get("content") for m in turn if m.get("role") == "user"), None)
+        prompt = " ".join(prompt.split())[:100] if isinstance(prompt, str) else "(sin prompt)"
+        tools = []
+        for m in turn:
+            if m.get("role") != "tool":
+                continue
+            for tc in m.get("tool_calls") or []:
+                name = (tc.get("function") or {}).get("name")
+                if name and name not in tools:
+                    tools.append(name)
+        return f"- «{prompt}»" + (f" → {', '.join(tools)}" if tools else "")
+
+    def _summarize(self, system_msg, removed):
+        """Mensaje de sistema con el resumen de los turnos descartados. Es texto fijo: solo cambia en
+        la siguiente compactación, así el prefijo del prompt se mantiene entre compactaciones."""
+        self.summary.extend(self._digest(turn) for turn in removed)
+        self.summarized_turns += len(removed)
+        base = (system_msg.get("content") or "").split(SUMMARY_MARKER)[0]
+        # Se conservan las líneas más recientes que caben en summary_tokens
+        lines, tokens = [], 0
+        for line in reversed(self.summary):
+            tokens += self.tokenizer(line) + 1
+            if tokens > self.summary_tokens:
+                break
+            lines.append(line)
+        self.summary = lines[::-1]
+        header = f"Se omitieron {self.summarized_turns} turnos antiguos. Últimos temas tratados:"
+        return {**system_msg, "content": base + SUMMARY_MARKER + header + "\n" + "\n".join(self.summary)}
+
+    def reset(self, system_msg):
+        """Olvida el resumen (la conversación se reinicia). Devuelve el mensaje de sistema original."""
+        self.summary = []
+        self.summarized_turns = 0
+        self._track_prefix([], "reset")
+        content = system_msg.get("content") or ""
+        if SUMMARY_MARKER not in content:
+            return system_msg
+        return {**system_msg, "content": content.split(SUMMARY_MARKER)[0]}
+
+    def _track_prefix(self, messages, reason):
+        """Comprueba que el historial empieza por lo enviado la vez anterior (mismos mensajes sin
+        modificar). Cada cambio obliga al servidor a repetir el prefill del prompt desde ese punto."""
+        def length(m):
+            content = m.get("content")
+            return len(content) if isinstance(content, str) else -1
+
+        previous = self._prefix
+        stable = len(previous) <= len(messages) and all(
+            m is old and length(m) == size for m, (old, size) in zip(messages, previous)
+        )
+        if previous:
+            self.prefix_checks += 1
+            if stable:
+                metrics.inc("agent_prefix_stable_total")
+            else:
+                self.prefix_changes += 1
+                metrics.inc("agent_prefix_changes_total", reason=reason)
+        self._prefix = [(m, length(m)) for m in messages]
+
+    def usage(self, messages=None):
+        tokens = self.count(messages) if messages is not None else self.last_tokens
+        return {
+            "model": self.model,
+            "tokens": tokens,
+            "budget": self.budget(),
+            "context_length": self.context_length(),
+            "truncated_tool_outputs": self.truncated,
+            "dropped_messages": self.dropped,
+            "compactions": self.compactions,
+            "summarized_turns": self.summarized_turns,
+            "prefix_checks": self.prefix_checks,
+            "prefix_changes": self.prefix_changes,
+        }
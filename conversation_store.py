@@ -0,0 +1,244 @@
+import atexit
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from context import estimate_tokens
+
+
+DEFAULT_STORE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "conversations.db")
+# Los mensajes se escriben en lotes: como mucho cada FLUSH_INTERVAL segundos o BATCH_SIZE operaciones
+FLUSH_INTERVAL = float(os.environ.get("AGENT_STORE_FLUSH_MS", "100")) / 1000
+BATCH_SIZE = 256
+# Filas leídas por consulta al cargar la cola de una conversación (se lee de la más nueva hacia atrás)
+LOAD_PAGE = 64
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    model TEXT,
+    title TEXT,
+    created_at REAL,
+    updated_at REAL,
+    reset_seq INTEGER NOT NULL DEFAULT 0,
+    last_seq INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS messages (
+    session_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    role TEXT,
+    data TEXT NOT NULL,
+    created_at REAL,
+    PRIMARY KEY (session_id, seq)
+) WITHOUT ROWID;
+"""
+
+
+class ConversationStore:
+    """Registro persistente y de solo añadir de las conversaciones (SQLite en modo WAL).
+
+    Las escrituras se encolan y las hace un hilo propio en lotes (una transacción por lote), así
+    guardar un mensaje no añade latencia al turno. Cambiar de modelo no borra nada: se anota el
+    `seq` del reinicio y al reanudar solo se cargan los mensajes posteriores. Al reanudar se lee la
+    conversación desde el final hacia atrás hasta llenar el presupuesto de tokens del contexto.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.environ.get("AGENT_STORE_PATH") or DEFAULT_STORE_PATH
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        conn = self._connect()
+        conn.executescript(SCHEMA)
+        conn.close()
+        self._queue = queue.Queue()
+        self._local = threading.local()
+        self.written = 0
+        self.batches = 0
+        self._writer = threading.Thread(target=self._write_loop, name="conversation-store", daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _reader(self):
+        # Una conexión de lectura por hilo (WAL permite leer mientras el hilo escritor escribe)
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    # --- Escritura (no bloqueante) --------------------------------------------------------
+
+    def append(self, session_id, seq, message, model=None):
+        """Encola un mensaje de la sesión. Se copia para que cambios posteriores no le afecten."""
+        self._queue.put(("message", session_id, seq, dict(message), model, time.time()))
+
+    def mark_reset(self, session_id, seq, model=None):
+        """Anota que la conversación se reinició en `seq` (los mensajes anteriores no se reanudan)."""
+        self._queue.put(("reset", session_id, seq, None, model, time.time()))
+
+    def delete(self, session_id):
+        self._queue.put(("delete", session_id, None, None, None, time.time()))
+
+    @property
+    def pending(self):
+        return self._queue.qsize()
+
+    def flush(self, timeout=10):
+        """Espera a que se escriba todo lo encolado hasta ahora."""
+        done = threading.Event()
+        self._queue.put(("flush", None, None, done, None, None))
+        return done.wait(timeout)
+
+    def close(self):
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join(timeout=10)
+
+    def _write_loop(self):
+        conn = self._connect()
+        while True:
+            op = self._queue.get()
+            batch = [op]
+            deadline = time.monotonic() + FLUSH_INTERVAL
+            # Reunir lo que llegue durante FLUSH_INTERVAL para escribirlo en una sola transacción
+            while op is not None and len(batch) < BATCH_SIZE:
+                remaining = deadline - time.monotonic()
+                try:
+                    op = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                batch.append(op)
+            events = []
+            try:
+                with conn:
+                    for op in batch:
+                        if op is None:
+                            continue
+                        if op[0] == "flush":
+                            events.append(op[3])
+                        else:
+                            self._apply(conn, op)
+                self.batches += 1
+            except sqlite3.Error as e:
+                print(f"⚠️  Error guardando conversaciones ({len(batch)} operaciones perdidas): {e}")
+            for event in events:
+                event.set()
+            if None in batch:
+                conn.close()
+                return
+
+    def _apply(self, conn, op):
+        kind, session_id, seq, message, model, ts = op
+        if kind == "message":
+            role = message.get("role")
+            conn.execute(
+                "INSERT OR REPLACE INTO messages (session_id, seq, role, data, created_at) VALUES (?, ?, ?, ?, ?)",
+                (session_id, seq, role, json.dumps(message, ensure_ascii=False, default=str), ts),
+            )
+            title = (message.get("content") or "")[:80] if role == "user" and isinstance(message.get("content"), str) else None
+            conn.execute(
+                """INSERT INTO sessions (id, model, title, created_at, updated_at, last_seq) VALUES (?, ?, ?, ?, ?, ?)
+                   ON CONFLICT(id) DO UPDATE SET model = COALESCE(excluded.model, model),
+                       title = COALESCE(title, excluded.title), updated_at = excluded.updated_at,
+                       last_seq = MAX(last_seq, excluded.last_seq)""",
+                (session_id, model, title, ts, ts, seq),
+            )
+            self.written += 1
+        elif kind == "reset":
+            conn.execute(
+                """INSERT INTO sessions (id, model, created_at, updated_at, reset_seq, last_seq) VALUES (?, ?, ?, ?, ?, ?)
+                   ON CONFLICT(id) DO UPDATE SET model = COALESCE(excluded.model, model), title = NULL,
+                       updated_at = excluded.updated_at, reset_seq = excluded.reset_seq,
+                       last_seq = MAX(last_seq, excluded.last_seq)""",
+                (session_id, model, ts, ts, seq, seq),
+            )
+        elif kind == "delete":
+            conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    # --- Lectura --------------------------------------------------------------------------
+
+    def session(self, session_id):
+        row = self._reader().execute(
+            "SELECT id, model, title, created_at, updated_at, reset_seq, last_seq FROM sessions WHERE id = ?",
+            (session_id,),
+        ).fetchone()
+        return self._session_row(row) if row else None
+
+    @staticmethod
+    def _session_row(row):
+        return {"id": row[0], "model": row[1], "title": row[2], "created_at": row[3],
+                "updated_at": row[4], "reset_seq": row[5], "last_seq": row[6]}
+
+    def load_tail(self, session_id, budget_tokens, tokenizer=estimate_tokens):
+        """Carga los últimos mensajes de la sesión que caben en `budget_tokens`.
+
+        Devuelve (info de la sesión, [(seq, mensaje), ...] en orden) o (None, []) si no existe.
+        El resultado empieza siempre en un mensaje `user` para no separar herramientas de su llamada.
+        """
+        info = self.session(session_id)
+        if info is None:
+            return None, []
+        conn = self._reader()
+        loaded = []
+        tokens = 0
+        before = info["last_seq"] + 1
+        while tokens < budget_tokens:
+            rows = conn.execute(
+                "SELECT seq, data FROM messages WHERE session_id = ? AND seq > ? AND seq < ? ORDER BY seq DESC LIMIT ?",
+                (session_id, info["reset_seq"], before, LOAD_PAGE),
+            ).fetchall()
+            if not rows:
+                break
+            for seq, data in rows:
+                message = json.loads(data)
+                content = message.get("content")
+                tokens += tokenizer(content if isinstance(content, str) else data)
+                loaded.append((seq, message))
+                if tokens >= budget_tokens:
+                    break
+            before = rows[-1][0]
+        loaded.reverse()
+        while loaded and loaded[0][1].get("role") != "user":
+            loaded.pop(0)
+        return info, loaded
+
+    def list_sessions(self, limit=50, offset=0):
+        rows = self._reader().execute(
+            """SELECT id, model, title, created_at, updated_at, reset_seq, last_seq FROM sessions
+               ORDER BY updated_at DESC LIMIT ? OFFSET ?""",
+            (limit, offset),
+        ).fetchall()
+        return [self._session_row(row) for row in rows]
+
+    def export(self, session_id):
+        """Itera todos los mensajes guardados de la sesión (incluidos los anteriores a un reinicio)."""
+        conn = self._reader()
+        after = 0
+        while True:
+            rows = conn.execute(
+                "SELECT seq, created_at, data FROM messages WHERE session_id = ? AND seq > ? ORDER BY seq LIMIT 500",
+                (session_id, after),
+            ).fetchall()
+            if not rows:
+                return
+            for seq, created_at, data in rows:
+                yield {"seq": seq, "created_at": created_at, "message": json.loads(data)}
+            after = rows[-1][0]
+
+    def stats(self):
+        return {"path": self.path, "pending": self._queue.qsize(), "written": self.written, "batches": self.batches}
+
+
+def default_store():
+    """Store configurado por entorno (AGENT_STORE=0 lo desactiva)."""
+    if os.environ.get("AGENT_STORE", "1").strip().lower() in ("0", "false", "no"):
+        return None
+    return ConversationStore()
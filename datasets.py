@@ -0,0 +1,335 @@
+import json
+import math
+import mmap
+import os
+import sys
+import threading
+from array import array
+
+
+# Datasets de texto del proyecto (carpeta persona/) y caché binaria de las tablas ya parseadas
+DATASETS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "persona")
+CACHE_DIR = os.environ.get("AGENT_DATASET_CACHE") or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "data", "datasets")
+# Fichero binario: MAGIC + longitud de la cabecera (4 bytes) + cabecera JSON + valores float64
+MAGIC = b"AGDSET01"
+# Máximo de valores devueltos en una serie (la respuesta al modelo debe ser corta)
+MAX_SERIES = 200
+
+MONTHS_ES = {"ene": "Jan", "feb": "Feb", "mar": "Mar", "abr": "Apr", "may": "May", "jun": "Jun",
+             "jul": "Jul", "ago": "Aug", "sep": "Sep", "oct": "Oct", "nov": "Nov", "dic": "Dec"}
+
+
+class DatasetError(Exception):
+    pass
+
+
+class Table:
+    """Tabla numérica densa: una fila por clave (p. ej. año) y columnas fijas.
+
+    `values` es un `array('d')` recién parseado o una vista `memoryview` sobre el mmap de la
+    caché binaria (sin copiar). Los valores que faltan son NaN.
+    """
+
+    def __init__(self, name, columns, keys, values, units="", title="", aliases=None, source=None, buffer=None):
+        self.name = name
+        self.columns = list(columns)
+        self.keys = list(keys)
+        self.values = values
+        self.units = units
+        self.title = title
+        self.aliases = aliases or {}
+        self.source = source
+        self._buffer = buffer  # mmap que respalda `values` (hay que mantenerlo abierto)
+        self._rows = {k: i for i, k in enumerate(self.keys)}
+        self._cols = {c.lower(): i for i, c in enumerate(self.columns)}
+
+    def column_index(self, column):
+        name = (column or "").strip()
+        name = self.aliases.get(name.lower(), name)
+        index = self._cols.get(name.lower())
+        if index is None:
+            raise DatasetError(f"columna '{column}' desconocida; disponibles: {', '.join(self.columns)}")
+        return index
+
+    def value(self, key, column):
+        row = self._rows.get(key)
+        if row is None:
+            return math.nan
+        return self.values[row * len(self.columns) + self.column_index(column)]
+
+    def series(self, column, start=None, end=None):
+        """[(clave, valor)] de una columna entre `start` y `end` (incluidos), sin los que faltan."""
+        col = self.column_index(column)
+        width = len(self.columns)
+        out = []
+        for row, key in enumerate(self.keys):
+            if (start is not None and key < start) or (end is not None and key > end):
+                continue
+            v = self.values[row * width + col]
+            if not math.isnan(v):
+                out.append((key, v))
+        return out
+
+    def missing(self):
+        return sum(1 for v in self.values if math.isnan(v))
+
+
+# --- Registro de datasets ---------------------------------------------------------------
+
+# nombre -> {"path", "title", "units", "aliases", "parse"}
+DATASETS = {}
+
+
+def register_dataset(name, path, title="", units="", aliases=None):
+    """Decorador para añadir un dataset: `parse(ruta)` devuelve {"columns", "keys", "rows"}
+    (rows = listas de floats, NaN si falta). `path` es relativo a DATASETS_DIR."""
+    def decorator(parse):
+        DATASETS[name] = {"path": os.path.join(DATASETS_DIR, path), "title": title, "units": units,
+                          "aliases": {k.lower(): v for k, v in (aliases or {}).items()}, "parse": parse}
+        return parse
+    return decorator
+
+
+@register_dataset(
+    "gistemp", os.path.join("temperatura", "GLB_Temps.txt"),
+    title="Índice global de temperatura tierra-océano (NASA GISTEMP), anomalías respecto a 1951-1980",
+    units="°C",
+    aliases={"annual": "J-D", "anual": "J-D", "año": "J-D", "year": "J-D", **MONTHS_ES},
+)
+def parse_gistemp(path):
+    """Tabla de ancho fijo de GISTEMP: cabeceras repetidas, '****' = falta y valores en 0.01 °C."""
+    columns = None
+    keys, rows = [], []
+    with open(path, encoding="utf-8", errors="replace") as f:
+        for line in f:
+            fields = line.split()
+            if not fields:
+                continue
+            if fields[0] == "Year" and fields[-1] == "Year":
+                columns = fields[1:-1]
+                continue
+            # Fila de datos: empieza y termina con el mismo año
+            if columns and fields[0].isdigit() and fields[-1] == fields[0] and len(fields) == len(columns) + 2:
+                keys.append(int(fields[0]))
+                rows.append([math.nan if "*" in v else int(v) / 100 for v in fields[1:-1]])
+    if not columns or not keys:
+        raise DatasetError(f"no se encontraron datos en {path}")
+    return {"columns": columns, "keys": keys, "rows": rows}
+
+
+# --- Carga con caché binaria ------------------------------------------------------------
+
+def _cache_path(name):
+    return os.path.join(CACHE_DIR, f"{name}.bin")
+
+
+def _source_signature(path):
+    st = os.stat(path)
+    return {"mtime_ns": st.st_mtime_ns, "size": st.st_size}
+
+
+def _write_cache(name, spec, signature, parsed, values):
+    header = json.dumps({
+        "name": name, "source": spec["path"], **signature, "byteorder": sys.byteorder,
+        "columns": parsed["columns"], "keys": parsed["keys"],
+    }).encode("utf-8")
+    # Relleno para que los float64 empiecen alineados a 8 bytes
+    padding = (-(len(MAGIC) + 4 + len(header))) % 8
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    path = _cache_path(name)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(MAGIC + (len(header) + padding).to_bytes(4, "little") + header + b" " * padding)
+        values.tofile(f)
+    os.replace(tmp, path)
+
+
+def _read_cache(name, spec, signature):
+    """Abre la caché con mmap si corresponde a la versión actual del fichero fuente (si no, None)."""
+    try:
+        f = open(_cache_path(name), "rb")
+    except OSError:
+        return None
+    with f:
+        try:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # fichero vacío
+            return None
+    if buffer[:len(MAGIC)] != MAGIC:
+        buffer.close()
+        return None
+    length = int.from_bytes(buffer[len(MAGIC):len(MAGIC) + 4], "little")
+    start = len(MAGIC) + 4
+    try:
+        header = json.loads(buffer[start:start + length])
+    except ValueError:
+        buffer.close()
+        return None
+    if (header.get("mtime_ns"), header.get("size"), header.get("byteorder")) != (
+            signature["mtime_ns"], signature["size"], sys.byteorder):
+        buffer.close()
+        return None
+    count = len(header["keys"]) * len(header["columns"])
+    offset = start + length
+    values = memoryview(buffer)[offset:offset + count * 8].cast("d")
+    return Table(name, header["columns"], header["keys"], values, units=spec["units"], title=spec["title"],
+                 aliases=spec["aliases"], source=spec["path"], buffer=buffer)
+
+
+def _load(name):
+    spec = DATASETS.get(name)
+    if spec is None:
+        raise DatasetError(f"dataset '{name}' desconocido; disponibles: {', '.join(sorted(DATASETS))}")
+    signature = _source_signature(spec["path"])
+    table = _read_cache(name, spec, signature)
+    if table is not None:
+        return table, signature
+    parsed = spec["parse"](spec["path"])
+    values = array("d", (v for row in parsed["rows"] for v in row))
+    try:
+        _write_cache(name, spec, signature, parsed, values)
+    except OSError as e:
+        print(f"⚠️  No se pudo guardar la caché del dataset {name}: {e}")
+    return Table(name, parsed["columns"], parsed["keys"], values, units=spec["units"], title=spec["title"],
+                 aliases=spec["aliases"], source=spec["path"]), signature
+
+
+_tables = {}
+_lock = threading.Lock()
+
+
+def get_table(name):
+    """Tabla del dataset; se vuelve a parsear solo si el fichero fuente cambió (mtime/tamaño)."""
+    with _lock:
+        entry = _tables.get(name)
+        if entry is not None and name in DATASETS and _source_signature(DATASETS[name]["path"]) == entry[1]:
+            return entry[0]
+        table, signature = _load(name)
+        _tables[name] = (table, signature)
+        return table
+
+
+# --- Consultas --------------------------------------------------------------------------
+
+def _fmt(v):
+    return f"{v:.2f}"
+
+
+def _parse_range(text):
+    """'1991-2020' -> (1991, 2020)."""
+    try:
+        start, end = str(text).split("-")
+        return int(start), int(end)
+    except ValueError:
+        raise DatasetError(f"rango '{text}' no válido (formato: 1991-2020)")
+
+
+def _trend_per_decade(points):
+    """Pendiente por mínimos cuadrados, en unidades por década."""
+    n = len(points)
+    if n < 2:
+        return math.nan
+    mx = sum(k for k, _ in points) / n
+    my = sum(v for _, v in points) / n
+    sxx = sum((k - mx) ** 2 for k, _ in points)
+    if not sxx:
+        return math.nan
+    return sum((k - mx) * (v - my) for k, v in points) / sxx * 10
+
+
+def query(dataset="gistemp", operation="info", column=None, year=None, start=None, end=None,
+          window=10, top=10, order="desc", baseline=None):
+    """Responde una consulta sobre un dataset con un texto corto.
+
+    Operaciones: info, value (year), series, stats, rolling (window), rank (top, order).
+    `baseline` ('1991-2020') expresa los valores como anomalía respecto a la media de ese periodo.
+    """
+    table = get_table(dataset)
+    operation = (operation or "info").lower()
+    if operation == "info":
+        first, last = table.keys[0], table.keys[-1]
+        return (f"{table.name}: {table.title}. Filas {first}-{last}, unidades {table.units}. "
+                f"Columnas: {', '.join(table.columns)}. Valores que faltan: {table.missing()}.")
+
+    column = column or (table.aliases.get("annual") or table.columns[0])
+    table.column_index(column)
+    label = table.aliases.get(column.lower(), column)
+    start = int(start) if start is not None else None
+    end = int(end) if end is not None else None
+
+    offset = 0.0
+    note = ""
+    if baseline:
+        b_start, b_end = _parse_range(baseline)
+        base = [v for _, v in table.series(column, b_start, b_end)]
+        if not base:
+            raise DatasetError(f"no hay datos de {label} en el periodo base {baseline}")
+        offset = sum(base) / len(base)
+        note = f", anomalía respecto a {b_start}-{b_end}"
+    units = f"{table.units}{note}"
+
+    if operation == "value":
+        if year is None:
+            raise DatasetError("la operación 'value' necesita 'year'")
+        v = table.value(int(year), column)
+        if math.isnan(v):
+            return f"{table.name} {label} {year}: sin dato"
+        return f"{table.name} {label} {year}: {_fmt(v - offset)} {units}"
+
+    points = [(k, v - offset) for k, v in table.series(column, start, end)]
+    if not points:
+        return f"{table.name} {label}: sin datos en el rango pedido"
+    span = f"{points[0][0]}-{points[-1][0]}"
+
+    if operation == "series":
+        shown = points[-MAX_SERIES:]
+        cut = f" (últimos {MAX_SERIES} de {len(points)})" if len(points) > MAX_SERIES else ""
+        return f"{table.name} {label} {span} ({units}){cut}: " + ", ".join(f"{k} {_fmt(v)}" for k, v in shown)
+
+    if operation == "stats":
+        values = [v for _, v in points]
+        lo = min(points, key=lambda p: p[1])
+        hi = max(points, key=lambda p: p[1])
+        trend = _trend_per_decade(points)
+        return (f"{table.name} {label} {span} ({units}): n={len(values)}, media {_fmt(sum(values) / len(values))}, "
+                f"mín {_fmt(lo[1])} ({lo[0]}), máx {_fmt(hi[1])} ({hi[0]}), tendencia {_fmt(trend)}/década")
+
+    if operation == "rolling":
+        window = max(1, int(window or 10))
+        by_key = dict(points)
+        rolling = []
+        total = 0.0
+        for i, (k, v) in enumerate(points):
+            total += v
+            if i >= window:
+                total -= points[i - window][1]
+            # Solo ventanas completas y sin huecos (claves consecutivas)
+            if i + 1 >= window and all((k - j) in by_key for j in range(window)):
+                rolling.append((k, total / window))
+        if not rolling:
+            return f"{table.name} {label}: no hay {window} valores seguidos en el rango pedido"
+        shown = rolling[-MAX_SERIES:]
+        return (f"{table.name} {label} media móvil de {window} ({units}), clave = final de la ventana: "
+                + ", ".join(f"{k} {_fmt(v)}" for k, v in shown))
+
+    if operation == "rank":
+        top = max(1, min(int(top or 10), MAX_SERIES))
+        ascending = (order or "desc").lower().startswith("asc")
+        ranked = sorted(points, key=lambda p: p[1], reverse=not ascending)[:top]
+        kind = "más bajos" if ascending else "más altos"
+        return (f"{table.name} {label} {span}, {top} {kind} ({units}): "
+                + "; ".join(f"{i}. {k} {_fmt(v)}" for i, (k, v) in enumerate(ranked, 1)))
+
+    raise DatasetError(f"operación '{operation}' desconocida (info, value, series, stats, rolling, rank)")
+
+
+if __name__ == "__main__":
+    import time
+    for name in DATASETS:
+        started = time.perf_counter()
+        print(query(name, "info"))
+        print(f"  carga: {(time.perf_counter() - started) * 1000:.2f} ms")
+    started = time.perf_counter()
+    print(query("gistemp", "rank", column="annual", top=5))
+    print(f"  consulta: {(time.perf_counter() - started) * 1000:.3f} ms")
@@ -0,0 +1,196 @@
+import getpass
+import os
+import platform
+import shutil
+import threading
+import time
+
+
+# Segundos tras los que la instantánea se considera antigua y se recoge de nuevo en segundo plano
+ENV_REFRESH = float(os.environ.get("AGENT_ENV_REFRESH", "3600"))
+# Bloque del entorno en el mensaje de sistema (AGENT_ENV_SNAPSHOT=0 lo desactiva)
+ENV_SNAPSHOT = os.environ.get("AGENT_ENV_SNAPSHOT", "1").strip().lower() not in ("0", "false", "no")
+ENV_MARKER = "\n\n## Entorno del sistema\n"
+# Segundos que se espera a la primera recogida antes de seguir sin instantánea
+WAIT_TIMEOUT = 2.0
+
+PACKAGE_MANAGERS = ["apt-get", "dnf", "yum", "zypper", "pacman", "apk", "brew", "port", "winget", "choco", "scoop"]
+# Herramientas de línea de comandos cuya presencia se anuncia al modelo
+CLI_TOOLS = [
+    "git", "curl", "wget", "python3", "python", "pip", "node", "npm", "docker", "podman", "kubectl",
+    "systemctl", "journalctl", "sudo", "make", "gcc", "java", "go", "cargo", "jq", "rg", "tar", "unzip",
+    "ssh", "rsync", "powershell", "pwsh",
+]
+
+
+def _os_release():
+    try:
+        info = platform.freedesktop_os_release()
+    except (OSError, AttributeError):
+        return None
+    return info.get("PRETTY_NAME") or " ".join(filter(None, [info.get("NAME"), info.get("VERSION_ID")]))
+
+
+def _memory_bytes():
+    """(total, disponible) en bytes o (None, None) si no se puede saber sin dependencias."""
+    try:
+        with open("/proc/meminfo", encoding="ascii") as f:
+            fields = {line.split(":")[0]: int(line.split()[1]) * 1024 for line in f if line.split()[1:2]}
+        return fields.get("MemTotal"), fields.get("MemAvailable")
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        total = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+        return total, None
+    except (AttributeError, ValueError, OSError):
+        return None, None
+
+
+def _gb(value):
+    return round(value / 1024 ** 3, 1) if value else None
+
+
+def collect():
+    """Recoge la información del entorno sin lanzar procesos (solo stdlib, /proc y el PATH)."""
+    system = platform.system()
+    mem_total, mem_available = _memory_bytes()
+    root = os.path.abspath(os.sep)
+    try:
+        disk = shutil.disk_usage(root)
+    except OSError:
+        disk = None
+    shell = os.environ.get("SHELL") or os.environ.get("COMSPEC")
+    if system != "Windows" and shutil.which("bash"):
+        # Los comandos se ejecutan con `bash -lc` (ver execute_terminal_command)
+        shell = shutil.which("bash")
+    try:
+        user = getpass.getuser()
+    except Exception:
+        user = None
+    return {
+        "platform": system,
+        "platform_release": platform.release(),
+        "platform_version": platform.version(),
+        "architecture": platform.machine(),
+        "hostname": platform.node(),
+        "python_version": platform.python_version(),
+        "distro": _os_release() if system == "Linux" else (f"macOS {platform.mac_ver()[0]}" if system == "Darwin" else None),
+        "kernel": platform.release() if system != "Windows" else None,
+        "cpu_count": os.cpu_count(),
+        "memory_total_gb": _gb(mem_total),
+        "memory_available_gb": _gb(mem_available),
+        "disk_root": root,
+        "disk_total_gb": _gb(disk.total) if disk else None,
+        "disk_free_gb": _gb(disk.free) if disk else None,
+        "shell": shell,
+        "user": user,
+        "is_root": hasattr(os, "geteuid") and os.geteuid() == 0,
+        "home": os.path.expanduser("~"),
+        "cwd": os.getcwd(),
+        "package_manager": next((pm for pm in PACKAGE_MANAGERS if shutil.which(pm)), None),
+        "tools": [tool for tool in CLI_TOOLS if shutil.which(tool)],
+        "collected_at": round(time.time()),
+    }
+
+
+def render_block(info):
+    """Bloque compacto para el mensaje de sistema. Solo lleva datos estables (nada de memoria o disco
+    libres), así el mensaje de sistema no cambia entre recogidas y el prefijo del prompt se reutiliza."""
+    system = f"{info['platform']} {info['platform_release']} {info['architecture']}"
+    if info.get("distro"):
+        system += f" ({info['distro']})"
+    lines = [
+        f"SO: {system}; host {info['hostname']}; usuario {info['user']}{' (uid 0)' if info.get('is_root') and info['user'] != 'root' else ''}",
+        f"Shell de los comandos: {info['shell']}; gestor de paquetes: {info.get('package_manager') or 'ninguno detectado'}",
+        f"CPU: {info['cpu_count']} núcleos; RAM: {info['memory_total_gb']} GB; disco {info['disk_root']}: {info['disk_total_gb']} GB",
+        f"Python {info['python_version']}; directorio de trabajo: {info['cwd']}",
+        "Herramientas disponibles: " + (", ".join(info["tools"]) or "ninguna de las habituales"),
+    ]
+    return ENV_MARKER + "\n".join(lines)
+
+
+class EnvironmentSnapshot:
+    """Instantánea del entorno compartida por todas las sesiones.
+
+    Se recoge una vez en segundo plano al arrancar (`start`) y un hilo (`schedule`) la vuelve a recoger
+    cada `refresh` segundos. Sin ese hilo (CLI) se recoge de nuevo al pedirla si tiene más de `refresh`
+    segundos; en ambos casos sin bloquear: mientras tanto se sirve la anterior. También bajo demanda.
+    """
+
+    def __init__(self, refresh=ENV_REFRESH):
+        self.refresh_seconds = refresh
+        self._info = None
+        self._collected = 0.0
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._stop = threading.Event()
+        self._thread = None
+        self.collections = 0
+
+    def start(self):
+        """Lanza la recogida en segundo plano (no hace nada si ya está hecha o en curso)."""
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._collect, name="env-snapshot", daemon=True).start()
+
+    def schedule(self):
+        """Lanza el hilo que refresca la instantánea cada `refresh_seconds` (no hace nada si ya corre o
+        si el refresco está desactivado con un valor <= 0)."""
+        if self._thread is not None or self.refresh_seconds <= 0:
+            return
+        self._thread = threading.Thread(target=self._refresh_loop, name="env-refresh", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _refresh_loop(self):
+        while not self._stop.wait(self.refresh_seconds):
+            self.start()
+
+    def _collect(self):
+        try:
+            info = collect()
+        except Exception as e:
+            print(f"⚠️  No se pudo recoger el entorno del sistema: {e}")
+            info = None
+        with self._lock:
+            if info is not None:
+                self._info = info
+                self._collected = time.monotonic()
+                self.collections += 1
+            self._refreshing = False
+        self._ready.set()
+
+    def get(self, refresh=False, timeout=WAIT_TIMEOUT):
+        """Devuelve la instantánea (dict) o None si la primera recogida no termina a tiempo.
+        `refresh=True` la recoge de nuevo en el momento."""
+        if refresh:
+            self._collect()
+        elif self._info is None:
+            self.start()
+            self._ready.wait(timeout)
+        elif time.monotonic() - self._collected > self.refresh_seconds:
+            self.start()
+        return self._info
+
+    def block(self):
+        """Bloque del entorno para el mensaje de sistema ("" si está desactivado o no disponible)."""
+        if not ENV_SNAPSHOT:
+            return ""
+        info = self.get()
+        return render_block(info) if info else ""
+
+    def stats(self):
+        return {
+            "ready": self._info is not None,
+            "age": round(time.monotonic() - self._collected, 1) if self._info else None,
+            "collections": self.collections,
+        }
+
+
+# Instantánea compartida por todo el proceso
+environment = EnvironmentSnapshot()
@@ -0,0 +1,261 @@
+import atexit
+import os
+import re
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from output_store import private_directory
+from resource_limits import command_limits, usage_from_rusage, wait_with_usage
+
+
+_USER = os.getuid() if hasattr(os, "getuid") else os.environ.get("USERNAME", "user")
+# Directorio de los logs de los trabajos (privado, 0700 por usuario), tiempo máximo de cada uno y límites
+JOB_DIR = os.environ.get("AGENT_JOB_DIR") or os.path.join(tempfile.gettempdir(), f"agent-jobs-{_USER}")
+JOB_TIMEOUT = int(os.environ.get("AGENT_JOB_TIMEOUT", "3600"))
+MAX_RUNNING_JOBS = int(os.environ.get("AGENT_MAX_RUNNING_JOBS", "8"))
+# Trabajos recordados (los terminados más antiguos se olvidan y se borra su log)
+MAX_JOBS = int(os.environ.get("AGENT_MAX_JOBS", "50"))
+# Bytes máximos devueltos en cada lectura de la salida
+READ_LIMIT = 16384
+# Segundos entre SIGTERM y SIGKILL al cancelar
+KILL_GRACE = 3
+
+# Comandos que suelen tardar minutos: se lanzan en segundo plano aunque no se pida. Cada patrón se
+# compara con cada segmento del comando (separado por |, &&, || o ;), sin `sudo` delante. Las consultas
+# rápidas (`--version`, `--help` en cualquier comando; `make -n`, `rsync -n`...) no cuentan, y las
+# descargas y copias necesitan al menos un argumento que no sea una opción.
+LONG_RUNNING_COMMANDS = [
+    r"(apt|apt-get|aptitude|dnf|yum|zypper|pacman|brew|snap)\s+(-\S+\s+)*(install|upgrade|dist-upgrade|full-upgrade|update|-S\w*|-Syu)\b",
+    r"(pip3?|python3?\s+-m\s+pip|uv\s+pip|conda|mamba|poetry)\s+(install|update|upgrade)\b",
+    r"(npm|pnpm|yarn)\s+(install|ci|add|build|run\s+build)\b",
+    r"(cargo|go)\s+(build|install)\b",
+    r"make\b(?!.*\s(-[vhnqp]|--dry-run|--just-print|--recon|--question|--print-data-base)(?=\s|$))",
+    r"ninja\b(?!.*\s(-n|-t\s*\S+)(?=\s|$))",
+    r"(mvn|gradle|\./gradlew|\./configure)\b(?!.*\s-[vVh](?=\s|$))",
+    r"cmake\s+--build\b",
+    r"docker\s+(build|pull|compose\s+(up|build|pull))\b",
+    r"git\s+clone\b",
+    r"rsync\b(?!.*\s(-\w*n\w*|--dry-run)(?=\s|$))(\s+-\S+)*\s+[^-\s]",
+    r"(scp|wget)(\s+-\S+)*\s+[^-\s]",
+    r"dd\s+.*\bif=",
+]
+_QUERY = r"(?!.*\s(--version|--help)(\s|$))"
+_LONG_RUNNING = [re.compile(rf"^{_QUERY}{pattern}") for pattern in LONG_RUNNING_COMMANDS]
+_SEGMENT_SPLIT = re.compile(r"\s*(?:\|\||&&|;|\|)\s*")
+_SUDO = re.compile(r"^sudo\s+(-\S+\s+)*")
+_SLEEP = re.compile(r"^sleep\s+(\d+)")
+
+
+def is_long_running(command):
+    """True si algún segmento del comando es de los que suelen tardar (instalaciones, compilaciones,
+    descargas, copias grandes) o es un `sleep` de 30 s o más."""
+    for segment in _SEGMENT_SPLIT.split(" ".join((command or "").split())):
+        segment = _SUDO.sub("", segment)
+        sleep = _SLEEP.match(segment)
+        if (sleep and int(sleep.group(1)) >= 30) or any(rule.match(segment) for rule in _LONG_RUNNING):
+            return True
+    return False
+
+
+class JobError(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, job_id, command, owner, log_path):
+        self.id = job_id
+        self.command = command
+        self.owner = owner
+        self.log_path = log_path
+        self.status = "running"
+        self.returncode = None
+        self.started = time.time()
+        self.finished = None
+        self.process = None
+        # Tiempo de CPU y pico de memoria (de wait4, al terminar)
+        self.cpu = None
+        self.max_rss_kb = None
+        self.done = threading.Event()
+
+    @property
+    def running(self):
+        return self.status == "running"
+
+    def size(self):
+        try:
+            return os.path.getsize(self.log_path)
+        except OSError:
+            return 0
+
+    def summary(self):
+        end = self.finished or time.time()
+        return {
+            "job_id": self.id,
+            "command": self.command,
+            "owner": self.owner,
+            "status": self.status,
+            "returncode": self.returncode,
+            "started": self.started,
+            "finished": self.finished,
+            "elapsed": round(end - self.started, 1),
+            "output_bytes": self.size(),
+            "cpu_seconds": round(self.cpu, 2) if self.cpu is not None else None,
+            "max_rss_mb": round(self.max_rss_kb / 1024, 1) if self.max_rss_kb else None,
+        }
+
+
+class JobManager:
+    """Comandos largos ejecutados en segundo plano, desacoplados del turno que los lanzó.
+
+    Cada trabajo corre en su propio grupo de procesos (`bash -lc`) con stdout y stderr volcados a un
+    log en disco; un hilo espera a que termine (o lo mata al superar JOB_TIMEOUT). La salida se lee
+    de forma incremental por offset de bytes, así el modelo o la interfaz solo reciben lo nuevo.
+    """
+
+    def __init__(self, directory=JOB_DIR, timeout=JOB_TIMEOUT, max_running=MAX_RUNNING_JOBS, max_jobs=MAX_JOBS):
+        self.directory = directory
+        self.timeout = timeout
+        self.max_running = max_running
+        self.max_jobs = max_jobs
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def start(self, command, owner=None):
+        """Lanza `command` en segundo plano y devuelve su Job sin esperar a que termine."""
+        with self._lock:
+            running = sum(1 for job in self._jobs.values() if job.running)
+            if running >= self.max_running:
+                raise JobError(f"ya hay {running} trabajos en ejecución (máximo {self.max_running})")
+            private_directory(self.directory)
+            job_id = uuid.uuid4().hex[:8]
+            job = Job(job_id, command, owner, os.path.join(self.directory, f"{job_id}.log"))
+            fd = os.open(job.log_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0), 0o600)
+            with os.fdopen(fd, "wb") as log:
+                if sys.platform == "win32":
+                    job.process = subprocess.Popen(
+                        command, shell=True, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+                        creationflags=subprocess.CREATE_NEW_PROCESS_GROUP,
+                    )
+                else:
+                    # Grupo de procesos propio para poder matar también a los hijos, con los límites de
+                    # recursos de los comandos (ver resource_limits.py)
+                    job.process = subprocess.Popen(
+                        command_limits.argv(["bash", "-lc", command]), stdin=subprocess.DEVNULL, stdout=log,
+                        stderr=subprocess.STDOUT, **command_limits.popen_kwargs(),
+                    )
+                    command_limits.attach(job.process)
+            self._jobs[job_id] = job
+            self._forget_old()
+        threading.Thread(target=self._watch, args=(job,), name=f"job-{job_id}", daemon=True).start()
+        print(f"🕒 Trabajo {job_id} lanzado en segundo plano: {command}")
+        return job
+
+    def _watch(self, job):
+        # Solo este hilo espera al proceso (wait4 da sus recursos); el resto mira `returncode` y `done`
+        rusage = None
+        try:
+            returncode, rusage = wait_with_usage(job.process, self.timeout, on_timeout=lambda: self._kill(job))
+            status = "done" if returncode == 0 else "failed"
+        except subprocess.TimeoutExpired:
+            returncode = job.process.returncode
+            status = "timeout"
+        job.cpu, job.max_rss_kb = usage_from_rusage(rusage)
+        with self._lock:
+            job.returncode = returncode
+            if job.status == "running":
+                job.status = status
+            job.finished = time.time()
+        job.done.set()
+        command_limits.account(job.finished - job.started, job.size(), returncode, cpu=job.cpu,
+                               max_rss_kb=job.max_rss_kb, timed_out=status == "timeout", kind="job")
+        print(f"🏁 Trabajo {job.id} terminado [{job.status}] ({job.finished - job.started:.1f}s)")
+
+    def _kill(self, job, sig=None):
+        if job.process.returncode is not None:
+            return
+        try:
+            if sys.platform == "win32":
+                job.process.kill()
+            else:
+                os.killpg(job.process.pid, sig or signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    def _forget_old(self):
+        # Con el lock tomado: olvidar los terminados más antiguos por encima de max_jobs
+        excess = len(self._jobs) - self.max_jobs
+        for job_id in [j.id for j in self._jobs.values() if not j.running][:max(0, excess)]:
+            job = self._jobs.pop(job_id)
+            try:
+                os.remove(job.log_path)
+            except OSError:
+                pass
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            raise JobError(f"no existe el trabajo '{job_id}'")
+        return job
+
+    def list(self, owner=None):
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return [job.summary() for job in jobs if owner is None or job.owner == owner]
+
+    def read(self, job_id, offset=None, limit=READ_LIMIT, tail_lines=None):
+        """Salida del trabajo desde el byte `offset` (como mucho `limit` bytes).
+        Sin offset se devuelven las últimas `tail_lines` líneas. Devuelve (texto, siguiente offset)."""
+        job = self.get(job_id)
+        size = job.size()
+        limit = max(1, min(int(limit or READ_LIMIT), READ_LIMIT))
+        if offset is None:
+            start = max(0, size - limit)
+        else:
+            start = min(max(0, int(offset)), size)
+        try:
+            with open(job.log_path, "rb") as f:
+                f.seek(start)
+                data = f.read(limit if offset is not None else size - start)
+        except OSError:
+            data = b""
+        text = data.decode("utf-8", errors="replace")
+        if offset is None and tail_lines:
+            text = "\n".join(text.splitlines()[-int(tail_lines):])
+        return text, start + len(data)
+
+    def cancel(self, job_id):
+        """Termina el trabajo (SIGTERM y, si no basta, SIGKILL al grupo de procesos)."""
+        job = self.get(job_id)
+        with self._lock:
+            if not job.running:
+                return job
+            job.status = "cancelled"
+        self._kill(job, signal.SIGTERM if sys.platform != "win32" else None)
+        if not job.done.wait(KILL_GRACE):
+            self._kill(job)
+        return job
+
+    def stats(self):
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return {"jobs": len(jobs), "running": sum(1 for j in jobs if j.running), "max_running": self.max_running}
+
+    def close(self):
+        """Mata los trabajos que sigan en marcha (al salir del proceso)."""
+        with self._lock:
+            jobs = [j for j in self._jobs.values() if j.running]
+        for job in jobs:
+            job.status = "cancelled"
+            self._kill(job)
+
+
+# Trabajos compartidos por todas las sesiones del proceso
+job_manager = JobManager()
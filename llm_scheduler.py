@@ -0,0 +1,156 @@
+import asyncio
+import itertools
+import os
+import time
+from contextlib import asynccontextmanager
+
+from metrics import metrics
+
+
+# Peticiones simultáneas al backend y turnos que pueden esperar turno antes de responder 429
+LLM_CONCURRENCY = int(os.environ.get("AGENT_LLM_CONCURRENCY", "2"))
+LLM_MAX_QUEUE = int(os.environ.get("AGENT_LLM_MAX_QUEUE", "16"))
+# Sesiones recordadas para el reparto justo (las que llevan más tiempo sin usarse se olvidan)
+MAX_TRACKED_SESSIONS = 4096
+
+
+class SchedulerBusy(Exception):
+    """No se admiten más turnos: la cola del backend está llena (el servidor responde 429)."""
+
+    def __init__(self, message, retry_after=5):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class LLMScheduler:
+    """Control de admisión y reparto justo de las llamadas al modelo entre sesiones.
+
+    - Como mucho `concurrency` llamadas al backend a la vez (el resto espera en cola).
+    - `admit()` limita los turnos en curso a `concurrency + max_queue`; por encima, SchedulerBusy.
+      Un turno admitido no se rechaza a mitad: sus llamadas siguientes (tras las herramientas) esperan.
+    - Reparto por turnos de sesión (round-robin) en vez de FIFO: al liberarse un hueco se atiende
+      la sesión en espera que hace más tiempo que no usa el backend, así una sesión que encadena
+      herramientas no deja sin servicio a las demás.
+    Todo corre en el event loop del servidor (no es seguro entre hilos).
+    """
+
+    def __init__(self, concurrency=LLM_CONCURRENCY, max_queue=LLM_MAX_QUEUE):
+        self.concurrency = max(1, concurrency)
+        self.max_queue = max(0, max_queue)
+        self.active = 0
+        self.turns = 0
+        self._waiters = []          # [[orden, sesión, future, on_position, última posición notificada]]
+        self._last_served = {}      # sesión -> número de la última llamada atendida
+        self._served = itertools.count(1)
+        self._order = itertools.count()
+        self.admitted = 0
+        self.rejected = 0
+
+    @property
+    def waiting(self):
+        return len(self._waiters)
+
+    @property
+    def full(self):
+        return self.turns >= self.concurrency + self.max_queue
+
+    def check(self):
+        """Lanza SchedulerBusy si no se admiten más turnos."""
+        if self.full:
+            self.rejected += 1
+            metrics.inc("agent_llm_rejected_total")
+            raise SchedulerBusy(f"Servidor ocupado: {self.turns} turnos en curso y {self.waiting} llamadas en cola")
+
+    @asynccontextmanager
+    async def admit(self):
+        """Admite un turno completo o lanza SchedulerBusy si ya hay demasiados en curso."""
+        self.check()
+        self.turns += 1
+        self.admitted += 1
+        try:
+            yield
+        finally:
+            self.turns -= 1
+
+    @asynccontextmanager
+    async def slot(self, session_id, on_position=None):
+        """Reserva un hueco del backend para una llamada. `on_position(posición, en_cola)` se invoca
+        mientras se espera cada vez que cambia la posición en la cola (1 = la siguiente)."""
+        started = time.perf_counter()
+        if self.active < self.concurrency and not self._waiters:
+            self.active += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            waiter = [next(self._order), session_id, future, on_position, None]
+            self._waiters.append(waiter)
+            self._notify_positions()
+            try:
+                await future
+            except asyncio.CancelledError:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    self._notify_positions()
+                elif future.done() and not future.cancelled():
+                    # El hueco se concedió justo al cancelar: devolverlo
+                    self._release()
+                raise
+        self._mark_served(session_id)
+        metrics.observe("agent_span_seconds", time.perf_counter() - started, span="llm_queue")
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _mark_served(self, session_id):
+        self._last_served[session_id] = next(self._served)
+        if len(self._last_served) > MAX_TRACKED_SESSIONS:
+            oldest = sorted(self._last_served, key=self._last_served.get)[:len(self._last_served) // 2]
+            for key in oldest:
+                del self._last_served[key]
+
+    def _priority(self, waiter):
+        # Primero la sesión que hace más tiempo que no se atiende; a igualdad, la que llegó antes
+        order, session_id = waiter[0], waiter[1]
+        return self._last_served.get(session_id, 0), order
+
+    def _release(self):
+        self.active -= 1
+        while self._waiters and self.active < self.concurrency:
+            waiter = min(self._waiters, key=self._priority)
+            self._waiters.remove(waiter)
+            future = waiter[2]
+            if future.done():
+                continue
+            self.active += 1
+            future.set_result(None)
+        self._notify_positions()
+
+    def _notify_positions(self):
+        ordered = sorted(self._waiters, key=self._priority)
+        for position, waiter in enumerate(ordered, 1):
+            _, _, future, on_position, notified = waiter
+            if on_position is None or future.done() or notified == position:
+                continue
+            waiter[4] = position
+            try:
+                on_position(position, len(ordered))
+            except Exception as e:
+                print(f"⚠️  Error notificando la posición en cola: {e}")
+
+    def position(self, session_id):
+        """Posición en la cola de la sesión (1 = la siguiente) o None si no está esperando."""
+        for position, waiter in enumerate(sorted(self._waiters, key=self._priority), 1):
+            if waiter[1] == session_id:
+                return position
+        return None
+
+    def stats(self):
+        return {
+            "concurrency": self.concurrency,
+            "max_queue": self.max_queue,
+            "active": self.active,
+            "waiting": self.waiting,
+            "turns": self.turns,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+        }
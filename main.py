@@ -1,31 +1,84 @@
-from openai import OpenAI
-from dotenv import load_dotenv
-from agent import Agent
 import sys
 import os
-import json
+
+import cli_client
+
+# Conectado a un server.py en marcha (o gestionando el daemon) no se importa nada pesado: ver cli_client.py
+exit_code = cli_client.main(sys.argv[1:])
+if exit_code is not None:
+    sys.exit(exit_code)
+
+from dotenv import load_dotenv
+
+# .env antes de importar los módulos que leen su configuración del entorno al cargarse
+load_dotenv()
+from agent import Agent
+from backend_pool import backends
+from metrics import metrics
+from model_catalog import BackendUnavailable
 
 # Habilitar colores ANSI en Windows
 os.system('') if sys.platform == 'win32' else None
 
-load_dotenv()
 MODEL="openai/gpt-oss-20b"  # Modelo por defecto
+# Mostrar la respuesta token a token (AGENT_STREAM=0 para desactivar)
+STREAM = os.environ.get("AGENT_STREAM", "1").strip().lower() not in ("0", "false", "no")
+# Pedir el uso de tokens también en streaming (AGENT_STREAM_USAGE=0 si el backend no lo admite)
+STREAM_USAGE = os.environ.get("AGENT_STREAM_USAGE", "1").strip().lower() not in ("0", "false", "no")
 
 print(f"Mi primer agente de IA ({MODEL})")
 
 agent = Agent()
+agent.shell_pool.warm(1)
+# Backends compatibles con OpenAI (LM Studio por defecto) con su catálogo de modelos cacheado
+# (contexto y max_tokens por modelo) y reintento en otro backend si uno falla (ver backend_pool.py)
+
+
+def set_model(model):
+    """Fija el modelo en el agente con los metadatos del catálogo. Devuelve su max_tokens."""
+    info = backends.info(model)
+    agent.set_model(model, context_tokens=info.get("context_length"), max_tokens=info["max_tokens"])
+    return info["max_tokens"]
+
 
-# --- CONFIGURACIÓN DEL CLIENTE (SIN CAMBIOS) ---
-# Apunta al servidor local de LM Studio (por defecto: puerto 1234)
-client = OpenAI(
-    base_url="http://localhost:1234/v1",
-    api_key="lm-studio"  # Clave de API de marcador de posición
-)
+MAX_TOKENS = set_model(MODEL)
 
 # Códigos ANSI para colores
 GREEN = "\033[92m"
 RESET = "\033[0m"
 
+
+# Estado de la línea de texto que se está imprimiendo en modo streaming
+stream_state = {"started": False}
+
+
+def print_stream_event(event):
+    """Imprime los eventos del modo streaming a medida que llegan."""
+    if event["type"] == "token":
+        if not stream_state["started"]:
+            print("\n🤖 Asistente: ", end="", flush=True)
+            stream_state["started"] = True
+        print(event["content"], end="", flush=True)
+    elif event["type"] in ("tool_start", "assistant"):
+        # Cerrar la línea de texto en curso antes de la siguiente salida
+        if stream_state["started"]:
+            print()
+            stream_state["started"] = False
+
+
+def print_metrics():
+    """Resumen de los spans medidos en esta sesión (AGENT_TRACE_FILE guarda además la traza completa)."""
+    snapshot = metrics.snapshot()
+    if not snapshot["spans"]:
+        print("Todavía no hay métricas.")
+        return
+    for name, data in sorted(snapshot["spans"].items()):
+        print(f"    {name}: {data['count']} × {data['mean_ms']} ms (total {data['total_s']} s)")
+    if snapshot["tokens"]:
+        print("    tokens: " + ", ".join(f"{k}={v}" for k, v in sorted(snapshot["tokens"].items())))
+    if snapshot["tokens_saved"]:
+        print("    tokens ahorrados en salidas de herramientas: " + ", ".join(f"{k}={v}" for k, v in sorted(snapshot["tokens_saved"].items())))
+
 while True:
     user_input = input(f"\n👦 {GREEN}Tú: {RESET}").strip()
     
@@ -41,24 +94,11 @@ while True:
             print("Confirmación recibida: ejecutando comando pendiente...")
             # Ejecutar inmediatamente y añadir el resultado como un mensaje 'tool'
             result = agent.handle_tool_call("execute_terminal_command", {"command": cmd, "_confirmed": True})
-            try:
-                params_json = json.dumps({"command": cmd}, ensure_ascii=False, indent=2)
-            except Exception:
-                params_json = str({"command": cmd})
-            combined = f"== execute_terminal_command ==\nParámetros: {params_json}\n{result}"
-            agent.messages.append({
-                "role": "tool",
-                "content": combined,
-                "display_as": "code",
-                "tool_calls": [{
-                    "type": "function",
-                    "function": {"name": "execute_terminal_command", "arguments": json.dumps({"command": cmd}, ensure_ascii=False)}
-                }]
-            })
+            agent.add_tool_result("execute_terminal_command", {"command": cmd}, result)
             agent.pending_confirmation = None
             # Ahora dejamos que el flujo normal continúe para que el modelo reciba la salida y responda
         elif ans in ("no", "n"):
-            agent.messages.append({"role": "assistant", "content": "Operación cancelada por el usuario."})
+            agent.add_message({"role": "assistant", "content": "Operación cancelada por el usuario."})
             agent.pending_confirmation = None
             # pedimos otro prompt
             continue
@@ -72,50 +112,63 @@ while True:
         print("Hasta luego!")
         break
 
+    if user_input.strip() == "/metrics":
+        print_metrics()
+        continue
+
     if user_input.strip() == "/models":
-        # Intentar con el cliente OpenAI primero
+        # Lista cacheada del catálogo (se refresca sola en segundo plano)
         try:
-            models = client.models.list()
+            models, _ = backends.list()
             i=0
-            for m in models.data:
-                activo=" (activo)" if m.id == MODEL else ""
-                print(f"    {i} - {m.id}{GREEN}{activo}{RESET}")
+            for m in models:
+                activo=" (activo)" if m == MODEL else ""
+                print(f"    {i} - {m}{GREEN}{activo}{RESET}")
                 i+=1
             new_model = input(f"\n{GREEN}Si quiere cambiar de Modelo introduzca (0..{i-1}): {RESET}").strip()
             if new_model.isdigit() and 0 <= int(new_model) < i:
-                MODEL = models.data[int(new_model)].id
+                MODEL = models[int(new_model)]
                 print(f"Modelo cambiado a: {MODEL}")
-                agent.messages = [agent.messages[0]]  # Mantener solo system message
+                agent.reset_history()  # Mantener solo system message
+                MAX_TOKENS = set_model(MODEL)
                 print("✅ Historial limpiado. Nueva conversación con el modelo " + MODEL)
             else:
                 print("Entrada no válida, no se cambió el modelo.")
             continue
 
-        except Exception as e:
+        except BackendUnavailable as e:
             print("No se pudieron listar los modelos:", e)
         continue
 
     # Agregar nuestro mensaje al historial como entrada de usuario
-    agent.messages.append({"role": "user", "content": user_input})
+    agent.add_message({"role": "user", "content": user_input})
     
     # Bucle que permite que, si el modelo invoca herramientas, procesarlas y luego repetir
-    while True:
-        response = client.chat.completions.create(
-            model=MODEL,
-            messages=agent.messages,
-            tools=agent.tools,
-            temperature=0.7,
-            max_tokens=4096, 
-            stream=False
-        )
-        
-        called_tool = agent.process_response(response)
-
-        # Si se generó una confirmación pendiente, salimos del bucle interior para esperar la confirmación del usuario
-        if agent.pending_confirmation is not None:
-            # El mensaje con la petición de confirmación ya fue agregado por process_response/handle_tool_call
-            break
-        
-        # Si no se llamó herramienta, tenemos la respuesta final
-        if not called_tool:
-            break
+    metrics.new_trace()
+    with metrics.span("turn", endpoint="cli"):
+        while True:
+            extra = {"stream_options": {"include_usage": True}} if STREAM and STREAM_USAGE else {}
+            with metrics.span("llm", model=MODEL, stream=STREAM):
+                response = backends.create_sync(
+                    model=MODEL,
+                    messages=agent.messages,
+                    tools=agent.tools,
+                    temperature=0.7,
+                    max_tokens=MAX_TOKENS,
+                    stream=STREAM,
+                    **extra
+                )
+
+            if STREAM:
+                called_tool = agent.process_stream(response, on_event=print_stream_event)
+            else:
+                called_tool = agent.process_response(response)
+
+            # Si se generó una confirmación pendiente, salimos del bucle interior para esperar la confirmación del usuario
+            if agent.pending_confirmation is not None:
+                # El mensaje con la petición de confirmación ya fue agregado por process_response/handle_tool_call
+                break
+
+            # Si no se llamó herramienta, tenemos la respuesta final
+            if not called_tool:
+                break
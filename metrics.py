@@ -0,0 +1,191 @@
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+
+# Límites (segundos) de los histogramas: de milisegundos (agente) a minutos (modelo y comandos)
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+HELP = {
+    "agent_span_seconds": "Duración de cada fase del turno (llm, llm_stream, tool, history_trim, serialize, turn)",
+    "agent_turns_total": "Turnos de conversación completados",
+    "agent_tool_calls_total": "Llamadas a herramientas por herramienta y resultado",
+    "agent_llm_tokens_total": "Tokens informados por el backend en `usage` (prompt/completion)",
+    "agent_llm_requests_total": "Peticiones al modelo",
+    "agent_errors_total": "Errores por origen",
+    "agent_command_seconds": "Tiempo real (clock=wall) y de CPU (clock=cpu) de los comandos ejecutados y trabajos",
+    "agent_command_output_bytes_total": "Bytes de salida (stdout+stderr) de los comandos ejecutados y trabajos",
+    "agent_command_limits_total": "Comandos terminados por un límite de recursos (cpu, memory) o por timeout",
+    "agent_tool_tokens_saved_total": "Tokens ahorrados en los mensajes tool (encoding: parámetros compactos; exact/near: salidas deduplicadas)",
+}
+
+# Identificador del turno en curso (se propaga a las tareas asyncio y, copiando el contexto, a los hilos)
+_trace_id = contextvars.ContextVar("agent_trace_id", default=None)
+
+
+def _label_key(labels):
+    # Los booleanos en minúsculas ("true"/"false"), como es habitual en las etiquetas de Prometheus
+    return tuple(sorted((k, str(v).lower() if isinstance(v, bool) else str(v))
+                        for k, v in labels.items() if v is not None))
+
+
+def _format_labels(key, extra=None):
+    items = list(key) + (list(extra) if extra else [])
+    if not items:
+        return ""
+    escape = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")  # noqa: E731
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in items) + "}"
+
+
+class Metrics:
+    """Registro de métricas en memoria con salida en formato de texto de Prometheus.
+
+    - Contadores (`inc`) e histogramas (`observe`) con etiquetas de baja cardinalidad.
+    - Colectores (`collect`): funciones `stats()` de otros componentes (caché, pool de shells,
+      sesiones...) cuyos valores numéricos se publican como gauges al generar la salida.
+    - Trazas opcionales en JSON lines (AGENT_TRACE_FILE): una línea por span con el id del turno.
+    """
+
+    def __init__(self, trace_file=None):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._collectors = []
+        self.trace_file = trace_file if trace_file is not None else os.environ.get("AGENT_TRACE_FILE")
+        self._trace = None
+        self._trace_lock = threading.Lock()
+
+    # --- Registro ---------------------------------------------------------------------------
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = [[0] * len(BUCKETS), 0.0, 0]
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    hist[0][i] += 1
+                    break
+            hist[1] += value
+            hist[2] += 1
+
+    def collect(self, prefix, stats_fn):
+        """Publica los valores numéricos de `stats_fn()` como gauges `<prefix>_<clave>`."""
+        self._collectors.append((prefix, stats_fn))
+
+    # --- Spans y trazas ---------------------------------------------------------------------
+
+    def new_trace(self):
+        """Empieza un turno nuevo: los spans siguientes (en esta tarea o hilo) comparten su id."""
+        trace_id = uuid.uuid4().hex[:16]
+        _trace_id.set(trace_id)
+        return trace_id
+
+    @contextmanager
+    def span(self, name, **labels):
+        """Mide un bloque: lo añade al histograma `agent_span_seconds` y, si hay fichero, a la traza.
+        Se puede usar tanto en código síncrono como dentro de corrutinas."""
+        start = time.perf_counter()
+        status = "ok"
+        try:
+            yield labels
+        except BaseException:
+            status = "error"
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            self.observe("agent_span_seconds", elapsed, span=name, **labels)
+            if self.trace_file:
+                self.trace(name, duration_ms=round(elapsed * 1000, 3), status=status, **labels)
+
+    def trace(self, name, **attrs):
+        """Escribe un evento en la traza JSON lines (no hace nada si no está activada)."""
+        if not self.trace_file:
+            return
+        record = {"ts": round(time.time(), 6), "trace": _trace_id.get(), "span": name, **attrs}
+        line = json.dumps(record, ensure_ascii=False, default=str) + "\n"
+        with self._trace_lock:
+            if self._trace is None:
+                self._trace = open(self.trace_file, "a", encoding="utf-8", buffering=1)
+            self._trace.write(line)
+
+    # --- Salida -----------------------------------------------------------------------------
+
+    def render(self):
+        """Texto en formato de exposición de Prometheus (versión 0.0.4)."""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {k: ([*v[0]], v[1], v[2]) for k, v in self._histograms.items()}
+
+        lines = []
+        seen = set()
+
+        def header(name, kind, help_text=None):
+            if name not in seen:
+                seen.add(name)
+                lines.append(f"# HELP {name} {help_text or HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, key), value in sorted(counters.items()):
+            header(name, "counter")
+            lines.append(f"{name}{_format_labels(key)} {value}")
+
+        for (name, key), (buckets, total, count) in sorted(histograms.items()):
+            header(name, "histogram")
+            cumulative = 0
+            for bound, n in zip(BUCKETS, buckets):
+                cumulative += n
+                lines.append(f"{name}_bucket{_format_labels(key, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_bucket{_format_labels(key, [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{_format_labels(key)} {round(total, 6)}")
+            lines.append(f"{name}_count{_format_labels(key)} {count}")
+
+        for prefix, stats_fn in self._collectors:
+            try:
+                stats = stats_fn() or {}
+            except Exception as e:
+                print(f"⚠️  Error recogiendo métricas de {prefix}: {e}")
+                continue
+            for key, value in stats.items():
+                if isinstance(value, bool):
+                    value = int(value)
+                if not isinstance(value, (int, float)):
+                    continue
+                name = f"{prefix}_{key}"
+                header(name, "gauge", f"Campo '{key}' de las estadísticas de {prefix}")
+                lines.append(f"{name} {value}")
+
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """Resumen legible de los spans: número, media y total por fase (para la CLI)."""
+        with self._lock:
+            items = [(k, v[1], v[2]) for k, v in self._histograms.items() if k[0] == "agent_span_seconds"]
+            counters = dict(self._counters)
+        spans = {}
+        for (_, key), total, count in items:
+            labels = dict(key)
+            name = labels.pop("span")
+            label = name + ("" if not labels else " " + ",".join(f"{k}={v}" for k, v in labels.items()))
+            spans[label] = {"count": count, "mean_ms": round(total / count * 1000, 2), "total_s": round(total, 3)}
+        tokens, saved = {}, {}
+        for (name, key), value in counters.items():
+            target = tokens if name == "agent_llm_tokens_total" else saved if name == "agent_tool_tokens_saved_total" else None
+            if target is not None:
+                kind = dict(key).get("kind", "?")
+                target[kind] = target.get(kind, 0) + value
+        return {"spans": spans, "tokens": tokens, "tokens_saved": saved}
+
+
+# Registro compartido por todo el proceso
+metrics = Metrics()
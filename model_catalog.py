@@ -0,0 +1,186 @@
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from context import model_context_length
+
+
+# Segundos durante los que la lista de modelos se considera fresca; después se sirve la copia
+# antigua mientras se refresca en segundo plano (stale-while-revalidate)
+MODELS_TTL = float(os.environ.get("AGENT_MODELS_TTL", "30"))
+# Tras un fallo del backend no se vuelve a intentar hasta pasado este tiempo (cortocircuito)
+BACKEND_RETRY = float(os.environ.get("AGENT_BACKEND_RETRY", "10"))
+REQUEST_TIMEOUT = float(os.environ.get("AGENT_BACKEND_TIMEOUT", "5"))
+# max_tokens de la respuesta: como mucho esto y nunca más de 1/4 del contexto del modelo
+DEFAULT_MAX_TOKENS = 4000
+
+
+class BackendUnavailable(Exception):
+    """El backend de modelos no responde y no hay una lista cacheada que servir."""
+
+
+class ModelCatalog:
+    """Catálogo de modelos del backend (LM Studio) con caché y sesión HTTP compartida.
+
+    - La lista se cachea `ttl` segundos; pasado ese tiempo se devuelve la copia antigua y se
+      refresca en un hilo (una sola petición a la vez).
+    - Si el backend falla, durante `retry` segundos no se le vuelve a llamar: se sirve la copia
+      antigua o se falla al instante en vez de esperar el timeout en cada petición.
+    - Guarda metadatos por modelo (longitud de contexto, soporte de herramientas) cuando el backend
+      los expone en la API nativa de LM Studio (`/api/v0/models`).
+    """
+
+    def __init__(self, base_url, ttl=MODELS_TTL, retry=BACKEND_RETRY, timeout=REQUEST_TIMEOUT):
+        self.base_url = base_url.rstrip("/")
+        self.ttl = ttl
+        self.retry = retry
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+        self.session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+        self._models = None
+        self._metadata = {}
+        self._fetched_at = 0.0
+        self._down_until = 0.0
+        self._last_error = None
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    # --- Acceso al backend ----------------------------------------------------------------
+
+    def _fetch(self):
+        resp = self.session.get(f"{self.base_url}/models", timeout=self.timeout)
+        resp.raise_for_status()
+        data = resp.json()
+        models = []
+        for item in data.get("data", []) or data.get("models", []):
+            if isinstance(item, dict):
+                models.append(item.get("id") or item.get("name"))
+            else:
+                models.append(str(item))
+        return models, self._fetch_metadata()
+
+    def _fetch_metadata(self):
+        # API nativa de LM Studio: max_context_length, loaded_context_length, capabilities...
+        # Otros backends compatibles con OpenAI no la tienen: se ignora cualquier fallo.
+        root = self.base_url[:-3] if self.base_url.endswith("/v1") else self.base_url
+        try:
+            resp = self.session.get(f"{root}/api/v0/models", timeout=self.timeout)
+            resp.raise_for_status()
+            items = resp.json().get("data", [])
+        except (requests.RequestException, ValueError):
+            return {}
+        metadata = {}
+        for item in items:
+            if not isinstance(item, dict) or not item.get("id"):
+                continue
+            capabilities = item.get("capabilities")
+            metadata[item["id"]] = {
+                "context_length": item.get("loaded_context_length") or item.get("max_context_length"),
+                "tools": ("tool_use" in capabilities) if isinstance(capabilities, list) else None,
+                "type": item.get("type"),
+                "state": item.get("state"),
+            }
+        return metadata
+
+    def refresh(self, quiet=False):
+        """Consulta el backend y actualiza la caché. Lanza BackendUnavailable si falla
+        (`quiet=True` no imprime el aviso: lo usan las sondas periódicas de backend_pool.py)."""
+        try:
+            models, metadata = self._fetch()
+        except (requests.RequestException, ValueError) as e:
+            with self._lock:
+                self._down_until = time.monotonic() + self.retry
+                self._last_error = str(e)
+            if not quiet:
+                print(f"⚠️  No se pudo consultar el backend de modelos: {e}")
+            raise BackendUnavailable(str(e))
+        with self._lock:
+            self._models = models
+            self._metadata = metadata
+            self._fetched_at = time.monotonic()
+            self._down_until = 0.0
+            self._last_error = None
+        return models
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing or time.monotonic() < self._down_until:
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            except BackendUnavailable:
+                pass
+            finally:
+                with self._lock:
+                    self._refreshing = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+    # --- Consultas ------------------------------------------------------------------------
+
+    def list(self, force=False):
+        """Devuelve (modelos, info) donde info indica si la lista viene de caché o está caducada."""
+        now = time.monotonic()
+        with self._lock:
+            models = self._models
+            age = now - self._fetched_at if models is not None else None
+            down = now < self._down_until
+
+        if models is not None and not force:
+            stale = age > self.ttl
+            if stale:
+                self._refresh_in_background()
+            return models, {"cached": True, "stale": stale, "age": round(age, 1), "backend_down": down}
+        if down and not force:
+            raise BackendUnavailable(f"backend no disponible ({self._last_error}); se reintentará en "
+                                     f"{self._down_until - now:.0f}s")
+        models = self.refresh()
+        return models, {"cached": False, "stale": False, "age": 0.0, "backend_down": False}
+
+    def info(self, model):
+        """Metadatos cacheados del modelo (sin llamar al backend; si la caché caducó se refresca aparte)."""
+        with self._lock:
+            meta = dict(self._metadata.get(model) or {})
+            stale = self._models is None or time.monotonic() - self._fetched_at > self.ttl
+        if stale:
+            self._refresh_in_background()
+        meta["id"] = model
+        meta["max_tokens"] = self.max_tokens(model, meta.get("context_length"))
+        return meta
+
+    def known_models(self):
+        """Modelos de la última consulta correcta (None si nunca se pudo consultar)."""
+        with self._lock:
+            return self._models
+
+    def context_tokens(self, model):
+        """Longitud de contexto del modelo según el backend, o None si no se conoce."""
+        with self._lock:
+            return (self._metadata.get(model) or {}).get("context_length")
+
+    def max_tokens(self, model, context_length=None):
+        """Tokens máximos de respuesta: DEFAULT_MAX_TOKENS acotado a 1/4 del contexto del modelo."""
+        if context_length is None:
+            context_length = self.context_tokens(model)
+        if context_length is None:
+            # Sin metadatos del backend se usa la tabla de familias de modelos de context.py
+            context_length = model_context_length(model)
+        return max(256, min(DEFAULT_MAX_TOKENS, int(context_length) // 4))
+
+    def stats(self):
+        with self._lock:
+            now = time.monotonic()
+            return {
+                "models": len(self._models) if self._models is not None else None,
+                "age": round(now - self._fetched_at, 1) if self._models is not None else None,
+                "ttl": self.ttl,
+                "backend_down": now < self._down_until,
+                "last_error": self._last_error,
+            }
@@ -0,0 +1,264 @@
+import glob
+import os
+import stat
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+# Límites de la salida que se devuelve al modelo (cabeza + cola)
+MAX_OUTPUT_BYTES = int(os.environ.get("AGENT_OUTPUT_MAX_BYTES", "16384"))
+MAX_OUTPUT_LINES = int(os.environ.get("AGENT_OUTPUT_MAX_LINES", "200"))
+# Número máximo de salidas completas guardadas en disco (se borran las más antiguas)
+MAX_STORED_OUTPUTS = int(os.environ.get("AGENT_OUTPUT_MAX_FILES", "50"))
+# Bytes máximos en disco: de cada salida (lo que pase de ahí no se guarda) y entre todas las guardadas
+MAX_FILE_BYTES = int(os.environ.get("AGENT_OUTPUT_MAX_FILE_MB", "64")) * 1024 * 1024
+MAX_TOTAL_BYTES = int(os.environ.get("AGENT_OUTPUT_MAX_TOTAL_MB", "256")) * 1024 * 1024
+# Los ficheros de salidas de ejecuciones anteriores con más de estos segundos se borran al arrancar
+STALE_SECONDS = 24 * 3600
+# Cada cuántas líneas se guarda la posición en el fichero para paginar sin releerlo entero
+LINE_INDEX_STEP = 1024
+
+_USER = os.getuid() if hasattr(os, "getuid") else os.environ.get("USERNAME", "user")
+# Directorio privado de este usuario: las salidas de los comandos pueden contener secretos
+OUTPUT_DIR = os.environ.get("AGENT_OUTPUT_DIR") or os.path.join(tempfile.gettempdir(), f"agent-outputs-{_USER}")
+
+
+def private_directory(path):
+    """Crea `path` con permisos 0700 (o los corrige si ya era nuestro) y lo devuelve.
+    Lanza OSError si es un enlace o es de otro usuario (p. ej. alguien lo creó antes en /tmp)."""
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    if hasattr(os, "getuid"):
+        info = os.lstat(path)
+        if stat.S_ISLNK(info.st_mode) or not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid():
+            raise OSError(f"{path} no es un directorio privado de este usuario")
+        if info.st_mode & 0o077:
+            os.chmod(path, 0o700)
+    return path
+
+
+class OutputStore:
+    """Salidas completas de comandos volcadas a ficheros temporales, accesibles por `output_id`.
+
+    Los ficheros van a un directorio 0700 del usuario. Cada salida guarda como mucho `max_file_bytes`
+    y se conservan las últimas `max_outputs` sin pasar de `max_total_bytes` entre todas.
+    """
+
+    def __init__(self, directory=None, max_outputs=MAX_STORED_OUTPUTS, max_file_bytes=MAX_FILE_BYTES,
+                 max_total_bytes=MAX_TOTAL_BYTES):
+        self.directory = directory or OUTPUT_DIR
+        self.max_outputs = max_outputs
+        self.max_file_bytes = max_file_bytes
+        self.max_total_bytes = max_total_bytes
+        self._outputs = OrderedDict()
+        self._lock = threading.Lock()
+        self._ready = False
+
+    def _prepare(self):
+        # La primera vez: directorio privado y limpieza de lo que dejaron ejecuciones anteriores
+        private_directory(self.directory)
+        cutoff = time.time() - STALE_SECONDS
+        for path in glob.glob(os.path.join(self.directory, "*.out")):
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+        self._ready = True
+
+    def create(self):
+        """Reserva un `output_id` y abre su fichero para escritura binaria (solo legible por el usuario)."""
+        if not self._ready:
+            self._prepare()
+        output_id = uuid.uuid4().hex[:12]
+        path = os.path.join(self.directory, f"{output_id}.out")
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0), 0o600)
+        return output_id, path, os.fdopen(fd, "wb")
+
+    def register(self, output_id, path, total_bytes, total_lines, line_index):
+        """Registra una salida ya escrita (`total_bytes`/`total_lines`: lo guardado en el fichero)."""
+        with self._lock:
+            self._outputs[output_id] = {
+                "path": path,
+                "bytes": total_bytes,
+                "lines": total_lines,
+                "line_index": line_index,
+                "created": time.time(),
+            }
+            stored = sum(meta["bytes"] for meta in self._outputs.values())
+            while len(self._outputs) > 1 and (len(self._outputs) > self.max_outputs or stored > self.max_total_bytes):
+                _, old = self._outputs.popitem(last=False)
+                stored -= old["bytes"]
+                try:
+                    os.remove(old["path"])
+                except OSError:
+                    pass
+
+    def info(self, output_id):
+        with self._lock:
+            return self._outputs.get(output_id)
+
+    def read(self, output_id, offset=0, limit=None):
+        """Devuelve las líneas [offset, offset+limit) de una salida guardada."""
+        meta = self.info(output_id)
+        if meta is None:
+            return f"Error: no existe la salida '{output_id}' (puede haber expirado)"
+        offset = max(0, int(offset or 0))
+        limit = max(1, min(int(limit or MAX_OUTPUT_LINES), MAX_OUTPUT_LINES))
+        if offset >= meta["lines"]:
+            return f"Error: offset {offset} fuera de rango (la salida tiene {meta['lines']} líneas)"
+
+        # Saltar directamente al punto indexado más cercano y avanzar desde ahí
+        step = offset // LINE_INDEX_STEP
+        step = min(step, len(meta["line_index"]) - 1)
+        line_no, position = step * LINE_INDEX_STEP, meta["line_index"][step]
+        lines = []
+        size = 0
+        with open(meta["path"], "rb") as f:
+            f.seek(position)
+            for raw in f:
+                if line_no >= offset:
+                    if len(lines) >= limit or size + len(raw) > MAX_OUTPUT_BYTES:
+                        break
+                    lines.append(raw)
+                    size += len(raw)
+                line_no += 1
+
+        end = offset + len(lines)
+        text = b"".join(lines).decode("utf-8", errors="replace").rstrip("\n")
+        more = f"; continúa con offset={end}" if end < meta["lines"] else ""
+        return f"[salida {output_id}: líneas {offset}-{end - 1} de {meta['lines']}{more}]\n{text}"
+
+
+output_store = OutputStore()
+
+
+class BoundedCapture:
+    """Captura la salida de un proceso con memoria acotada.
+
+    Mientras la salida cabe en los límites se guarda entera. Al superarlos se vuelca todo
+    a un fichero del `OutputStore` y en memoria solo quedan la cabeza y la cola.
+    """
+
+    def __init__(self, store=None, max_bytes=MAX_OUTPUT_BYTES, max_lines=MAX_OUTPUT_LINES):
+        self.store = store or output_store
+        self.max_bytes = max_bytes
+        self.max_lines = max_lines
+        self.buffer = bytearray()
+        self.head = None
+        self.tail = bytearray()
+        self.total_bytes = 0
+        self.total_lines = 0
+        self.output_id = None
+        self._path = None
+        self._file = None
+        self._line_index = [0]
+        # Bytes escritos en el fichero y líneas completas que contiene si se cortó en max_file_bytes
+        self._file_bytes = 0
+        self._saved_lines = None
+
+    @property
+    def truncated(self):
+        return self.output_id is not None
+
+    def feed(self, data):
+        if not data:
+            return
+        self._index_lines(data)
+        self.total_bytes += len(data)
+
+        if self._file is None:
+            self.buffer += data
+            if len(self.buffer) > self.max_bytes or self.total_lines > self.max_lines:
+                self._start_spill()
+            return
+
+        self._write(data)
+        self.tail += data
+        self._trim_tail()
+
+    def _write(self, data):
+        # `data` ya está contado en total_lines; al llegar a max_file_bytes se deja de escribir
+        if self._saved_lines is not None:
+            return
+        room = self.store.max_file_bytes - self._file_bytes
+        if len(data) > room:
+            # Se guarda hasta la última línea completa que cabe; el resto solo queda en la cola en memoria
+            lines_before = self.total_lines - data.count(b"\n")
+            data = data[: data.rfind(b"\n", 0, room) + 1]
+            self._saved_lines = lines_before + data.count(b"\n")
+        self._file.write(data)
+        self._file_bytes += len(data)
+
+    def _index_lines(self, data):
+        # Guarda la posición en bytes de cada línea múltiplo de LINE_INDEX_STEP
+        start = 0
+        base = self.total_bytes
+        while True:
+            pos = data.find(b"\n", start)
+            if pos == -1:
+                break
+            self.total_lines += 1
+            if self.total_lines % LINE_INDEX_STEP == 0:
+                self._line_index.append(base + pos + 1)
+            start = pos + 1
+
+    def _start_spill(self):
+        self.output_id, self._path, self._file = self.store.create()
+        self._write(bytes(self.buffer))
+        head = bytes(self.buffer[: self.max_bytes // 2])
+        head_lines = head.split(b"\n")
+        if len(head_lines) > self.max_lines // 2:
+            head = b"\n".join(head_lines[: self.max_lines // 2])
+        self.head = head
+        self.tail = bytearray(self.buffer[len(head):])
+        self.buffer = bytearray()
+        self._trim_tail()
+
+    def _trim_tail(self):
+        limit = self.max_bytes - len(self.head)
+        if len(self.tail) > limit:
+            del self.tail[: len(self.tail) - limit]
+            # La cola empieza siempre en una línea completa
+            nl = self.tail.find(b"\n")
+            if 0 <= nl < len(self.tail) - 1:
+                del self.tail[: nl + 1]
+        max_tail_lines = self.max_lines - self.max_lines // 2
+        if self.tail.count(b"\n") > max_tail_lines:
+            pos = len(self.tail)
+            for _ in range(max_tail_lines + 1):
+                pos = self.tail.rfind(b"\n", 0, pos)
+            del self.tail[: pos + 1]
+
+    def close(self):
+        """Cierra el fichero de volcado (si lo hay) y lo registra en el store."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            if self._saved_lines is not None:
+                lines = self._saved_lines
+                index = self._line_index[: lines // LINE_INDEX_STEP + 1]
+            else:
+                # Contar la última línea si no termina en salto de línea
+                lines = self.total_lines + (0 if self.total_bytes and self._ends_with_newline() else 1)
+                index = self._line_index
+            self.store.register(self.output_id, self._path, self._file_bytes, lines, index)
+
+    def _ends_with_newline(self):
+        return bool(self.tail) and self.tail.endswith(b"\n")
+
+    def text(self):
+        """Texto a devolver al modelo: completo o cabeza + aviso + cola."""
+        if not self.truncated:
+            return self.buffer.decode("utf-8", errors="replace")
+        tail = bytes(self.tail)
+        omitted = self.total_bytes - len(self.head) - len(tail)
+        if self._saved_lines is None:
+            saved = f"Salida completa guardada con output_id='{self.output_id}'"
+        else:
+            saved = f"Guardadas solo las primeras {self._saved_lines} líneas con output_id='{self.output_id}'"
+        notice = (f"\n[... salida truncada: {omitted} bytes omitidos de {self.total_bytes} "
+                  f"({self.total_lines} líneas). {saved}; usa read_command_output para paginarla ...]\n")
+        return self.head.decode("utf-8", errors="replace") + notice + tail.decode("utf-8", errors="replace")
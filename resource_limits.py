@@ -0,0 +1,369 @@
+import os
+import platform
+import shutil
+import signal
+import subprocess
+import threading
+
+from metrics import metrics
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+# Prioridad de CPU de los comandos (`nice`; 0 la deja como la del servidor)
+CMD_NICE = int(os.environ.get("AGENT_CMD_NICE", "10"))
+# Nivel de E/S de la clase best-effort de `ionice` (0 = máxima, 7 = mínima; -1 lo desactiva)
+CMD_IONICE = int(os.environ.get("AGENT_CMD_IONICE", "7"))
+# Segundos de CPU por proceso (RLIMIT_CPU: SIGXCPU al llegar y SIGKILL unos segundos después; 0 = sin límite)
+CMD_CPU_SECONDS = int(os.environ.get("AGENT_CMD_CPU_SECONDS", "0"))
+# Memoria máxima en MB: memory.max del cgroup de los comandos o, sin cgroup v2, RLIMIT_AS por proceso (0 = sin límite)
+CMD_MEMORY_MB = int(os.environ.get("AGENT_CMD_MEMORY_MB", "0"))
+# cgroup v2 propio para los comandos (peso de CPU y memoria máxima conjuntos) si el sistema lo delega
+CMD_CGROUP = os.environ.get("AGENT_CMD_CGROUP", "1").strip().lower() not in ("0", "false", "no")
+# Peso de CPU del cgroup de los comandos frente al resto (cpu.weight: 1-10000, 100 por defecto en el sistema)
+CMD_CPU_WEIGHT = int(os.environ.get("AGENT_CMD_CPU_WEIGHT", "20"))
+# Los recursos consumidos se añaden al resultado de la herramienta a partir de estos segundos (reales o de CPU)
+CMD_REPORT_SECONDS = float(os.environ.get("AGENT_CMD_REPORT_SECONDS", "1.0"))
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+CGROUP_NAME = "agent-commands"
+# Segundos entre el límite blando y el duro de RLIMIT_CPU
+CPU_GRACE = 5
+
+
+def _cgroup_path():
+    # Ruta del cgroup v2 del propio proceso ("0::/ruta" en /proc/self/cgroup)
+    try:
+        with open("/proc/self/cgroup", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("0::"):
+                    return os.path.join(CGROUP_ROOT, line[3:].strip().lstrip("/"))
+    except OSError:
+        pass
+    return None
+
+
+def _write(path, value):
+    with open(path, "w", encoding="ascii") as f:
+        f.write(value)
+
+
+def _controllers(path):
+    try:
+        with open(os.path.join(path, "cgroup.controllers"), encoding="ascii") as f:
+            return set(f.read().split())
+    except OSError:
+        return set()
+
+
+def wait_with_usage(process, timeout=None, on_timeout=None):
+    """Espera a `process` con `os.wait4` para obtener sus recursos (los de él y los hijos que esperó).
+
+    Devuelve (returncode, rusage o None). Si pasa `timeout` se llama a `on_timeout` (que debe matar el
+    proceso) y, cuando termina, se lanza `subprocess.TimeoutExpired`. Sin wait4 (Windows) usa `wait`.
+    """
+    if not hasattr(os, "wait4"):
+        try:
+            return process.wait(timeout=timeout), None
+        except subprocess.TimeoutExpired:
+            if on_timeout:
+                on_timeout()
+            process.wait()
+            raise
+    expired = threading.Event()
+
+    def expire():
+        expired.set()
+        if on_timeout:
+            on_timeout()
+
+    timer = threading.Timer(timeout, expire) if timeout else None
+    if timer:
+        timer.daemon = True
+        timer.start()
+    try:
+        _, status, usage = os.wait4(process.pid, 0)
+        # Popen no vuelve a esperar un proceso con returncode
+        process.returncode = os.waitstatus_to_exitcode(status)
+    except ChildProcessError:
+        # Ya lo esperó otro (p. ej. un poll() concurrente): sin recursos
+        process.wait()
+        usage = None
+    finally:
+        if timer:
+            timer.cancel()
+    if expired.is_set():
+        raise subprocess.TimeoutExpired(process.args, timeout)
+    return process.returncode, usage
+
+
+def usage_from_rusage(rusage):
+    """(segundos de CPU, pico de RSS en KB) de un `resource.struct_rusage` (None, None si no hay)."""
+    if rusage is None:
+        return None, None
+    # ru_maxrss va en KB en Linux y en bytes en macOS
+    max_rss = rusage.ru_maxrss // 1024 if platform.system() == "Darwin" else rusage.ru_maxrss
+    return rusage.ru_utime + rusage.ru_stime, max_rss
+
+
+class CommandLimits:
+    """Límites y contabilidad de los comandos que ejecuta el agente (pool de shells, `bash -lc` y trabajos).
+
+    - Al lanzar cada proceso (`argv`/`popen_kwargs`/`attach`): nueva sesión (su grupo se mata entero en
+      los timeouts) y los envoltorios `nice`, `ionice` (best-effort) y `prlimit` (RLIMIT_CPU y, si no
+      hay cgroup, RLIMIT_AS), que aplican los límites con exec antes de que el comando arranque. No se
+      usa `preexec_fn`: el servidor tiene hilos y ejecutar Python entre fork y exec puede bloquearse.
+    - Con cgroup v2 delegado, los comandos van a un cgroup hermano o hijo del servidor con
+      `cpu.weight` y `memory.max` conjuntos (el padre escribe el pid en `cgroup.procs` al lanzarlo);
+      si no se puede crear se sigue solo con los rlimits.
+    - `account` registra tiempo real y de CPU, pico de RSS y bytes de salida de cada comando en las
+      métricas; `describe` devuelve la línea que se añade al resultado de la herramienta.
+    """
+
+    def __init__(self, nice=CMD_NICE, ionice=CMD_IONICE, cpu_seconds=CMD_CPU_SECONDS, memory_mb=CMD_MEMORY_MB,
+                 cgroup=CMD_CGROUP, cpu_weight=CMD_CPU_WEIGHT, report_seconds=CMD_REPORT_SECONDS):
+        self.posix = os.name == "posix"
+        self.nice = nice if self.posix else 0
+        self.ionice = shutil.which("ionice") if ionice >= 0 and platform.system() == "Linux" else None
+        self.ionice_level = min(max(ionice, 0), 7)
+        self._nice_bin = shutil.which("nice") if self.nice else None
+        self._prlimit_bin = shutil.which("prlimit") if platform.system() == "Linux" else None
+        self.cpu_seconds = cpu_seconds if resource else 0
+        self.memory_mb = memory_mb
+        self.cpu_weight = cpu_weight
+        self.report_seconds = report_seconds
+        self._cgroup_wanted = cgroup and platform.system() == "Linux"
+        self._cgroup_ready = False
+        self.cgroup = None
+        self.cgroup_memory = False
+        # Último `oom_kill` visto en memory.events (para distinguir un OOM de otro SIGKILL)
+        self._oom_kills = 0
+        self._lock = threading.Lock()
+        self.commands = 0
+        self.limited = 0
+        self.wall_total = 0.0
+        self.cpu_total = 0.0
+        self.output_bytes_total = 0
+        self.max_rss_kb = 0
+
+    # --- Lanzamiento ------------------------------------------------------------------------
+
+    def argv(self, args):
+        """Antepone a los argumentos los envoltorios que fijan los límites (`nice`, `ionice -t` y
+        `prlimit`). Cada uno hace exec del siguiente, así el comando ya arranca limitado."""
+        self._setup_cgroup()
+        prefix = []
+        if self._nice_bin:
+            prefix += [self._nice_bin, "-n", str(self.nice)]
+        if self.ionice:
+            # -t: si el sistema no permite cambiar la prioridad de E/S se sigue sin ella
+            prefix += [self.ionice, "-t", "-c", "2", "-n", str(self.ionice_level)]
+        rlimits = self._rlimits()
+        if rlimits and self._prlimit_bin:
+            prefix += [self._prlimit_bin] + [f"--{name}={soft}:{hard}" for name, _, soft, hard in rlimits] + ["--"]
+        return prefix + list(args)
+
+    def _rlimits(self):
+        # (opción de prlimit, recurso, blando, duro)
+        limits = []
+        if self.cpu_seconds:
+            limits.append(("cpu", resource.RLIMIT_CPU, self.cpu_seconds, self.cpu_seconds + CPU_GRACE))
+        if self.memory_mb and not self.cgroup_memory and resource:
+            limits.append(("as", resource.RLIMIT_AS, self.memory_mb * 1024 * 1024, self.memory_mb * 1024 * 1024))
+        return limits
+
+    def popen_kwargs(self):
+        """Argumentos para Popen/create_subprocess_exec: una sesión nueva (la crea el propio subprocess,
+        sin código Python en el hijo). Tras lanzar el proceso hay que llamar a `attach`."""
+        if not self.posix:
+            return {}
+        self._setup_cgroup()
+        return {"start_new_session": True}
+
+    def attach(self, process):
+        """Mete el proceso recién lanzado en el cgroup de los comandos y, si no hay `nice` o `prlimit`
+        en el sistema, le aplica desde aquí la prioridad y los rlimits (mejor esfuerzo)."""
+        if not self.posix:
+            return
+        pid = process.pid
+        if self.cgroup:
+            try:
+                _write(os.path.join(self.cgroup, "cgroup.procs"), str(pid))
+            except OSError:
+                pass
+        try:
+            if self.nice and not self._nice_bin:
+                os.setpriority(os.PRIO_PROCESS, pid, os.getpriority(os.PRIO_PROCESS, 0) + self.nice)
+            if not self._prlimit_bin and hasattr(resource, "prlimit"):
+                for _, limit, soft, hard in self._rlimits():
+                    resource.prlimit(pid, limit, (soft, hard))
+        except (OSError, ValueError):
+            pass
+
+    def _setup_cgroup(self):
+        """Crea el cgroup de los comandos la primera vez (si hay cgroup v2 y permisos); si no, nada."""
+        if self._cgroup_ready:
+            return
+        with self._lock:
+            if self._cgroup_ready:
+                return
+            self._cgroup_ready = True
+            if not self._cgroup_wanted or not os.path.exists(os.path.join(CGROUP_ROOT, "cgroup.controllers")):
+                return
+            own = _cgroup_path()
+            if not own:
+                return
+            # Un cgroup con procesos no puede repartir recursos a sus hijos (salvo la raíz): primero se prueba
+            # como hijo del cgroup del servidor y después como hermano
+            errors = []
+            for parent in dict.fromkeys([own, os.path.dirname(own.rstrip("/"))]):
+                if not parent.startswith(CGROUP_ROOT):
+                    continue
+                try:
+                    self._create_cgroup(parent)
+                    print(f"🧱 Comandos en el cgroup {self.cgroup} (cpu.weight={self.cpu_weight}"
+                          f"{f', memory.max={self.memory_mb} MB' if self.cgroup_memory else ''})")
+                    return
+                except OSError as e:
+                    errors.append(str(e))
+            print(f"ℹ️  cgroup v2 no disponible para los comandos; solo rlimits ({errors[-1] if errors else 'sin permisos'})")
+
+    def _create_cgroup(self, parent):
+        path = os.path.join(parent, CGROUP_NAME)
+        wanted = {"cpu"} | ({"memory"} if self.memory_mb else set())
+        available = _controllers(parent) & wanted
+        if not available:
+            raise OSError(f"{parent} no ofrece los controladores {', '.join(sorted(wanted))}")
+        _write(os.path.join(parent, "cgroup.subtree_control"), " ".join(f"+{c}" for c in sorted(available)))
+        os.makedirs(path, exist_ok=True)
+        controllers = _controllers(path)
+        if "cpu" in controllers:
+            _write(os.path.join(path, "cpu.weight"), str(min(max(self.cpu_weight, 1), 10000)))
+        if self.memory_mb and "memory" in controllers:
+            _write(os.path.join(path, "memory.max"), str(self.memory_mb * 1024 * 1024))
+            self.cgroup_memory = True
+            self._oom_kills = self._read_oom_kills(path)
+        # Comprobar que se pueden mover procesos (hace falta permiso de escritura en cgroup.procs)
+        if not os.access(os.path.join(path, "cgroup.procs"), os.W_OK):
+            raise OSError(f"sin permiso para mover procesos a {path}")
+        self.cgroup = path
+
+    @staticmethod
+    def _read_oom_kills(path):
+        try:
+            with open(os.path.join(path, "memory.events"), encoding="ascii") as f:
+                for line in f:
+                    name, _, value = line.partition(" ")
+                    if name == "oom_kill":
+                        return int(value)
+        except (OSError, ValueError):
+            pass
+        return 0
+
+    def kill_group(self, process):
+        """Mata el proceso y todo su grupo (se lanzó en una sesión nueva)."""
+        try:
+            if self.posix:
+                os.killpg(process.pid, signal.SIGKILL)
+            else:
+                process.kill()
+        except (ProcessLookupError, PermissionError, OSError):
+            try:
+                process.kill()
+            except OSError:
+                pass
+
+    # --- Contabilidad -----------------------------------------------------------------------
+
+    def limit_hit(self, returncode):
+        """Qué límite terminó el comando según su código de salida (None si ninguno conocido)."""
+        if returncode is None or not self.posix:
+            return None
+        # -N si el proceso murió por la señal N; 128+N si lo informa un shell intermedio
+        sig = -returncode if returncode < 0 else returncode - 128 if 128 < returncode < 160 else None
+        if sig == signal.SIGXCPU:
+            return "cpu"
+        # Con memory.max el OOM killer del cgroup termina el comando con SIGKILL; otros SIGKILL (un
+        # `kill -9`, el timeout) no cuentan si no subió `oom_kill` en memory.events
+        if sig == signal.SIGKILL and self.cgroup_memory:
+            oom_kills = self._read_oom_kills(self.cgroup)
+            with self._lock:
+                grew, self._oom_kills = oom_kills > self._oom_kills, max(oom_kills, self._oom_kills)
+            if grew:
+                return "memory"
+        return None
+
+    def account(self, wall, output_bytes, returncode, cpu=None, max_rss_kb=None, timed_out=False, kind="command"):
+        """Registra los recursos de un comando terminado y devuelve el dict de uso."""
+        limit = "timeout" if timed_out else self.limit_hit(returncode)
+        usage = {"wall": wall, "cpu": cpu, "max_rss_kb": max_rss_kb, "output_bytes": output_bytes,
+                 "returncode": returncode, "limit": limit}
+        with self._lock:
+            self.commands += 1
+            self.wall_total += wall
+            self.cpu_total += cpu or 0.0
+            self.output_bytes_total += output_bytes
+            self.max_rss_kb = max(self.max_rss_kb, max_rss_kb or 0)
+            if limit:
+                self.limited += 1
+        metrics.observe("agent_command_seconds", wall, clock="wall", kind=kind)
+        if cpu is not None:
+            metrics.observe("agent_command_seconds", cpu, clock="cpu", kind=kind)
+        metrics.inc("agent_command_output_bytes_total", output_bytes, kind=kind)
+        if limit:
+            metrics.inc("agent_command_limits_total", limit=limit, kind=kind)
+        return usage
+
+    def describe(self, usage):
+        """Línea de recursos para el resultado de la herramienta ("" si el comando fue rápido y no topó
+        con ningún límite: así los resultados habituales no cambian y siguen deduplicándose)."""
+        if not usage:
+            return ""
+        notes = {
+            "cpu": f"superó el límite de CPU ({self.cpu_seconds} s, AGENT_CMD_CPU_SECONDS)",
+            "memory": f"superó la memoria máxima ({self.memory_mb} MB, AGENT_CMD_MEMORY_MB)",
+        }
+        slow = max(usage["wall"], usage["cpu"] or 0.0) >= self.report_seconds
+        if not slow and usage["limit"] not in notes:
+            return ""
+        parts = [f"{usage['wall']:.1f} s reales"]
+        if usage["cpu"] is not None:
+            parts.append(f"{usage['cpu']:.1f} s de CPU")
+        if usage["max_rss_kb"]:
+            parts.append(f"pico de memoria {usage['max_rss_kb'] / 1024:.0f} MB")
+        parts.append(f"{_size(usage['output_bytes'])} de salida")
+        line = "\n[recursos: " + ", ".join(parts) + "]"
+        if usage["limit"] in notes:
+            line += f"\n[el comando {notes[usage['limit']]}]"
+        return line
+
+    def stats(self):
+        with self._lock:
+            return {
+                "nice": self.nice,
+                "ionice": self.ionice_level if self.ionice else None,
+                "cpu_seconds_limit": self.cpu_seconds,
+                "memory_mb_limit": self.memory_mb,
+                "cgroup": self.cgroup,
+                "commands": self.commands,
+                "limited": self.limited,
+                "wall_seconds": round(self.wall_total, 3),
+                "cpu_seconds": round(self.cpu_total, 3),
+                "output_bytes": self.output_bytes_total,
+                "max_rss_mb": round(self.max_rss_kb / 1024, 1),
+            }
+
+
+def _size(n):
+    if n < 1024:
+        return f"{n} B"
+    if n < 1024 * 1024:
+        return f"{n / 1024:.1f} KB"
+    return f"{n / 1024 / 1024:.1f} MB"
+
+
+# Límites compartidos por todos los comandos del proceso
+command_limits = CommandLimits()
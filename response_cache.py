@@ -0,0 +1,199 @@
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import Counter, OrderedDict
+
+from environment import environment
+from metrics import metrics
+from tool_cache import command_ttl, tool_cache
+
+
+# Caché de respuestas a preguntas repetidas (opt-in: AGENT_RESPONSE_CACHE=1)
+RESPONSE_CACHE = os.environ.get("AGENT_RESPONSE_CACHE", "0").strip().lower() in ("1", "true", "yes", "si", "sí")
+# Vida máxima de una respuesta; si el turno usó comandos con TTL menor (ver tool_cache.py) manda el menor
+RESPONSE_CACHE_TTL = float(os.environ.get("AGENT_RESPONSE_CACHE_TTL", "600"))
+# Similitud mínima (coseno entre trigramas de caracteres) para servir la respuesta de una pregunta
+# casi igual; 0 la desactiva y solo se sirven prompts idénticos tras normalizarlos
+RESPONSE_CACHE_SIMILARITY = float(os.environ.get("AGENT_RESPONSE_CACHE_SIMILARITY", "0.9"))
+MAX_ENTRIES = 512
+# Herramientas cuyo resultado cambia de un momento a otro: un turno que las usa no se cachea
+VOLATILE_TOOLS = {"read_command_output", "job_status", "cancel_job", "list_jobs"}
+
+_PUNCTUATION = re.compile(r"[^\w\s]")
+# Rutas, versiones, nombres de fichero, puertos...: dos preguntas parecidas que difieren en uno de
+# estos datos no son la misma pregunta ("espacio en /home" frente a "espacio en /var")
+_SPECIFIC = re.compile(r"\S*[\d/\\.:_@~-]\S*")
+
+
+def normalize_prompt(prompt):
+    """Minúsculas, sin tildes, sin signos de puntuación y con los espacios colapsados."""
+    text = unicodedata.normalize("NFKD", (prompt or "").lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return " ".join(_PUNCTUATION.sub(" ", text).split())
+
+
+def _specifics(prompt):
+    tokens = (token.strip("¿?¡!,;.:\"'()") for token in _SPECIFIC.findall((prompt or "").lower()))
+    return frozenset(token for token in tokens if _SPECIFIC.fullmatch(token))
+
+
+def _vector(text):
+    """Vector de trigramas de caracteres normalizado (un 'embedding' local sin dependencias)."""
+    padded = f"  {text} "
+    counts = Counter(padded[i:i + 3] for i in range(len(padded) - 2))
+    norm = math.sqrt(sum(v * v for v in counts.values())) or 1.0
+    return {gram: v / norm for gram, v in counts.items()}
+
+
+def _similarity(a, b):
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(v * b.get(gram, 0.0) for gram, v in a.items())
+
+
+def environment_hash():
+    """Huella del entorno que ve el modelo: una respuesta no sirve en otra máquina u otro entorno."""
+    return hashlib.sha1(environment.block().encode("utf-8")).hexdigest()[:12]
+
+
+def prompt_context(system_message, tools):
+    """Huella de lo que acompaña al prompt en la petición: mensaje de sistema y herramientas. Dos
+    sesiones con otro prompt de sistema u otras herramientas no comparten respuestas."""
+    payload = json.dumps([(system_message or {}).get("content"), tools], ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()[:12]
+
+
+def answer_ttl(messages, ttl=RESPONSE_CACHE_TTL):
+    """TTL de la respuesta de un turno a partir de las herramientas que usó (0 = no cacheable):
+    el menor entre `ttl` y el de los comandos de solo lectura; otros comandos o herramientas volátiles dan 0."""
+    for message in messages:
+        for call in message.get("tool_calls") or []:
+            function = call.get("function") or {}
+            name = function.get("name")
+            if name in VOLATILE_TOOLS:
+                return 0
+            if name != "execute_terminal_command":
+                continue
+            try:
+                args = json.loads(function.get("arguments") or "{}")
+            except ValueError:
+                return 0
+            command_limit = command_ttl(args.get("command")) if isinstance(args, dict) and not args.get("background") else None
+            if not command_limit:
+                return 0
+            ttl = min(ttl, command_limit)
+    return ttl
+
+
+class ResponseCache:
+    """Respuestas finales a prompts que inician conversación, compartidas entre sesiones.
+
+    - Clave: prompt normalizado + modelo + huella del entorno (environment.py) + huella del mensaje
+      de sistema y las herramientas (`context`, ver `prompt_context`).
+    - Si no hay una idéntica, se busca la pregunta más parecida con el mismo resto de la clave
+      (coseno entre trigramas de caracteres) y se sirve si supera `similarity` y menciona las
+      mismas rutas, versiones o nombres de fichero.
+    - Cada respuesta caduca a los `ttl` segundos (o antes si usó comandos con TTL menor) y se descarta
+      si desde que se guardó se ejecutó algún comando que puede cambiar el sistema (generación de
+      tool_cache). Tampoco se guardan turnos que cambiaron el sistema, pidieron confirmación o
+      usaron herramientas volátiles.
+    """
+
+    def __init__(self, enabled=RESPONSE_CACHE, ttl=RESPONSE_CACHE_TTL, similarity=RESPONSE_CACHE_SIMILARITY,
+                 max_entries=MAX_ENTRIES):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.similarity = similarity
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = {"exact": 0, "near": 0}
+        self.misses = 0
+        self.stores = 0
+
+    def _valid(self, entry, now):
+        return entry["expires"] > now and entry["generation"] == tool_cache.generation
+
+    def get(self, prompt, model, context=None):
+        """Entrada cacheada para el prompt (dict con `answer`, `kind`, `age`, `similarity`) o None."""
+        if not self.enabled:
+            return None
+        normalized = normalize_prompt(prompt)
+        if not normalized:
+            return None
+        env = environment_hash()
+        now = time.monotonic()
+        with self._lock:
+            for key in [k for k, e in self._entries.items() if not self._valid(e, now)]:
+                del self._entries[key]
+            entry = self._entries.get((normalized, model, env, context))
+            kind, score = "exact", 1.0
+            if entry is None and self.similarity > 0:
+                vector, specifics = _vector(normalized), _specifics(prompt)
+                score = self.similarity
+                for (_, *rest), candidate in self._entries.items():
+                    if rest != [model, env, context] or candidate["specifics"] != specifics:
+                        continue
+                    candidate_score = _similarity(vector, candidate["vector"])
+                    if candidate_score >= score:
+                        entry, score = candidate, candidate_score
+                kind = "near"
+            if entry is None:
+                self.misses += 1
+                metrics.inc("agent_response_cache_total", result="miss")
+                return None
+            self.hits[kind] += 1
+            self._entries.move_to_end(entry["key"])
+        metrics.inc("agent_response_cache_total", result=kind)
+        return {"answer": entry["answer"], "kind": kind, "similarity": round(score, 3),
+                "age": round(now - entry["created"], 1), "prompt": entry["prompt"]}
+
+    def put(self, prompt, model, answer, generation, turn_messages=(), context=None):
+        """Guarda la respuesta final del turno si es cacheable. `generation` es la de tool_cache al
+        empezar el turno: si cambió, el turno ejecutó algo que pudo modificar el sistema."""
+        if not self.enabled or not answer or generation != tool_cache.generation:
+            return False
+        normalized = normalize_prompt(prompt)
+        ttl = answer_ttl(turn_messages, self.ttl)
+        if not normalized or ttl <= 0:
+            return False
+        key = (normalized, model, environment_hash(), context)
+        now = time.monotonic()
+        with self._lock:
+            self._entries[key] = {
+                "key": key, "prompt": prompt, "answer": answer, "vector": _vector(normalized),
+                "specifics": _specifics(prompt),
+                "created": now, "expires": now + ttl, "generation": generation,
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self.stores += 1
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            hits = sum(self.hits.values())
+            lookups = hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "hits_exact": self.hits["exact"],
+                "hits_near": self.hits["near"],
+                "misses": self.misses,
+                "stores": self.stores,
+                "hit_ratio": round(hits / lookups, 3) if lookups else 0.0,
+            }
+
+
+# Caché compartida por todas las sesiones del servidor
+response_cache = ResponseCache()
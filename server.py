@@ -1,15 +1,27 @@
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse, FileResponse, RedirectResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, RedirectResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from openai import OpenAI
 from dotenv import load_dotenv
+import asyncio
 import os
 import json
+from contextlib import asynccontextmanager
 
-from agent import Agent
-
+# .env antes de importar los módulos que leen su configuración del entorno al cargarse
 load_dotenv()
+from backend_pool import backends
+from conversation_store import default_store
+from environment import environment
+from jobs import JobError, job_manager
+from llm_scheduler import LLM_CONCURRENCY, LLMScheduler, SchedulerBusy
+from metrics import metrics
+from model_catalog import BackendUnavailable
+from resource_limits import command_limits
+from response_cache import prompt_context, response_cache
+from sessions import SessionManager
+from shell_pool import shell_pool
+from tool_cache import tool_cache
 
 APP = FastAPI(title="Agent API")
 
@@ -27,13 +39,72 @@ if not os.path.isdir(static_dir):
     os.makedirs(static_dir, exist_ok=True)
 APP.mount("/static", StaticFiles(directory=static_dir), name="static")
 
-# Cliente OpenAI (apunta a LM Studio por defecto)
-client = OpenAI(base_url="http://localhost:1234/v1", api_key="lm-studio")
+# Backends compatibles con OpenAI (LM Studio por defecto; AGENT_LLM_BACKENDS para varios). Cada uno
+# tiene su catálogo de modelos cacheado y su cliente asíncrono; el pool enruta y reintenta (ver backend_pool.py)
 
-# Modelo activo (valor por defecto)
+# Modelo por defecto para las sesiones nuevas
 MODEL = os.environ.get("AGENT_MODEL", "deepseek-r1-0528-qwen3-8b")
 
-agent = Agent()
+# Una instancia de Agent por sesión (cookie o cabecera X-Session-Id)
+SESSION_COOKIE = "agent_session"
+SESSION_HEADER = "X-Session-Id"
+# Conversaciones persistidas en SQLite (AGENT_STORE=0 para mantenerlas solo en memoria)
+store = default_store()
+sessions = SessionManager(default_model=MODEL, store=store)
+# Arrancar los shells del pool en segundo plano para que el primer comando no pague el login
+shell_pool.warm()
+# Instantánea del entorno para el mensaje de sistema de las sesiones, refrescada periódicamente
+# (ver environment.py)
+environment.start()
+environment.schedule()
+# Cargar el catálogo de modelos en segundo plano (la primera carga de la página ya lo encuentra en caché)
+backends.info(MODEL)
+# Sondas periódicas de salud y latencia de los backends
+backends.start()
+# Control de admisión y reparto justo de las llamadas al backend entre sesiones (ver llm_scheduler.py);
+# AGENT_LLM_CONCURRENCY es por backend
+scheduler = LLMScheduler(concurrency=LLM_CONCURRENCY * len(backends.backends))
+# Pedir al backend el uso de tokens también en streaming (AGENT_STREAM_USAGE=0 si no lo admite)
+STREAM_USAGE = os.environ.get("AGENT_STREAM_USAGE", "1").strip().lower() not in ("0", "false", "no")
+# Bytes de una salida de herramienta que se envían en el historial; el resto se pide al expandirla
+UI_INLINE_BYTES = int(os.environ.get("AGENT_UI_INLINE_BYTES", "4096"))
+
+# Estado de los componentes publicado en /api/metrics junto a los contadores y spans
+turns_in_flight = {"chat": 0, "stream": 0}
+metrics.collect("agent_turns_in_flight", lambda: dict(turns_in_flight))
+metrics.collect("agent_tool_cache", tool_cache.stats)
+metrics.collect("agent_shell_pool", shell_pool.stats)
+metrics.collect("agent_sessions", sessions.stats)
+metrics.collect("agent_model_catalog", backends.primary.catalog.stats)
+metrics.collect("agent_backends", backends.stats)
+metrics.collect("agent_llm_scheduler", scheduler.stats)
+metrics.collect("agent_jobs", job_manager.stats)
+metrics.collect("agent_command_limits", command_limits.stats)
+metrics.collect("agent_environment", environment.stats)
+metrics.collect("agent_response_cache", response_cache.stats)
+if store is not None:
+    metrics.collect("agent_store", store.stats)
+
+
+def _session_id(request: Request):
+    return request.headers.get(SESSION_HEADER) or request.cookies.get(SESSION_COOKIE)
+
+
+def _get_session(request: Request):
+    """Obtiene (o crea) la sesión asociada a la petición. Bloquea: desde una corrutina usar `_get_session_async`."""
+    return sessions.get(_session_id(request))
+
+
+async def _get_session_async(request: Request):
+    # Reanudar una sesión lee SQLite y puede esperar a la cola de escritura: fuera del event loop
+    return await asyncio.to_thread(_get_session, request)
+
+
+def _with_session(response, session):
+    """Devuelve al cliente el identificador de sesión (cookie + cabecera)."""
+    response.set_cookie(SESSION_COOKIE, session.id, httponly=True, samesite="lax")
+    response.headers[SESSION_HEADER] = session.id
+    return response
 
 
 @APP.get("/")
@@ -43,141 +114,495 @@ def index():
 
 
 @APP.get("/api/models")
-def list_models():
-    """Lista modelos desde la API (intenta client.models.list(), si falla usa /v1/models)."""
+def list_models(refresh: bool = False):
+    """Lista los modelos de todos los backends desde sus catálogos cacheados (ver model_catalog.py);
+    `?refresh=true` fuerza la consulta."""
     try:
-        models = client.models.list()
-        ids = [m.id for m in models.data]
-        return JSONResponse({"models": ids, "source": "client.models.list()"})
-    except Exception:
-        # Fallback: petición HTTP directa
-        try:
-            import requests
-            resp = requests.get("http://localhost:1234/v1/models", timeout=5)
-            resp.raise_for_status()
-            data = resp.json()
-            items = []
-            for item in data.get("data", []) or data.get("models", []):
-                if isinstance(item, dict):
-                    items.append(item.get("id") or item.get("name"))
-                else:
-                    items.append(str(item))
-            return JSONResponse({"models": items, "source": "http://localhost:1234/v1/models"})
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"No se pudieron listar los modelos: {e}")
+        models, info = backends.list(force=refresh)
+    except BackendUnavailable as e:
+        raise HTTPException(status_code=503, detail=f"No se pudieron listar los modelos: {e}")
+    details = {m: backends.info(m) for m in models}
+    sources = [f"{b.url}/models" for b in backends.backends]
+    return JSONResponse({"models": models, "source": sources[0], "sources": sources, "details": details, **info})
+
+
+@APP.get("/api/backends")
+def list_backends():
+    """Estado de cada backend del pool: salud, latencia, peticiones en curso y modelos servidos."""
+    return JSONResponse({"backends": backends.describe(), **backends.stats()})
 
 
 @APP.post("/api/model")
-def change_model(payload: dict):
-    """Cambia el modelo activo en el servidor (cliente solo actualiza variable y limpia historial).
+async def change_model(payload: dict, request: Request):
+    """Cambia el modelo activo de la sesión y limpia su historial.
 
     Payload: { "model": "model-name" }
     """
-    global MODEL, agent
     model = payload.get("model") if payload else None
     if not model:
         raise HTTPException(status_code=400, detail="Campo 'model' requerido")
 
-    # Actualizar variable y resetear la conversación
-    old = MODEL
-    MODEL = model
-    agent.messages = [agent.messages[0]]
-    return JSONResponse({"ok": True, "model": MODEL, "old_model": old, "cleared_history": True})
+    session = await _get_session_async(request)
+    async with session.lock:
+        # Actualizar modelo y resetear la conversación de esta sesión
+        old = session.model
+        session.model = model
+        _set_model(session.agent, model)
+        session.agent.reset_history()
+    return _with_session(JSONResponse({"ok": True, "model": model, "old_model": old, "cleared_history": True, "cursor": session.agent.cursor}), session)
 
 
-@APP.post("/api/chat")
-def chat(payload: dict):
-    """Enviar prompt y devolver la respuesta final. Mantiene el loop de tool-calls igual que main.py."""
-    global MODEL, agent
-    prompt = payload.get("prompt") if payload else None
-    if prompt is None:
-        raise HTTPException(status_code=400, detail="Campo 'prompt' requerido")
+@APP.get("/api/sessions")
+def list_sessions(request: Request):
+    """Conversación guardada de quien llama (no hay cuentas: cada cliente solo ve la suya) y estado
+    agregado de las sesiones en memoria y del almacén."""
+    session_id = _session_id(request)
+    saved = store.session(session_id) if store is not None and session_id else None
+    return JSONResponse({"sessions": [saved] if saved else [], "active": sessions.stats(),
+                         "store": store.stats() if store is not None else None})
+
+
+@APP.get("/api/sessions/{session_id}/export")
+def export_session(session_id: str, request: Request):
+    """Exporta todos los mensajes guardados de la conversación de quien llama en JSONL (uno por línea)."""
+    # Solo la propia sesión: conocer el id de otra no basta para leerla
+    if store is None or session_id != _session_id(request):
+        raise HTTPException(status_code=404, detail="Sesión no encontrada")
+    store.flush()
+    if store.session(session_id) is None:
+        raise HTTPException(status_code=404, detail="Sesión no encontrada")
+    lines = (json.dumps(entry, ensure_ascii=False) + "\n" for entry in store.export(session_id))
+    return StreamingResponse(lines, media_type="application/x-ndjson",
+                             headers={"Content-Disposition": f'attachment; filename="{session_id}.jsonl"'})
+
+
+@APP.get("/api/metrics")
+def get_metrics():
+    """Métricas en formato de texto de Prometheus: spans por fase, tokens, herramientas y estado de cachés/colas."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@APP.get("/api/environment")
+def get_environment(refresh: bool = False):
+    """Instantánea del entorno que reciben las sesiones en su mensaje de sistema; `?refresh=true` la recoge de nuevo."""
+    info = environment.get(refresh=refresh)
+    if info is None:
+        raise HTTPException(status_code=503, detail="La instantánea del entorno todavía no está disponible")
+    return JSONResponse({**info, **environment.stats()})
+
+
+@APP.get("/api/queue")
+def queue_status(request: Request):
+    """Estado del planificador de llamadas al modelo y posición en cola de la sesión (si espera)."""
+    session_id = request.headers.get(SESSION_HEADER) or request.cookies.get(SESSION_COOKIE)
+    return JSONResponse({**scheduler.stats(), "position": scheduler.position(session_id) if session_id else None})
+
+
+def _session_job(request, job_id):
+    """Trabajo en segundo plano de la sesión de la petición (404 si no existe o es de otra sesión)."""
+    session = _get_session(request)
+    try:
+        job = job_manager.get(job_id)
+    except JobError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    if job.owner != session.id:
+        raise HTTPException(status_code=404, detail=f"no existe el trabajo '{job_id}'")
+    return session, job
+
+
+@APP.get("/api/jobs")
+def list_jobs(request: Request):
+    """Comandos en segundo plano de la sesión (ver jobs.py)."""
+    session = _get_session(request)
+    return _with_session(JSONResponse({"jobs": job_manager.list(owner=session.id)}), session)
+
+
+@APP.get("/api/jobs/{job_id}")
+def job_output(job_id: str, request: Request, offset: int = None, lines: int = 40):
+    """Estado del trabajo y su salida: lo nuevo desde el byte `offset` o, sin él, las últimas `lines` líneas.
+    El cliente sigue el log pidiendo de nuevo con el `next_offset` recibido."""
+    session, job = _session_job(request, job_id)
+    output, next_offset = job_manager.read(job.id, offset, tail_lines=lines)
+    return _with_session(JSONResponse({**job.summary(), "output": output, "offset": offset, "next_offset": next_offset}), session)
+
+
+@APP.post("/api/jobs/{job_id}/cancel")
+def cancel_job(job_id: str, request: Request):
+    """Cancela un trabajo en segundo plano de la sesión."""
+    session, job = _session_job(request, job_id)
+    job = job_manager.cancel(job.id)
+    return _with_session(JSONResponse(job.summary()), session)
+
+
+def _busy(e):
+    return HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+
+@APP.get("/api/messages")
+def get_messages(request: Request, since: int = None):
+    """Historial de la sesión desde el cursor `since` (el mismo formato que devuelve /api/chat).
+    La interfaz lo usa al cargar la página para recuperar la conversación."""
+    session = _get_session(request)
+    return _with_session(JSONResponse(_history(session.agent, since)), session)
+
+
+@APP.get("/api/messages/{message_id}")
+def get_message(message_id: int, request: Request):
+    """Contenido completo de un mensaje (para expandir una salida de herramienta truncada)."""
+    session = _get_session(request)
+    entry = session.agent.display_entry(message_id)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Mensaje no encontrado")
+    content = entry.get("content") or ""
+    return _with_session(JSONResponse({"id": entry["id"], "seq": entry["seq"], "role": entry.get("role"),
+                                       "content": content, "size": len(content.encode("utf-8"))}), session)
+
+
+@APP.get("/api/context")
+def context_usage(request: Request):
+    """Uso del contexto de la sesión: tokens del historial frente al presupuesto del modelo."""
+    session = _get_session(request)
+    _set_model(session.agent, session.model)
+    return _with_session(JSONResponse(session.agent.context_usage()), session)
+
+
+def _preview(text):
+    """Cabeza de una salida larga para la interfaz, cortada en un salto de línea si es posible."""
+    head = text[:UI_INLINE_BYTES]
+    cut = head.rfind("\n")
+    return head[:cut] if cut > UI_INLINE_BYTES // 2 else head
+
+
+def _client_message(entry):
+    """Entrada de la vista de clientes tal como se envía: id, tamaño en bytes y líneas y, si es una
+    salida de herramienta grande, solo su cabeza (`truncated`); el resto se pide con /api/messages/{id}."""
+    content = entry.get("content") or ""
+    size = len(content.encode("utf-8"))
+    message = {"id": entry["id"], "seq": entry["seq"], "role": entry.get("role"), "content": content,
+               "size": size, "lines": content.count("\n") + 1 if content else 0}
+    if entry.get("display_as"):
+        message["display_as"] = entry["display_as"]
+    if message["role"] == "tool" and size > UI_INLINE_BYTES:
+        message["content"] = _preview(content)
+        message["truncated"] = True
+    return message
+
+
+def _history(agent, since):
+    """Mensajes nuevos para el cliente desde el cursor `since` (sin 'system', tools ya combinados).
+
+    Sin cursor se devuelve todo el historial. Si el cursor es posterior al del servidor
+    (p. ej. tras reiniciar la sesión) también se devuelve todo y se marca `reset`.
+    """
+    reset = since is not None and since > agent.cursor
+    if since is None or reset:
+        since = 0
+    return {"messages": [_client_message(m) for m in agent.messages_since(since)], "cursor": agent.cursor, "reset": reset}
+
+
+def _parse_since(payload):
+    try:
+        return int(payload.get("since")) if payload.get("since") is not None else None
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Campo 'since' debe ser un entero")
+
+
+def _last_assistant(agent):
+    """Devuelve el contenido del último mensaje 'assistant' con texto (o None)."""
+    for m in reversed(agent.messages):
+        if m.get("role") == "assistant" and m.get("content"):
+            return m.get("content")
+    return None
+
 
+def _set_model(agent, model):
+    """Fija en el agente el modelo de la sesión con los metadatos del catálogo (contexto y max_tokens)."""
+    info = backends.info(model)
+    agent.set_model(model, context_tokens=info.get("context_length"), max_tokens=info["max_tokens"])
+    return info["max_tokens"]
+
+
+async def _add_user_prompt(agent, prompt):
+    """Añade el prompt del usuario al historial gestionando confirmaciones pendientes.
+
+    Devuelve True si el usuario canceló un comando pendiente (no hay que llamar al modelo).
+    """
     # Manejar confirmaciones pendientes para comandos destructivos
     if getattr(agent, 'pending_confirmation', None):
         user_reply = prompt.strip().lower()
         # Respuestas afirmativas
         if user_reply in ("si", "sí", "si.", "sí.", "yes", "y"):
             # Guardar el mensaje del usuario
-            agent.messages.append({"role": "user", "content": prompt})
+            agent.add_message({"role": "user", "content": prompt})
             pending = agent.pending_confirmation.get("command")
             # Ejecutar el comando pendiente indicando que ya fue confirmado internamente
-            result = agent.handle_tool_call("execute_terminal_command", {"command": pending, "_confirmed": True})
+            result = await agent.handle_tool_call_async("execute_terminal_command", {"command": pending, "_confirmed": True})
             # Asegurar que pending queda limpio para evitar bucles
             agent.pending_confirmation = None
 
-            header = f"== execute_terminal_command ==\n"
-            params = json.dumps({"command": pending}, ensure_ascii=False, indent=2)
-            content = header + f"Parámetros: {params}\n" + (result if isinstance(result, str) else json.dumps(result, ensure_ascii=False))
-            agent.messages.append({"role": "tool", "content": content, "display_as": "code", "tool_calls": [{"type": "function", "function": {"name": "execute_terminal_command", "arguments": json.dumps({"command": pending}, ensure_ascii=False)}}]})
+            agent.add_tool_result("execute_terminal_command", {"command": pending}, result)
         elif user_reply in ("no", "n", "no.", "n."):
             # Cancelar la operación
             agent.pending_confirmation = None
-            agent.messages.append({"role": "user", "content": prompt})
-            agent.messages.append({"role": "assistant", "content": "Operación cancelada por el usuario."})
-            # Responder de forma inmediata sin llamar al modelo
-            filtered_messages = [m for m in agent.messages if m.get("role") != "system"]
-            return JSONResponse({"ok": True, "model": MODEL, "response": "Operación cancelada por el usuario.", "messages": filtered_messages})
+            agent.add_message({"role": "user", "content": prompt})
+            agent.add_message({"role": "assistant", "content": "Operación cancelada por el usuario."})
+            return True
         else:
             # No es una confirmación clara; tratar como mensaje normal y enviarlo al modelo
-            agent.messages.append({"role": "user", "content": prompt})
+            agent.add_message({"role": "user", "content": prompt})
     else:
         # Añadir mensaje de usuario
-        agent.messages.append({"role": "user", "content": prompt})
+        agent.add_message({"role": "user", "content": prompt})
+    return False
 
-    # Llamadas repetidas si el modelo invoca herramientas
-    last_assistant = None
-    try:
+
+def _opens_conversation(agent):
+    """True si el siguiente prompt abre la conversación (sin turnos previos ni confirmación pendiente):
+    solo esas respuestas no dependen del historial y se pueden servir desde la caché de respuestas."""
+    return agent.pending_confirmation is None and not any(m.get("role") == "user" for m in agent.messages)
+
+
+def _cached_answer(agent, model, prompt, payload):
+    """Responde desde la caché de respuestas si procede (`no_cache` en el payload la salta).
+    Devuelve la marca para el cliente (`kind`, `similarity`, `age`, `prompt`) o None."""
+    if not response_cache.enabled or (payload or {}).get("no_cache") or not _opens_conversation(agent):
+        return None
+    hit = response_cache.get(prompt, model, context=prompt_context(agent.messages[0], agent.tools))
+    if hit is None:
+        return None
+    agent.add_message({"role": "user", "content": prompt})
+    agent.add_message({"role": "assistant", "content": hit["answer"]})
+    print(f"♻️ Respuesta servida desde la caché de respuestas ({hit['kind']}, hace {hit['age']}s)")
+    return {key: hit[key] for key in ("kind", "similarity", "age", "prompt")}
+
+
+def _remember_answer(agent, model, prompt, generation):
+    """Guarda en la caché de respuestas el turno que abrió la conversación (si es cacheable)."""
+    if agent.pending_confirmation is not None:
+        return
+    start = next((i for i, m in enumerate(agent.messages) if m.get("role") == "user"), None)
+    if start is None or agent.messages[start].get("content") != prompt:
+        # El historial se recortó a mitad de turno: no se sabe qué herramientas usó
+        return
+    response_cache.put(prompt, model, _last_assistant(agent), generation, agent.messages[start + 1:],
+                       context=prompt_context(agent.messages[0], agent.tools))
+
+
+async def _cancel_on_disconnect(request: Request, coro):
+    """Ejecuta `coro` y la cancela (matando los comandos en curso) si el cliente se desconecta."""
+    task = asyncio.create_task(coro)
+    while True:
+        done, _ = await asyncio.wait({task}, timeout=0.5)
+        if done:
+            return task.result()
+        if await request.is_disconnected():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            raise HTTPException(status_code=499, detail="Cliente desconectado")
+
+
+@asynccontextmanager
+async def _turn(endpoint, session):
+    """Mide un turno completo (incluida la espera al lock de la sesión). El id de traza lo fija el
+    endpoint antes de crear la tarea del turno, para que la serialización de la respuesta lo comparta."""
+    async with scheduler.admit():
+        metrics.trace("turn_start", endpoint=endpoint, session=session.id, model=session.model)
+        turns_in_flight[endpoint] += 1
+        try:
+            with metrics.span("turn", endpoint=endpoint):
+                yield
+            metrics.inc("agent_turns_total", endpoint=endpoint)
+        finally:
+            turns_in_flight[endpoint] -= 1
+
+
+async def _create_completion(session_id, model, messages, tools, max_tokens, stream=False):
+    """Llamada al modelo medida como span `llm` (en streaming, hasta recibir la respuesta HTTP).
+    El pool elige el backend (el de la sesión si puede) y reintenta en otro si falla."""
+    extra = {"stream": True, "stream_options": {"include_usage": True}} if stream and STREAM_USAGE else {"stream": stream}
+    metrics.inc("agent_llm_requests_total", model=model, stream=stream)
+    with metrics.span("llm", model=model, stream=stream):
+        return await backends.create(
+            session_id,
+            model=model,
+            messages=messages,
+            tools=tools,
+            temperature=0.7,
+            max_tokens=max_tokens,
+            **extra,
+        )
+
+
+async def _complete(session, max_tokens, on_event=None):
+    """Una llamada al modelo dentro de un hueco del planificador. Con `on_event` se hace en streaming:
+    se emiten `queued` (posición en cola) y `token`, y se devuelve la respuesta ya consumida. Las
+    herramientas se ejecutan después, fuera del hueco, para no ocupar el backend mientras tanto."""
+    agent = session.agent
+    stream = on_event is not None
+
+    def on_position(position, waiting):
+        on_event({"type": "queued", "position": position, "waiting": waiting})
+
+    async with scheduler.slot(session.id, on_position=on_position if stream else None):
+        response = await _create_completion(session.id, session.model, agent.messages, agent.tools, max_tokens, stream=stream)
+        if stream:
+            response = await agent.read_stream_async(response, on_event=on_event)
+    return response
+
+
+async def _chat_turn(session, prompt, since=None, payload=None):
+    """Un turno completo de conversación: prompt del usuario + loop de tool-calls."""
+    # Las peticiones de una misma sesión se serializan; sesiones distintas corren en paralelo
+    async with _turn("chat", session), session.lock:
+        agent = session.agent
+        max_tokens = _set_model(agent, session.model)
+        cached = _cached_answer(agent, session.model, prompt, payload)
+        if cached is not None:
+            return {"ok": True, "model": session.model, "response": _last_assistant(agent), "cached": cached, **_history(agent, since)}
+        cacheable = response_cache.enabled and _opens_conversation(agent)
+        generation = tool_cache.generation
+        if await _add_user_prompt(agent, prompt):
+            # Responder de forma inmediata sin llamar al modelo
+            return {"ok": True, "model": session.model, "response": "Operación cancelada por el usuario.", **_history(agent, since)}
+
+        # Llamadas repetidas si el modelo invoca herramientas
         while True:
-            # Ajuste simple de max_tokens para modelos grandes
-            max_tokens = 2048 if "gemma" in MODEL.lower() or "gemma" in MODEL.lower() else 4000
-            response = client.chat.completions.create(
-                model=MODEL,
-                messages=agent.messages,
-                tools=agent.tools,
-                temperature=0.7,
-                max_tokens=max_tokens,
-            )
-
-            called_tool = agent.process_response(response)
+            response = await _complete(session, max_tokens)
+
+            called_tool = await agent.process_response_async(response)
             # Si no se llamó herramienta, la respuesta final ya está en agent.messages
             if not called_tool:
-                # Buscar último mensaje assistant
-                for m in reversed(agent.messages):
-                    if m.get("role") == "assistant" and m.get("content"):
-                        last_assistant = m.get("content")
-                        break
                 break
 
-        # Filtrar historial para enviar al cliente: eliminar 'system', combinar múltiples 'tool' en uno
-        filtered_messages = []
-        last_tool_msg = None
-        for msg in agent.messages:
-            if msg.get("role") == "system":
-                continue
-            elif msg.get("role") == "tool":
-                # Guardar el primer tool message; los posteriores se combinan
-                if last_tool_msg is None:
-                    last_tool_msg = msg.copy()
-                else:
-                    # Combinar contenido de múltiples tool messages
-                    last_tool_msg["content"] = last_tool_msg.get("content", "") + "\n\n" + msg.get("content", "")
-            else:
-                # Antes de añadir mensaje no-tool, agregar el tool pendiente
-                if last_tool_msg is not None:
-                    filtered_messages.append(last_tool_msg)
-                    last_tool_msg = None
-                filtered_messages.append(msg)
-        
-        # Agregar último tool message si existe
-        if last_tool_msg is not None:
-            filtered_messages.append(last_tool_msg)
-        
-        return JSONResponse({"ok": True, "model": MODEL, "response": last_assistant, "messages": filtered_messages})
+        if cacheable:
+            _remember_answer(agent, session.model, prompt, generation)
+        return {"ok": True, "model": session.model, "response": _last_assistant(agent), **_history(agent, since)}
+
+
+@APP.post("/api/chat")
+async def chat(payload: dict, request: Request):
+    """Enviar prompt y devolver la respuesta final. Mantiene el loop de tool-calls igual que main.py.
+
+    Payload: { "prompt": "...", "since": <cursor opcional> }. Con `since` solo se devuelven los
+    mensajes nuevos o modificados desde ese cursor; la respuesta incluye el nuevo `cursor`.
+    """
+    prompt = payload.get("prompt") if payload else None
+    if prompt is None:
+        raise HTTPException(status_code=400, detail="Campo 'prompt' requerido")
+    since = _parse_since(payload)
+
+    session = await _get_session_async(request)
+    metrics.new_trace()
+    try:
+        result = await _cancel_on_disconnect(request, _chat_turn(session, prompt, since, payload))
+        with metrics.span("serialize", endpoint="chat"):
+            response = JSONResponse(result)
+        return _with_session(response, session)
+    except HTTPException:
+        raise
+    except SchedulerBusy as e:
+        raise _busy(e)
     except Exception as e:
+        metrics.inc("agent_errors_total", source="chat")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def _sse(event):
+    """Serializa un evento del agente en formato Server-Sent Events."""
+    return f"event: {event.get('type', 'message')}\ndata: {json.dumps(event, ensure_ascii=False, default=str)}\n\n"
+
+
+@APP.post("/api/chat/stream")
+async def chat_stream(payload: dict, request: Request):
+    """Igual que /api/chat pero devuelve Server-Sent Events a medida que se generan.
+
+    Eventos: `queued` (posición en la cola del backend), `token` (fragmento de texto),
+    `tool_start`/`tool_end` (ejecución de herramientas), `assistant` (respuesta completa de un paso),
+    `done` (respuesta final + mensajes desde `since`) y `error`.
+    Si el cliente se desconecta, el turno se cancela y se matan los comandos en curso.
+    """
+    prompt = payload.get("prompt") if payload else None
+    if prompt is None:
+        raise HTTPException(status_code=400, detail="Campo 'prompt' requerido")
+    since = _parse_since(payload)
+
+    session = await _get_session_async(request)
+    agent = session.agent
+    # Rechazar antes de abrir el stream si no se admiten más turnos (el cliente recibe un 429 normal)
+    try:
+        scheduler.check()
+    except SchedulerBusy as e:
+        raise _busy(e)
+
+    async def run(events):
+        try:
+            async with _turn("stream", session), session.lock:
+                max_tokens = _set_model(agent, session.model)
+                cached = _cached_answer(agent, session.model, prompt, payload)
+                if cached is not None:
+                    events.put_nowait({"type": "done", "model": session.model, "response": _last_assistant(agent), "cached": cached, **_history(agent, since)})
+                    return
+                cacheable = response_cache.enabled and _opens_conversation(agent)
+                generation = tool_cache.generation
+                if await _add_user_prompt(agent, prompt):
+                    events.put_nowait({"type": "done", "model": session.model, "response": "Operación cancelada por el usuario.", **_history(agent, since)})
+                    return
+                while True:
+                    response = await _complete(session, max_tokens, on_event=events.put_nowait)
+                    called_tool = await agent.process_response_async(response, on_event=events.put_nowait)
+                    if not called_tool:
+                        break
+                if cacheable:
+                    _remember_answer(agent, session.model, prompt, generation)
+                events.put_nowait({"type": "done", "model": session.model, "response": _last_assistant(agent), **_history(agent, since)})
+        except asyncio.CancelledError:
+            raise
+        except SchedulerBusy as e:
+            events.put_nowait({"type": "error", "detail": str(e), "status": 429})
+        except Exception as e:
+            metrics.inc("agent_errors_total", source="chat_stream")
+            events.put_nowait({"type": "error", "detail": str(e)})
+        finally:
+            # Marca de fin para cerrar el stream HTTP
+            events.put_nowait(None)
+
+    async def event_source():
+        events = asyncio.Queue()
+        metrics.new_trace()
+        # El loop del agente corre en su propia tarea y los eventos se reenvían por la cola
+        task = asyncio.create_task(run(events))
+        try:
+            while True:
+                event = await events.get()
+                if event is None:
+                    break
+                if event.get("type") == "tool_end" and len(event.get("output") or "") > UI_INLINE_BYTES:
+                    # Salidas grandes: solo la cabeza; la completa llega con el historial del evento `done`
+                    output = event["output"]
+                    event = {**event, "output": _preview(output), "output_size": len(output.encode("utf-8")),
+                             "output_truncated": True}
+                if event.get("type") == "done":
+                    # El evento final lleva el historial nuevo: es el que cuesta serializar
+                    with metrics.span("serialize", endpoint="stream"):
+                        data = _sse(event)
+                    yield data
+                else:
+                    yield _sse(event)
+        finally:
+            # Cliente desconectado antes de terminar: cancelar el turno
+            if not task.done():
+                task.cancel()
+
+    return _with_session(StreamingResponse(
+        event_source(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    ), session)
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run("server:APP", host="0.0.0.0", port=8000, reload=True)
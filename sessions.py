@@ -0,0 +1,157 @@
+import asyncio
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from agent import Agent
+
+
+class Session:
+    """Estado de una sesión: su propio `Agent`, el modelo activo y un lock para serializar sus peticiones."""
+
+    def __init__(self, session_id, model, store=None):
+        self.id = session_id
+        self.model = model
+        self.agent = Agent()
+        # También sin almacén: identifica los trabajos en segundo plano de la sesión (ver jobs.py)
+        self.agent.session_id = session_id
+        if store is not None:
+            self.agent.attach_store(store, session_id)
+        # asyncio.Lock: las peticiones de la sesión se serializan sin bloquear el event loop
+        self.lock = asyncio.Lock()
+        self.created_at = time.time()
+        self.last_used = self.created_at
+
+    def size_bytes(self):
+        """Tamaño aproximado del historial (suma de los contenidos de los mensajes)."""
+        total = 0
+        for m in self.agent.messages:
+            content = m.get("content")
+            if content:
+                total += len(content) if isinstance(content, str) else len(str(content))
+        return total
+
+
+class SessionManager:
+    """Almacén de sesiones con expiración por inactividad (TTL) y desalojo LRU.
+
+    - `max_sessions`: número máximo de sesiones vivas.
+    - `ttl`: segundos de inactividad tras los que una sesión se descarta.
+    - `max_bytes`: límite aproximado de memoria (suma de historiales) antes de desalojar las menos usadas.
+    - `store`: `ConversationStore` opcional; las sesiones que no están en memoria (desalojadas o
+      tras reiniciar el servidor) se reanudan desde él con la cola de la conversación.
+    Las sesiones con una petición en curso (lock tomado) nunca se desalojan.
+    """
+
+    def __init__(self, default_model, max_sessions=None, ttl=None, max_bytes=None, store=None):
+        self.default_model = default_model
+        self.store = store
+        self.max_sessions = max_sessions or int(os.environ.get("AGENT_MAX_SESSIONS", "100"))
+        self.ttl = ttl or float(os.environ.get("AGENT_SESSION_TTL", "3600"))
+        self.max_bytes = max_bytes or int(os.environ.get("AGENT_SESSION_MAX_BYTES", str(256 * 1024 * 1024)))
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    @staticmethod
+    def new_id():
+        return uuid.uuid4().hex
+
+    def get(self, session_id=None):
+        """Devuelve la sesión `session_id` y la marca como usada.
+
+        Solo se aceptan identificadores que emitió el servidor (en memoria o en el almacén); uno
+        desconocido no se adopta y se crea una sesión nueva con un id aleatorio, así el id (uuid4)
+        sirve de credencial y un cliente no puede elegirlo. Puede bloquear (reanudar lee SQLite y
+        espera a la cola de escritura): desde el event loop hay que llamarlo en un hilo.
+        """
+        now = time.time()
+        with self._lock:
+            session = self._sessions.get(session_id) if session_id else None
+            if session is not None and now - session.last_used > self.ttl and not session.lock.locked():
+                del self._sessions[session_id]
+                self.evictions += 1
+                session.agent.close()
+                session = None
+            if session is not None:
+                return self._touch(session, now)
+        # La lectura del almacén y la creación del Agent se hacen sin el lock: otras sesiones no esperan
+        created = self._resume(session_id) if session_id and self.store is not None else None
+        if created is None:
+            created = Session(self.new_id(), self.default_model, self.store)
+        with self._lock:
+            # Otra petición pudo reanudar la misma sesión mientras tanto
+            session = self._sessions.get(created.id)
+            if session is None:
+                session = created
+            else:
+                created.agent.close()
+            return self._touch(session, now)
+
+    def _touch(self, session, now):
+        # Con el lock tomado
+        self._sessions[session.id] = session
+        session.last_used = now
+        self._sessions.move_to_end(session.id)
+        self._evict(now)
+        return session
+
+    def _resume(self, session_id):
+        """Reconstruye una sesión guardada cargando solo lo que cabe en el contexto de su modelo."""
+        # Lo último de la sesión (p. ej. recién desalojada) puede estar aún en la cola de escritura o en
+        # el lote que el escritor está guardando (`pending` ya no lo cuenta): esperar siempre
+        self.store.flush()
+        info = self.store.session(session_id)
+        if info is None:
+            return None
+        session = Session(session_id, info["model"] or self.default_model, self.store)
+        session.agent.set_model(session.model)
+        _, entries = self.store.load_tail(session_id, session.agent.context.budget())
+        session.agent.restore_history(entries)
+        session.agent._seq = max(session.agent.cursor, info["last_seq"])
+        print(f"💾 Sesión {session_id[:8]} reanudada: {len(entries)} mensajes ({session.model})")
+        return session
+
+    def drop(self, session_id):
+        """Elimina una sesión explícitamente. Devuelve True si existía."""
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+        if session is None:
+            return False
+        session.agent.close()
+        return True
+
+    def _evict(self, now):
+        # 1) Sesiones inactivas más allá del TTL
+        for sid, s in list(self._sessions.items()):
+            if now - s.last_used > self.ttl and not s.lock.locked():
+                del self._sessions[sid]
+                self.evictions += 1
+                s.agent.close()
+
+        # 2) LRU por número de sesiones y por memoria; se recorre de la menos a la más reciente
+        #    y nunca se desaloja la última (la que acaba de pedirse)
+        total_bytes = sum(s.size_bytes() for s in self._sessions.values())
+        for sid in list(self._sessions.keys())[:-1]:
+            if len(self._sessions) <= self.max_sessions and total_bytes <= self.max_bytes:
+                break
+            s = self._sessions[sid]
+            if s.lock.locked():
+                continue
+            total_bytes -= s.size_bytes()
+            del self._sessions[sid]
+            self.evictions += 1
+            s.agent.close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "max_sessions": self.max_sessions,
+                "ttl": self.ttl,
+                "bytes": sum(s.size_bytes() for s in self._sessions.values()),
+                "max_bytes": self.max_bytes,
+                "evictions": self.evictions,
+            }
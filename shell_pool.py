@@ -0,0 +1,288 @@
+import os
+import platform
+import re
+import selectors
+import shlex
+import shutil
+import signal
+import subprocess
+import threading
+import time
+import uuid
+
+from resource_limits import command_limits
+
+
+# Número de shells calientes que se mantienen abiertos (igual que el paralelismo de herramientas por defecto)
+POOL_SIZE = int(os.environ.get("AGENT_SHELL_POOL_SIZE", "4"))
+# Comandos que ejecuta un shell antes de reciclarlo (evita acumular estado o fugas del propio bash)
+MAX_USES = int(os.environ.get("AGENT_SHELL_MAX_USES", "200"))
+# Tiempo máximo para arrancar un shell (lectura de /etc/profile y scripts de login)
+SPAWN_TIMEOUT = 30
+# Salida de `times`: dos líneas "XmY.YYYs XmY.YYYs" (el separador decimal depende del locale)
+_TIMES = rb"(\d+)m([\d.,]+)s (\d+)m([\d.,]+)s\n(\d+)m([\d.,]+)s (\d+)m([\d.,]+)s\n"
+
+
+class ShellUnavailable(Exception):
+    """No se pudo arrancar un shell del pool; el llamante usa el modo de un proceso por comando."""
+
+
+class ShellWorker:
+    """Un `bash -l` de larga duración que ejecuta comandos enviados por stdin.
+
+    Cada comando se envía con `eval` (el texto llega intacto, entre comillas simples) y va seguido
+    de un centinela aleatorio con el código de salida en stdout y otro en stderr, que marcan el
+    final de su salida; justo antes se imprime `times`, cuya diferencia con la del comando anterior
+    es su tiempo de CPU (`last_cpu`). En modo aislado (por defecto) el comando corre en un subshell
+    `( ... )`, así cwd, variables y `exit` no afectan al siguiente comando; en modo persistente corre
+    en el propio shell y `cd`/`export` se conservan entre llamadas.
+    """
+
+    def __init__(self, persistent=False):
+        self.persistent = persistent
+        self.token = f"__AGENT_DONE_{uuid.uuid4().hex}__".encode()
+        self._done_out = re.compile(rb"\n" + _TIMES + self.token + rb" (-?\d+)\n")
+        self._done_err = b"\n" + self.token + b"\n"
+        self.uses = 0
+        # Segundos de CPU del último comando (None si no se pudieron medir) y total acumulado del shell
+        self.last_cpu = None
+        self._cpu_total = 0.0
+        self.lock = threading.Lock()
+        # Nueva sesión: el grupo de procesos del shell incluye a todos los comandos que lance, que
+        # heredan sus límites (nice, ionice, rlimits y cgroup; ver resource_limits.py)
+        self.process = subprocess.Popen(
+            command_limits.argv(["bash", "-l", "-s"]),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            **command_limits.popen_kwargs(),
+        )
+        command_limits.attach(self.process)
+        try:
+            # Descartar lo que impriman los scripts de login hasta el primer centinela
+            self._send(":")
+            self._collect(None, None, time.monotonic() + SPAWN_TIMEOUT)
+        except (OSError, subprocess.TimeoutExpired, ShellUnavailable) as e:
+            self.close()
+            raise ShellUnavailable(f"no se pudo arrancar bash: {e}")
+
+    @property
+    def alive(self):
+        return self.process.poll() is None
+
+    def _send(self, script):
+        trailer = (f"__agent_rc=$?; printf '\\n'; builtin times; "
+                   f"printf '%s %s\\n' {self.token.decode()} \"$__agent_rc\"; "
+                   f"printf '\\n%s\\n' {self.token.decode()} >&2\n")
+        self.process.stdin.write((script + "\n" + trailer).encode())
+        self.process.stdin.flush()
+
+    def run(self, command, timeout, stdout_capture, stderr_capture):
+        """Ejecuta `command` volcando su salida en las capturas. Devuelve el código de salida.
+
+        Si se agota `timeout` se mata el grupo de procesos del shell (el pool lo recicla) y se
+        lanza `subprocess.TimeoutExpired`.
+        """
+        with self.lock:
+            self.uses += 1
+            self.last_cpu = None
+            body = f"eval {shlex.quote(command)} </dev/null"
+            self._send(body if self.persistent else f"( {body} )")
+            return self._collect(stdout_capture, stderr_capture, time.monotonic() + timeout, command, timeout)
+
+    def _collect(self, stdout_capture, stderr_capture, deadline, command=None, timeout=None):
+        # Lee stdout y stderr hasta ver ambos centinelas. Se retiene el final de cada buffer
+        # (lo que podría ser un centinela a medias) hasta saber que no lo es.
+        keep = len(self.token) + 128
+        pending = {self.process.stdout: bytearray(), self.process.stderr: bytearray()}
+        captures = {self.process.stdout: stdout_capture, self.process.stderr: stderr_capture}
+        return_code = None
+        open_streams = 2
+
+        with selectors.DefaultSelector() as selector:
+            for stream in pending:
+                selector.register(stream, selectors.EVENT_READ)
+            while open_streams:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.kill()
+                    raise subprocess.TimeoutExpired(command or "bash", timeout or SPAWN_TIMEOUT)
+                for key, _ in selector.select(timeout=remaining):
+                    stream = key.fileobj
+                    data = os.read(stream.fileno(), 65536)
+                    buf = pending[stream]
+                    capture = captures[stream]
+                    if not data:
+                        # El shell terminó sin centinela (p. ej. `kill $$` o `exit` en modo persistente)
+                        selector.unregister(stream)
+                        open_streams -= 1
+                        if capture is not None:
+                            capture.feed(bytes(buf))
+                        buf.clear()
+                        continue
+                    buf += data
+                    if stream is self.process.stdout:
+                        match = self._done_out.search(buf)
+                        end = match.start() if match else -1
+                        if match:
+                            return_code = int(match.group(9))
+                            self._account_cpu(match)
+                    else:
+                        end = buf.find(self._done_err)
+                    if end >= 0:
+                        if capture is not None:
+                            capture.feed(bytes(buf[:end]))
+                        selector.unregister(stream)
+                        open_streams -= 1
+                    elif len(buf) > keep:
+                        if capture is not None:
+                            capture.feed(bytes(buf[:-keep]))
+                        del buf[:-keep]
+
+        if return_code is None:
+            self.kill()
+            if command is None:
+                raise ShellUnavailable("el shell terminó durante el arranque")
+            if stderr_capture is not None:
+                stderr_capture.feed("\n[el shell del pool terminó inesperadamente]".encode())
+            return_code = self.process.returncode if self.process.returncode is not None else -1
+        return return_code
+
+    def _account_cpu(self, match):
+        # `times`: usuario y sistema del shell y de sus hijos ya esperados (en minutos y segundos)
+        values = match.groups()[:8]
+        total = sum(int(values[i]) * 60 + float(values[i + 1].replace(b",", b".")) for i in range(0, 8, 2))
+        self.last_cpu = max(0.0, total - self._cpu_total)
+        self._cpu_total = total
+
+    def kill(self):
+        """Mata el shell y todo su grupo de procesos (se puede llamar desde otro hilo durante `run`)."""
+        if self.process.poll() is None:
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except (ProcessLookupError, PermissionError):
+                self.process.kill()
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            pass
+
+    def close(self):
+        self.kill()
+        for stream in (self.process.stdin, self.process.stdout, self.process.stderr):
+            try:
+                stream.close()
+            except OSError:
+                pass
+
+
+class ShellPool:
+    """Pool de `ShellWorker` calientes para no pagar el arranque de `bash -lc` en cada comando.
+
+    - `size`: shells ociosos que se conservan (con `persistent=True`, número fijo de shells compartidos
+      por turnos, normalmente 1 por sesión para que se mantenga cwd y entorno).
+    - Los shells se reciclan tras `max_uses` comandos, un timeout o si mueren.
+    - Se desactiva con AGENT_SHELL_POOL=0; en Windows o sin `bash` nunca está activo.
+    """
+
+    def __init__(self, size=POOL_SIZE, max_uses=MAX_USES, persistent=False, enabled=None):
+        if enabled is None:
+            enabled = os.environ.get("AGENT_SHELL_POOL", "1").strip().lower() not in ("0", "false", "no")
+        self.enabled = bool(enabled) and not platform.system().lower().startswith("win") and shutil.which("bash") is not None
+        self.size = max(1, size)
+        self.max_uses = max_uses
+        self.persistent = persistent
+        self._idle = []
+        self._lock = threading.Lock()
+        # En modo persistente solo existen `size` shells: quien llega después espera su turno
+        self._slots = threading.Semaphore(self.size) if persistent else None
+        self.spawned = 0
+        self.recycled = 0
+        self.failures = 0
+
+    def acquire(self):
+        """Devuelve un shell libre (arrancando uno nuevo si no hay). Lanza ShellUnavailable."""
+        if not self.enabled:
+            raise ShellUnavailable("pool de shells desactivado")
+        if self._slots is not None:
+            self._slots.acquire()
+        with self._lock:
+            while self._idle:
+                worker = self._idle.pop()
+                if worker.alive:
+                    return worker
+        try:
+            worker = ShellWorker(persistent=self.persistent)
+        except ShellUnavailable:
+            if self._slots is not None:
+                self._slots.release()
+            with self._lock:
+                self.failures += 1
+            raise
+        with self._lock:
+            self.spawned += 1
+        return worker
+
+    def release(self, worker):
+        """Devuelve el shell al pool o lo cierra si está muerto, agotado o sobra."""
+        keep = self.enabled and worker.alive and worker.uses < self.max_uses
+        with self._lock:
+            if keep and len(self._idle) < self.size:
+                self._idle.append(worker)
+                worker = None
+            else:
+                self.recycled += 1
+        if worker is not None:
+            worker.close()
+        if self._slots is not None:
+            self._slots.release()
+
+    def run(self, command, timeout, stdout_capture, stderr_capture):
+        worker = self.acquire()
+        try:
+            return worker.run(command, timeout, stdout_capture, stderr_capture)
+        finally:
+            self.release(worker)
+
+    def warm(self, count=None):
+        """Arranca shells en segundo plano hasta tener `count` ociosos (por defecto, `size`)."""
+        if not self.enabled or self.persistent:
+            return
+
+        def spawn():
+            for _ in range(min(count or self.size, self.size) - len(self._idle)):
+                try:
+                    worker = ShellWorker()
+                except ShellUnavailable:
+                    with self._lock:
+                        self.failures += 1
+                    return
+                with self._lock:
+                    self.spawned += 1
+                    self._idle.append(worker)
+
+        threading.Thread(target=spawn, daemon=True).start()
+
+    def close(self):
+        """Cierra los shells ociosos; los que están en uso se cierran al liberarse."""
+        self.enabled = False
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for worker in idle:
+            worker.close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "persistent": self.persistent,
+                "idle": len(self._idle),
+                "size": self.size,
+                "spawned": self.spawned,
+                "recycled": self.recycled,
+                "failures": self.failures,
+            }
+
+
+# Pool compartido por todas las sesiones en modo aislado
+shell_pool = ShellPool()
@@ -148,32 +148,101 @@ function renderTextWithTables(text){
   return nodes;
 }
 
-// Render tool output with header, parameters (toggle), and output block
-function renderToolOutput(text){
-  const container = document.createElement('div');
-  container.className = 'tool-container';
+// Salidas a partir de este tamaño se muestran plegadas (con su tamaño) hasta que se expanden
+const COLLAPSE_BYTES = 2048;
+const COLLAPSE_LINES = 40;
+
+function formatBytes(n){
+  if(n < 1024) return `${n} B`;
+  if(n < 1024 * 1024) return `${(n / 1024).toFixed(1)} KB`;
+  return `${(n / 1024 / 1024).toFixed(1)} MB`;
+}
+
+function isLargeOutput(text, meta){
+  if(meta && meta.truncated) return true;
+  const size = (meta && meta.size) || text.length;
+  const lines = (meta && meta.lines) || text.split('\n').length;
+  return size >= COLLAPSE_BYTES || lines >= COLLAPSE_LINES;
+}
 
-  // Try to extract header and parameters
-  const headerMatch = text.match(/^==\s*(.+?)\s*==\n?/);
+// Separa la cabecera "== herramienta ==" y los parámetros del resto de la salida
+function splitToolText(text){
   let rest = text;
   let toolName = null;
+  let paramsText = null;
+  const headerMatch = rest.match(/^==\s*(.+?)\s*==\n?/);
   if(headerMatch){
     toolName = headerMatch[1];
-    rest = text.slice(headerMatch[0].length);
+    rest = rest.slice(headerMatch[0].length);
   }
-
-  const toolHeader = document.createElement('div');
-  toolHeader.className = 'tool-header';
-  toolHeader.textContent = toolName ? `Herramienta: ${toolName}` : 'Herramienta';
-  container.appendChild(toolHeader);
-
-  // buscar parámetros JSON al inicio
-  let paramsText = null;
   const paramsMatch = rest.match(/^Parámetros:\s*(\{[\s\S]*?\})\n?/);
   if(paramsMatch){
     paramsText = paramsMatch[1];
     rest = rest.slice(paramsMatch[0].length);
   }
+  return {toolName, paramsText, rest};
+}
+
+// Bloque de salida: si es grande, plegado con un botón que indica bytes y líneas.
+// Las salidas truncadas por el servidor (`meta.truncated`) se piden completas al expandirlas.
+function renderOutputBlock(rest, meta){
+  const outPre = document.createElement('pre');
+  outPre.className = 'code-block';
+  const size = (meta && meta.size) || new Blob([rest]).size;
+  const lines = (meta && meta.lines) || rest.split('\n').length;
+  const item = meta && meta.item;
+  if(!isLargeOutput(rest, meta)){
+    outPre.textContent = rest.trim();
+    return outPre;
+  }
+  const wrapper = document.createElement('div');
+  const toggle = document.createElement('button');
+  toggle.className = 'output-toggle';
+  const label = `salida (${formatBytes(size)}, ${lines} líneas)`;
+  const show = async ()=>{
+    if(item) item.expanded = true;
+    toggle.textContent = 'Ocultar ' + label;
+    outPre.style.display = 'block';
+    if(item && item.fullText !== undefined){
+      outPre.textContent = splitToolText(item.fullText).rest.trim();
+      return;
+    }
+    outPre.textContent = rest.trim();
+    if(meta.truncated && meta.id !== undefined){
+      outPre.textContent += '\n⏳ Cargando salida completa...';
+      try{
+        const data = await (await fetch(`/api/messages/${meta.id}`)).json();
+        if(item) item.fullText = data.content || '';
+        outPre.textContent = splitToolText(data.content || '').rest.trim();
+      }catch(e){
+        outPre.textContent = rest.trim() + '\n⚠️ No se pudo cargar la salida completa';
+      }
+    }
+  };
+  const hide = ()=>{
+    if(item) item.expanded = false;
+    toggle.textContent = 'Mostrar ' + label;
+    outPre.style.display = 'none';
+    outPre.textContent = '';
+  };
+  toggle.onclick = ()=> outPre.style.display === 'none' ? show() : hide();
+  wrapper.appendChild(toggle);
+  wrapper.appendChild(outPre);
+  if(item && item.expanded) show(); else hide();
+  return wrapper;
+}
+
+// Render tool output with header, parameters (toggle), and output block
+function renderToolOutput(text, meta){
+  const container = document.createElement('div');
+  container.className = 'tool-container';
+
+  const {toolName, paramsText, rest} = splitToolText(text);
+
+  const toolHeader = document.createElement('div');
+  toolHeader.className = 'tool-header';
+  toolHeader.textContent = toolName ? `Herramienta: ${toolName}` : 'Herramienta';
+  container.appendChild(toolHeader);
 
   if(paramsText){
     const paramsWrapper = document.createElement('div');
@@ -204,10 +273,7 @@ function renderToolOutput(text){
     container.appendChild(paramsWrapper);
   }
 
-  const outPre = document.createElement('pre');
-  outPre.className = 'code-block';
-  outPre.textContent = rest.trim();
-  container.appendChild(outPre);
+  container.appendChild(renderOutputBlock(rest, meta));
 
   return container;
 }
@@ -222,10 +288,35 @@ function isCodeLike(text){
   return false;
 }
 
-function appendMessage(role, text, displayAs){
-  const log = document.getElementById('chatLog');
-  const el = document.createElement('div');
-  el.className = 'msg ' + role;
+// Virtualización del historial: los mensajes lejos de la zona visible se vacían (se queda un hueco
+// con su altura medida) y se vuelven a construir al acercarse, así el DOM no crece con la sesión
+const VIRTUAL_MARGIN = '1500px 0px';
+let virtualizer = null;
+
+function getVirtualizer(){
+  if(virtualizer || typeof IntersectionObserver === 'undefined') return virtualizer;
+  virtualizer = new IntersectionObserver(entries => {
+    entries.forEach(entry => {
+      const el = entry.target;
+      if(entry.isIntersecting){
+        if(el.dataset.virtual){
+          delete el.dataset.virtual;
+          el.style.height = '';
+          fillMessage(el, el._item);
+        }
+      } else if(!el.dataset.virtual && el.isConnected && el.offsetHeight && !provisional.includes(el)){
+        el.style.height = el.offsetHeight + 'px';
+        el.dataset.virtual = '1';
+        el.replaceChildren();
+      }
+    });
+  }, {root: document.getElementById('chatLog'), rootMargin: VIRTUAL_MARGIN});
+  return virtualizer;
+}
+
+// Construye el contenido (rol + cuerpo) de un mensaje a partir de su descripción
+function fillMessage(el, item){
+  const {role, text, displayAs} = item;
   const roleEl = document.createElement('div');
   roleEl.className = 'role';
   roleEl.textContent = role;
@@ -239,7 +330,7 @@ function appendMessage(role, text, displayAs){
   const isTypingIndicator = (role === 'assistant' && String(text).trim() === '...');
 
   // If text contains a pipe table, render text and tables preserving surrounding text
-  if(isPipeTable(text)){
+  if(isPipeTable(text) && !(role === 'tool' && isLargeOutput(text, item.meta))){
     const nodes = renderTextWithTables(text);
     if(nodes && nodes.length){
       nodes.forEach(n => bodyEl.appendChild(n));
@@ -248,7 +339,7 @@ function appendMessage(role, text, displayAs){
     }
   } else if(shouldRenderAsCode){
     if(role === 'tool'){
-      const toolNode = renderToolOutput(text);
+      const toolNode = renderToolOutput(text, {...(item.meta || {}), item});
       bodyEl.appendChild(toolNode);
     } else {
       const pre = document.createElement('pre');
@@ -272,13 +363,277 @@ function appendMessage(role, text, displayAs){
     }
   }
 
-  el.appendChild(roleEl);
-  el.appendChild(bodyEl);
+  el.replaceChildren(roleEl, bodyEl);
+  // Respuesta servida desde la caché de respuestas del servidor (ver response_cache.py)
+  const cached = item.meta && item.meta.cached;
+  if(cached){
+    const note = document.createElement('div');
+    note.className = 'cache-note';
+    note.textContent = `♻️ Respuesta de caché (hace ${Math.round(cached.age)} s` +
+      (cached.kind === 'near' ? `, pregunta parecida: «${cached.prompt}»)` : ')');
+    el.appendChild(note);
+  }
+}
+
+// Crea el elemento de un mensaje (sin añadirlo al log). `meta`: {id, size, lines, truncated} del servidor
+function createMessage(role, text, displayAs, meta){
+  const el = document.createElement('div');
+  el.className = 'msg ' + role;
+  el._item = {role, text: String(text ?? ''), displayAs, meta};
+  fillMessage(el, el._item);
+  const observer = getVirtualizer();
+  if(observer) observer.observe(el);
+  return el;
+}
+
+function appendMessage(role, text, displayAs, meta){
+  const log = document.getElementById('chatLog');
+  const el = createMessage(role, text, displayAs, meta);
   log.appendChild(el);
-  // Debug: indicar que se añadió un mensaje
-  try{ console.log('appendMessage:', role, text); }catch(e){}
   // Defer scrolling para asegurar que el navegador ha renderizado el nuevo contenido
   ensureScrollToBottom(log);
+  return el;
+}
+
+function removeMessage(el){
+  if(virtualizer) virtualizer.unobserve(el);
+  el.remove();
+}
+
+// Sustituye un mensaje ya renderizado por uno nuevo (misma posición en el log)
+function replaceMessage(el, role, text, displayAs, meta){
+  const fresh = createMessage(role, text, displayAs, meta);
+  if(el && el.parentNode){
+    // Conservar el estado de la salida (expandida o no) del mensaje sustituido
+    if(el._item && el._item.expanded) fresh._item.expanded = true;
+    if(virtualizer) virtualizer.unobserve(el);
+    el.parentNode.replaceChild(fresh, el);
+    if(fresh._item.expanded) fillMessage(fresh, fresh._item);
+  } else {
+    document.getElementById('chatLog').appendChild(fresh);
+  }
+  return fresh;
+}
+
+// Estado del historial incremental: cursor del servidor y mensajes ya renderizados por id
+let cursor = null;
+const rendered = new Map();
+// Elementos temporales (prompt local, tokens, herramientas en curso) hasta que llega el historial
+let provisional = [];
+
+function appendProvisional(role, text, displayAs){
+  const el = appendMessage(role, text, displayAs);
+  provisional.push(el);
+  return el;
+}
+
+function clearProvisional(){
+  provisional.forEach(removeMessage);
+  provisional = [];
+}
+
+function resetHistory(newCursor){
+  if(virtualizer) virtualizer.disconnect();
+  document.getElementById('chatLog').innerHTML = '';
+  rendered.clear();
+  provisional = [];
+  cursor = (typeof newCursor === 'number') ? newCursor : null;
+}
+
+// Aplica los mensajes nuevos/modificados devueltos por el servidor (salta el system)
+function applyHistory(data){
+  clearProvisional();
+  if(data.reset) resetHistory();
+  const log = document.getElementById('chatLog');
+  // Solo se construyen los mensajes nuevos (por id) y se añaden de una vez
+  const fragment = document.createDocumentFragment();
+  // Si la respuesta salió de la caché se marca el último mensaje del asistente
+  const answers = (data.messages || []).filter(m => m.role === 'assistant');
+  const cachedId = data.cached && answers.length ? answers[answers.length - 1].id : undefined;
+  (data.messages || []).forEach(m => {
+    if(!m.role || m.role === 'system') return;
+    const text = m.content || (m.text||'');
+    const meta = {id: m.id, size: m.size, lines: m.lines, truncated: m.truncated, cached: cachedId !== undefined && m.id === cachedId ? data.cached : undefined};
+    const prev = rendered.get(m.id);
+    // Un mensaje ya renderizado (p. ej. tool combinado) se sustituye en su sitio
+    const el = prev && prev.isConnected ? replaceMessage(prev, m.role, text, m.display_as, meta) : createMessage(m.role, text, m.display_as, meta);
+    if(!el.parentNode) fragment.appendChild(el);
+    if(m.id !== undefined) rendered.set(m.id, el);
+  });
+  log.appendChild(fragment);
+  if(typeof data.cursor === 'number') cursor = data.cursor;
+  // asegurar scroll al final tras renderizado completo
+  requestAnimationFrame(()=>{ const last = log.lastElementChild; if(last) last.scrollIntoView({behavior:'auto', block:'end'}); else log.scrollTop = log.scrollHeight; });
+}
+
+// Al cargar la página se recupera la conversación de la sesión (solo se construye lo visible)
+async function loadHistory(){
+  try{
+    const res = await fetch('/api/messages');
+    if(res.ok) applyHistory(await res.json());
+  }catch(e){}
+}
+
+function chatBody(prompt){
+  return JSON.stringify(cursor === null ? {prompt} : {prompt, since: cursor});
+}
+
+function toolText(ev, output){
+  const params = ev.args && Object.keys(ev.args).length ? `Parámetros: ${JSON.stringify(ev.args)}\n` : '';
+  return `== ${ev.name} ==\n${params}${output}`;
+}
+
+// Consume el endpoint SSE /api/chat/stream y despacha cada evento a su handler
+async function streamChat(prompt, handlers){
+  const res = await fetch('/api/chat/stream', {method:'POST', headers:{'Content-Type':'application/json'}, body: chatBody(prompt)});
+  if(res.status === 429){
+    // Servidor saturado: no reintentar por el endpoint clásico (también respondería 429)
+    const data = await res.json().catch(()=>({}));
+    const err = new Error(data.detail || 'Servidor ocupado');
+    err.busy = true;
+    throw err;
+  }
+  if(!res.ok || !res.body) throw new Error('HTTP ' + res.status);
+  const reader = res.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  while(true){
+    const {value, done} = await reader.read();
+    if(done) break;
+    buffer += decoder.decode(value, {stream:true});
+    // Los eventos SSE van separados por una línea en blanco
+    let idx;
+    while((idx = buffer.indexOf('\n\n')) !== -1){
+      const frame = buffer.slice(0, idx);
+      buffer = buffer.slice(idx + 2);
+      const data = frame.split('\n').filter(l => l.startsWith('data:')).map(l => l.slice(5).trimStart()).join('\n');
+      if(!data) continue;
+      let ev;
+      try{ ev = JSON.parse(data); }catch(e){ continue; }
+      const handler = handlers[ev.type];
+      if(handler) handler(ev);
+    }
+  }
+}
+
+async function sendPromptBlocking(prompt){
+  console.debug('fetch /api/chat', prompt);
+  const res = await fetch('/api/chat', {method:'POST', headers:{'Content-Type':'application/json'}, body: chatBody(prompt)});
+  const data = await res.json();
+  console.debug('response /api/chat', data);
+  applyHistory(data);
+}
+
+async function sendPromptStream(prompt){
+  // Burbuja del asistente que se va rellenando con los tokens
+  let bubble = appendProvisional('assistant','...');
+  let text = '';
+  // Herramientas en curso por índice de llamada (pueden terminar en cualquier orden)
+  const toolEls = {};
+  let running = 0;
+  let received = false;
+  try{
+    await streamChat(prompt, {
+      queued: ev => {
+        // Esperando turno en el backend: mostrar la posición en la cola
+        if(!bubble) bubble = appendProvisional('assistant', '');
+        bubble.querySelector('.text').textContent = `⏳ En cola (posición ${ev.position} de ${ev.waiting})`;
+      },
+      token: ev => {
+        received = true;
+        if(!bubble) bubble = appendProvisional('assistant', '');
+        text += ev.content;
+        bubble.querySelector('.text').innerHTML = escapeHtml(text).replace(/\n/g,'<br>');
+        ensureScrollToBottom(document.getElementById('chatLog'));
+      },
+      tool_start: ev => {
+        received = true;
+        // Si no llegó texto antes de la herramienta, quitar el indicador de escritura
+        if(bubble && !text) removeMessage(bubble);
+        bubble = null; text = '';
+        toolEls[ev.index] = appendProvisional('tool', toolText(ev, '⏳ Ejecutando...'), 'code');
+        running++;
+      },
+      tool_end: ev => {
+        const status = ev.status && ev.status !== 'ok' ? `[${ev.status}] ` : '';
+        const meta = ev.output_truncated ? {size: ev.output_size, truncated: true} : undefined;
+        toolEls[ev.index] = replaceMessage(toolEls[ev.index], 'tool', toolText(ev, status + (ev.output || '')), 'code', meta);
+        provisional.push(toolEls[ev.index]);
+        if((ev.output || '').includes("job_id='")) watchJobs();
+        running = Math.max(0, running - 1);
+        // Cuando terminan todas las herramientas, el modelo vuelve a generar
+        if(running === 0) bubble = appendProvisional('assistant','...');
+      },
+      done: ev => { received = true; applyHistory(ev); },
+      error: ev => { received = true; clearProvisional(); appendMessage('assistant', 'Error: ' + (ev.detail || 'desconocido')); },
+    });
+  }catch(e){
+    if(bubble) removeMessage(bubble);
+    if(e.busy){
+      // El servidor no guardó el prompt: devolverlo a la caja de texto para reenviarlo
+      clearProvisional();
+      document.getElementById('prompt').value = prompt;
+      appendMessage('assistant', '⏳ ' + e.message + '. Inténtalo de nuevo en unos segundos.');
+      return;
+    }
+    // Si el servidor no soporta streaming, usar el endpoint clásico
+    if(!received){
+      bubble = appendProvisional('assistant','...');
+      return sendPromptBlocking(prompt);
+    }
+    throw e;
+  }
+}
+
+// Comandos en segundo plano: se sigue la salida de cada uno por offset (solo llega lo nuevo)
+const jobTails = {};
+let jobsTimer = null;
+
+async function refreshJobs(){
+  jobsTimer = null;
+  let jobs = [];
+  try{
+    const res = await fetch('/api/jobs');
+    if(res.ok) jobs = (await res.json()).jobs || [];
+  }catch(e){ return; }
+  for(const job of jobs){
+    const tail = jobTails[job.job_id] || (jobTails[job.job_id] = {offset: null, line: ''});
+    if(tail.offset !== null && tail.offset >= job.output_bytes) continue;
+    try{
+      const q = tail.offset === null ? '?lines=1' : `?offset=${tail.offset}`;
+      const data = await (await fetch(`/api/jobs/${job.job_id}${q}`)).json();
+      const lines = (data.output || '').split('\n').filter(l => l.trim());
+      if(lines.length) tail.line = lines[lines.length - 1];
+      tail.offset = data.next_offset;
+    }catch(e){}
+  }
+  renderJobs(jobs);
+  if(jobs.some(j => j.status === 'running')) jobsTimer = setTimeout(refreshJobs, 2000);
+}
+
+function watchJobs(){
+  if(!jobsTimer) jobsTimer = setTimeout(refreshJobs, 500);
+}
+
+function renderJobs(jobs){
+  const panel = document.getElementById('jobsPanel');
+  panel.hidden = !jobs.length;
+  panel.innerHTML = jobs.slice().reverse().map(j => `
+    <div class="job" data-id="${j.job_id}">
+      <span class="job-status">${j.status === 'running' ? '🕒' : j.status === 'done' ? '✓' : '⚠️'} ${escapeHtml(j.status)}</span>
+      <span class="job-command" title="${escapeHtml(j.command)}">${escapeHtml(j.command)}</span>
+      <span class="job-tail">${escapeHtml((jobTails[j.job_id] || {}).line || '')}</span>
+      <span>${Math.round(j.elapsed)}s</span>
+      ${j.status === 'running' ? '<button class="job-cancel">Cancelar</button>' : ''}
+    </div>`).join('');
+  panel.querySelectorAll('.job-cancel').forEach(btn => {
+    btn.onclick = async ()=>{
+      const id = btn.closest('.job').dataset.id;
+      btn.disabled = true;
+      try{ await fetch(`/api/jobs/${id}/cancel`, {method:'POST'}); }catch(e){}
+      refreshJobs();
+    };
+  });
 }
 
 function ensureScrollToBottom(log){
@@ -307,25 +662,15 @@ function ensureScrollToBottom(log){
 
 document.addEventListener('DOMContentLoaded', ()=>{
   fetchModels();
+  loadHistory();
+  refreshJobs();
   document.getElementById('sendBtn').onclick = async ()=>{
     const prompt = document.getElementById('prompt').value.trim();
     if(!prompt) return;
-    appendMessage('user', prompt);
+    appendProvisional('user', prompt);
     document.getElementById('prompt').value = '';
-    appendMessage('assistant','...');
     try{
-      console.debug('fetch /api/chat', prompt);
-      const res = await fetch('/api/chat', {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify({prompt})});
-      const data = await res.json();
-      console.debug('response /api/chat', data);
-      // Re-renderizar todo el historial devuelto por el servidor (salta el system)
-      const log = document.getElementById('chatLog');
-      log.innerHTML = '';
-      (data.messages || []).forEach(m => {
-        if(m.role && m.role !== 'system') appendMessage(m.role, m.content || (m.text||''), m.display_as);
-      });
-      // asegurar scroll al final tras renderizado completo
-      requestAnimationFrame(()=>{ const log = document.getElementById('chatLog'); const last = log.lastElementChild; if(last) last.scrollIntoView({behavior:'auto', block:'end'}); else log.scrollTop = log.scrollHeight; });
+      await sendPromptStream(prompt);
     }catch(e){
       console.error('fetch /api/chat error', e);
       appendMessage('assistant','Error al contactar con servidor');
@@ -339,6 +684,7 @@ document.addEventListener('DOMContentLoaded', ()=>{
     try{
       const res = await fetch('/api/model',{method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify({model})});
       const data = await res.json();
+      if(data.cleared_history) resetHistory(data.cursor);
       alert('Modelo cambiado a: '+data.model);
     }catch(e){
       alert('Error al cambiar modelo');
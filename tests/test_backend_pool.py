@@ -0,0 +1,133 @@
+import asyncio
+import gc
+import time
+
+import pytest
+
+from backend_pool import BackendPool
+
+
+class FakeStream:
+    def __init__(self, chunks, fail_at=None):
+        self.chunks = chunks
+        self.fail_at = fail_at
+        self.closed = False
+
+    def __iter__(self):
+        for i, chunk in enumerate(self.chunks):
+            if i == self.fail_at:
+                raise ConnectionError("cortado")
+            yield chunk
+
+    async def _agen(self):
+        for chunk in self.chunks:
+            await asyncio.sleep(0.01)
+            yield chunk
+
+    def __aiter__(self):
+        return self._agen()
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def pool():
+    pool = BackendPool(urls=["http://127.0.0.1:1/v1"], probe_interval=0)
+    return pool, pool.backends[0]
+
+
+def _tracked(pool, backend, stream):
+    # Simula lo que hace `_begin` antes de la llamada; otra petición en curso queda aparte
+    backend.outstanding = 2
+    return pool._finish(backend, stream, time.perf_counter(), True)
+
+
+def test_full_iteration_releases_once(pool):
+    pool, backend = pool
+    tracked = _tracked(pool, backend, FakeStream([1, 2, 3]))
+    assert list(tracked) == [1, 2, 3]
+    tracked.close()
+    assert backend.outstanding == 1
+
+
+def test_error_mid_stream_releases(pool):
+    pool, backend = pool
+    tracked = _tracked(pool, backend, FakeStream([1, 2, 3], fail_at=1))
+    with pytest.raises(ConnectionError):
+        list(tracked)
+    assert backend.outstanding == 1
+
+
+def test_close_after_break_releases_and_closes(pool):
+    pool, backend = pool
+    stream = FakeStream([1, 2, 3])
+    with _tracked(pool, backend, stream) as tracked:
+        for _ in tracked:
+            break
+    assert stream.closed
+    assert backend.outstanding == 1
+
+
+def test_abandoned_stream_released_on_gc(pool):
+    pool, backend = pool
+    tracked = _tracked(pool, backend, FakeStream([1, 2, 3]))
+    next(iter(tracked))
+    del tracked
+    gc.collect()
+    assert backend.outstanding == 1
+
+
+def test_cancelled_async_read_releases(pool):
+    pool, backend = pool
+    tracked = _tracked(pool, backend, FakeStream(list(range(100))))
+
+    async def consume():
+        async for _ in tracked:
+            pass
+
+    async def main():
+        task = asyncio.create_task(consume())
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+    assert backend.outstanding == 1
+
+
+def test_cancelled_create_releases(pool):
+    pool, backend = pool
+    started = asyncio.Event()
+
+    async def pending(**kwargs):
+        started.set()
+        await asyncio.sleep(60)
+
+    completions = type("Completions", (), {"create": staticmethod(pending)})()
+    backend._async_client = type("Client", (), {"chat": type("Chat", (), {"completions": completions})()})()
+
+    async def main():
+        task = asyncio.create_task(pool.create(model="m", messages=[]))
+        await started.wait()
+        assert backend.outstanding == 1
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+    assert backend.outstanding == 0
+
+
+def test_interrupted_create_sync_releases(pool):
+    pool, backend = pool
+
+    def interrupted(**kwargs):
+        raise KeyboardInterrupt
+
+    completions = type("Completions", (), {"create": staticmethod(interrupted)})()
+    backend._sync_client = type("Client", (), {"chat": type("Chat", (), {"completions": completions})()})()
+    with pytest.raises(KeyboardInterrupt):
+        pool.create_sync(model="m", messages=[])
+    assert backend.outstanding == 0
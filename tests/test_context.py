@@ -0,0 +1,77 @@
+import pytest
+
+from context import SUMMARY_MARKER, ContextManager, estimate_tokens
+
+SYSTEM = {"role": "system", "content": "Eres un asistente de sistemas."}
+
+
+def _turn(i, output_chars=400):
+    return [
+        {"role": "user", "content": f"pregunta {i}"},
+        {"role": "tool", "content": f"salida {i} " + "x" * output_chars,
+         "tool_calls": [{"type": "function", "function": {"name": "execute_terminal_command", "arguments": "{}"}}]},
+        {"role": "assistant", "content": f"respuesta {i}"},
+    ]
+
+
+@pytest.fixture
+def context(monkeypatch):
+    monkeypatch.delenv("AGENT_CONTEXT_TOKENS", raising=False)
+    context = ContextManager(tokenizer=estimate_tokens, reserve_tokens=0, tool_output_tokens=64)
+    context.set_model("modelo", 2000)
+    return context
+
+
+def _grow(context, messages, turns, start=0):
+    for i in range(start, start + turns):
+        for message in _turn(i):
+            messages.append(message)
+            messages = context.fit(messages)
+    return messages
+
+
+def test_system_prompt_and_latest_turn_survive(context):
+    messages = _grow(context, [dict(SYSTEM)], 40)
+    assert context.compactions >= 1
+    assert context.count(messages) <= context.budget()
+    assert messages[0]["role"] == "system"
+    assert messages[0]["content"].startswith(SYSTEM["content"] + SUMMARY_MARKER)
+    assert [m["content"] for m in messages[-3:]][0] == "pregunta 39"
+    assert messages[-1]["content"] == "respuesta 39"
+
+
+def test_whole_turns_are_dropped(context):
+    messages = _grow(context, [dict(SYSTEM)], 40)
+    rest = messages[1:]
+    # Tras el sistema siempre empieza un turno y cada turno conserva user → tool → assistant
+    assert len(rest) % 3 == 0
+    for i in range(0, len(rest), 3):
+        assert [m["role"] for m in rest[i:i + 3]] == ["user", "tool", "assistant"]
+        number = rest[i]["content"].split()[-1]
+        assert rest[i + 1]["content"].startswith(f"salida {number} ")
+        assert rest[i + 2]["content"] == f"respuesta {number}"
+
+
+def test_summary_block_is_stable_between_compactions(context):
+    messages = _grow(context, [dict(SYSTEM)], 40)
+    compactions, system = context.compactions, messages[0]
+    changes = context.prefix_changes
+    # Un turno más que cabe en el hueco dejado: el prefijo (sistema + resumen incluido) no cambia
+    messages = _grow(context, messages, 1, start=40)
+    assert context.compactions == compactions
+    assert messages[0] is system
+    assert context.prefix_changes == changes
+    assert "- «pregunta 0» → execute_terminal_command" in system["content"]
+
+
+def test_compaction_leaves_headroom(context):
+    messages = _grow(context, [dict(SYSTEM)], 40)
+    # Se compacta hasta compact_target del presupuesto, no justo hasta caber
+    assert context.compactions < 40 // 2
+    assert context.prefix_changes == context.compactions
+
+
+def test_reset_drops_summary(context):
+    messages = _grow(context, [dict(SYSTEM)], 40)
+    assert context.reset(messages[0])["content"] == SYSTEM["content"]
+    assert context.summary == [] and context.summarized_turns == 0
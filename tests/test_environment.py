@@ -0,0 +1,35 @@
+import time
+
+import environment as environment_module
+from environment import EnvironmentSnapshot
+
+
+def test_schedule_refreshes_periodically(monkeypatch):
+    calls = []
+    monkeypatch.setattr(environment_module, "collect", lambda: calls.append(1) or {"n": len(calls)})
+    snapshot = EnvironmentSnapshot(refresh=0.05)
+    snapshot.start()
+    snapshot.schedule()
+    try:
+        assert snapshot.get(timeout=1) is not None
+        deadline = time.monotonic() + 2
+        while snapshot.collections < 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        # Sin que nadie la pida, el hilo la ha recogido de nuevo
+        assert snapshot.collections >= 3
+    finally:
+        snapshot.stop()
+
+
+def test_stale_snapshot_is_served_while_refreshing(monkeypatch):
+    monkeypatch.setattr(environment_module, "collect", lambda: {"t": time.monotonic()})
+    snapshot = EnvironmentSnapshot(refresh=0)
+    first = snapshot.get(timeout=1)
+    slow = lambda: time.sleep(0.3) or {"t": "nuevo"}
+    monkeypatch.setattr(environment_module, "collect", slow)
+    started = time.monotonic()
+    assert snapshot.get() is first
+    assert time.monotonic() - started < 0.1
+    # refresh <= 0: sin hilo periódico
+    snapshot.schedule()
+    assert snapshot._thread is None
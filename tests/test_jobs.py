@@ -0,0 +1,60 @@
+import os
+import stat
+
+import pytest
+
+from jobs import JobManager, is_long_running
+
+
+@pytest.mark.parametrize("command", [
+    "make",
+    "make -j8 all",
+    "sudo make install",
+    "cd src && make -C build",
+    "ninja -C out",
+    "./configure --prefix=/usr",
+    "wget https://example.com/x.tar.gz",
+    "wget -q -O x.tgz example.com/x.tgz",
+    "rsync -avz src/ host:dst/",
+    "scp file host:",
+    "apt-get install -y curl",
+    "pip3 install requests",
+    "sleep 60",
+])
+def test_long_running(command):
+    assert is_long_running(command)
+
+
+@pytest.mark.parametrize("command", [
+    "make --version",
+    "make -v",
+    "make -n",
+    "make -j4 --dry-run install",
+    "make --help",
+    "ninja --version",
+    "ninja -t targets",
+    "mvn -v",
+    "./configure --help",
+    "wget --version",
+    "wget -V",
+    "wget",
+    "rsync --version",
+    "rsync -avn src/ dst/",
+    "rsync --dry-run -a src/ dst/",
+    "scp",
+    "pip install --help",
+    "sleep 5",
+    "ls -la",
+])
+def test_quick_commands_stay_in_foreground(command):
+    assert not is_long_running(command)
+
+
+def test_job_dir_and_log_are_private(tmp_path):
+    directory = str(tmp_path / "jobs")
+    manager = JobManager(directory=directory)
+    job = manager.start("echo hola")
+    assert job.done.wait(10)
+    assert stat.S_IMODE(os.stat(directory).st_mode) == 0o700
+    assert stat.S_IMODE(os.stat(job.log_path).st_mode) == 0o600
+    manager.close()
@@ -0,0 +1,102 @@
+import asyncio
+import os
+import tempfile
+
+import pytest
+
+from llm_scheduler import LLMScheduler, SchedulerBusy
+
+
+def test_round_robin_between_sessions():
+    served = []
+
+    async def call(scheduler, session_id, hold=0.01):
+        async with scheduler.slot(session_id):
+            served.append(session_id)
+            await asyncio.sleep(hold)
+
+    async def main():
+        scheduler = LLMScheduler(concurrency=1, max_queue=10)
+        first = asyncio.create_task(call(scheduler, "a", hold=0.05))
+        await asyncio.sleep(0)
+        # "a" encadena varias llamadas antes de que "b" y "c" lleguen a la cola
+        tasks = [asyncio.create_task(call(scheduler, "a")) for _ in range(3)]
+        await asyncio.sleep(0)
+        tasks += [asyncio.create_task(call(scheduler, "b")), asyncio.create_task(call(scheduler, "c"))]
+        await asyncio.sleep(0)
+        assert scheduler.position("b") == 1 and scheduler.position("c") == 2
+        await asyncio.gather(first, *tasks)
+        assert scheduler.active == 0 and scheduler.waiting == 0
+
+    asyncio.run(main())
+    # FIFO sería a, a, a, a, b, c: las sesiones que no se han atendido pasan delante
+    assert served == ["a", "b", "c", "a", "a", "a"]
+
+
+def test_queue_full_rejects_new_turns():
+    async def main():
+        scheduler = LLMScheduler(concurrency=1, max_queue=1)
+        release = asyncio.Event()
+
+        async def turn():
+            async with scheduler.admit():
+                await release.wait()
+
+        running = [asyncio.create_task(turn()) for _ in range(2)]
+        await asyncio.sleep(0)
+        assert scheduler.full
+        with pytest.raises(SchedulerBusy) as busy:
+            async with scheduler.admit():
+                pass
+        assert busy.value.retry_after > 0
+        assert scheduler.stats()["rejected"] == 1
+        release.set()
+        await asyncio.gather(*running)
+        # Al terminar los turnos en curso se vuelve a admitir
+        async with scheduler.admit():
+            assert scheduler.turns == 1
+
+    asyncio.run(main())
+
+
+def test_cancelled_waiter_leaves_queue():
+    async def main():
+        scheduler = LLMScheduler(concurrency=1, max_queue=4)
+        positions = []
+        gate = asyncio.Event()
+
+        async def hold():
+            async with scheduler.slot("a"):
+                await gate.wait()
+
+        async def wait():
+            async with scheduler.slot("b", on_position=lambda position, total: positions.append(position)):
+                pass
+
+        holder = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(wait())
+        await asyncio.sleep(0)
+        assert positions == [1] and scheduler.waiting == 1
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert scheduler.waiting == 0
+        gate.set()
+        await holder
+        assert scheduler.active == 0
+
+    asyncio.run(main())
+
+
+def test_server_answers_429_when_full(monkeypatch):
+    os.environ.setdefault("AGENT_STORE_PATH", os.path.join(tempfile.mkdtemp(), "conversations.db"))
+    from fastapi.testclient import TestClient
+    import server
+
+    monkeypatch.setattr(server.scheduler, "turns", server.scheduler.concurrency + server.scheduler.max_queue)
+    with TestClient(server.APP) as client:
+        for endpoint in ("/api/chat", "/api/chat/stream"):
+            response = client.post(endpoint, json={"prompt": "hola"})
+            assert response.status_code == 429, endpoint
+            assert int(response.headers["Retry-After"]) > 0
@@ -0,0 +1,61 @@
+import os
+import stat
+
+import pytest
+
+from output_store import BoundedCapture, OutputStore, private_directory
+
+
+def _capture(store, lines):
+    capture = BoundedCapture(store=store, max_bytes=256, max_lines=10)
+    for i in range(lines):
+        capture.feed(f"linea {i:05d}\n".encode())
+    capture.close()
+    return capture
+
+
+def test_private_directory_is_0700(tmp_path):
+    path = str(tmp_path / "salidas")
+    os.makedirs(path, mode=0o755)
+    os.chmod(path, 0o755)
+    private_directory(path)
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o700
+
+
+def test_private_directory_rejects_symlink(tmp_path):
+    os.makedirs(tmp_path / "real")
+    os.symlink(tmp_path / "real", tmp_path / "enlace")
+    with pytest.raises(OSError):
+        private_directory(str(tmp_path / "enlace"))
+
+
+def test_spilled_output_is_private_and_paged(tmp_path):
+    store = OutputStore(directory=str(tmp_path / "out"))
+    capture = _capture(store, 100)
+    assert capture.truncated
+    assert stat.S_IMODE(os.stat(capture._path).st_mode) == 0o600
+    page = store.read(capture.output_id, offset=95, limit=10)
+    assert "de 100" in page and page.endswith("linea 00099")
+
+
+def test_file_capped_at_max_file_bytes(tmp_path):
+    store = OutputStore(directory=str(tmp_path / "out"), max_file_bytes=1000)
+    capture = _capture(store, 500)
+    assert os.path.getsize(capture._path) <= 1000
+    meta = store.info(capture.output_id)
+    assert meta["lines"] == 1000 // 12
+    # La última página guardada no promete más líneas
+    last = store.read(capture.output_id, offset=meta["lines"] - 1)
+    assert "continúa" not in last
+    assert "Guardadas solo las primeras" in capture.text()
+    # La cola en memoria sigue llegando hasta el final
+    assert capture.text().endswith("linea 00499\n")
+
+
+def test_total_bytes_evicts_oldest(tmp_path):
+    store = OutputStore(directory=str(tmp_path / "out"), max_total_bytes=2500)
+    captures = [_capture(store, 100) for _ in range(3)]
+    assert store.info(captures[0].output_id) is None
+    assert not os.path.exists(captures[0]._path)
+    assert store.info(captures[-1].output_id) is not None
+    assert sum(os.path.getsize(c._path) for c in captures[1:]) <= 2500
@@ -0,0 +1,86 @@
+import asyncio
+import json
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from agent import Agent
+
+# Segundos que tarda cada comando falso: el primero es el más lento
+DELAYS = {"echo uno": 0.3, "echo dos": 0.15, "echo tres": 0.0}
+
+
+def _response(*commands):
+    calls = [SimpleNamespace(id=f"call_{i}", type="function",
+                             function=SimpleNamespace(name="execute_terminal_command",
+                                                      arguments=json.dumps({"command": command})))
+             for i, command in enumerate(commands)]
+    message = SimpleNamespace(content=None, tool_calls=calls)
+    return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+
+
+@pytest.fixture
+def agent(monkeypatch):
+    agent = Agent()
+    agent.ran = []
+
+    def run_tool(name, args):
+        time.sleep(DELAYS.get(args["command"], 0))
+        agent.ran.append(args["command"])
+        return f"salida de {args['command']}"
+
+    async def run_tool_async(name, args):
+        await asyncio.sleep(DELAYS.get(args["command"], 0))
+        agent.ran.append(args["command"])
+        return f"salida de {args['command']}"
+
+    monkeypatch.setattr(agent, "_run_tool", run_tool)
+    monkeypatch.setattr(agent, "_run_tool_async", run_tool_async)
+    return agent
+
+
+def _process(agent, response, use_async, events):
+    if use_async:
+        return asyncio.run(agent.process_response_async(response, on_event=events.append))
+    return agent.process_response(response, on_event=events.append)
+
+
+@pytest.mark.parametrize("use_async", [False, True])
+def test_results_keep_call_order(agent, use_async):
+    events = []
+    started = time.perf_counter()
+    assert _process(agent, _response("echo uno", "echo dos", "echo tres"), use_async, events) is True
+    elapsed = time.perf_counter() - started
+    # En paralelo: terminan en orden inverso y el total es el del más lento
+    assert agent.ran == ["echo tres", "echo dos", "echo uno"]
+    assert elapsed < 0.4
+    content = agent.messages[-1]["content"]
+    positions = [content.index(f"salida de echo {n}") for n in ("uno", "dos", "tres")]
+    assert positions == sorted(positions)
+    calls = [json.loads(call["function"]["arguments"])["command"] for call in agent.messages[-1]["tool_calls"]]
+    assert calls == ["echo uno", "echo dos", "echo tres"]
+    assert [e["index"] for e in events if e["type"] == "tool_end"] == [2, 1, 0]
+
+
+@pytest.mark.parametrize("use_async", [False, True])
+def test_calls_after_unconfirmed_destructive_are_skipped(agent, use_async):
+    events = []
+    _process(agent, _response("echo uno", "rm -rf /tmp/x", "echo tres"), use_async, events)
+    # Solo se ejecuta lo anterior al comando destructivo; lo posterior ni se lanza
+    assert agent.ran == ["echo uno"]
+    assert agent.pending_confirmation["command"] == "rm -rf /tmp/x"
+    status = {e["index"]: e["status"] for e in events if e["type"] == "tool_end"}
+    assert status == {0: "ok", 1: "confirmation", 2: "skipped"}
+    assert "omitida" in agent.messages[-1]["content"]
+
+
+def test_plan_marks_only_calls_before_the_gate_runnable():
+    agent = Agent()
+    steps = agent._plan_execution([
+        {"name": "execute_terminal_command", "args": {"command": "ls"}, "raw": "{}"},
+        {"name": "execute_terminal_command", "args": {"command": "sudo reboot"}, "raw": "{}"},
+        {"name": "execute_terminal_command", "args": {"command": "ls -la"}, "raw": "{}"},
+        {"name": "no_existe", "args": {}, "raw": "{}"},
+    ])
+    assert [st["status"] for st in steps] == [None, "confirmation", "skipped", "skipped"]
@@ -0,0 +1,84 @@
+import os
+import signal
+import subprocess
+
+import pytest
+
+from resource_limits import CommandLimits, usage_from_rusage, wait_with_usage
+
+posix_only = pytest.mark.skipif(os.name != "posix", reason="límites POSIX")
+
+
+def limits(**kwargs):
+    kwargs.setdefault("cgroup", False)
+    return CommandLimits(**kwargs)
+
+
+@posix_only
+def test_limit_hit_from_returncode():
+    cl = limits(cpu_seconds=1)
+    assert cl.limit_hit(-signal.SIGXCPU) == "cpu"
+    assert cl.limit_hit(128 + signal.SIGXCPU) == "cpu"
+    assert cl.limit_hit(0) is None
+    assert cl.limit_hit(-signal.SIGKILL) is None
+
+
+@posix_only
+def test_sigkill_is_memory_only_after_oom_kill(tmp_path):
+    cl = limits(memory_mb=100)
+    cl.cgroup, cl.cgroup_memory = str(tmp_path), True
+    (tmp_path / "memory.events").write_text("low 0\nhigh 0\nmax 3\noom 1\noom_kill 1\n")
+    cl._oom_kills = 1
+    # Un `kill -9` o el timeout no suben oom_kill
+    assert cl.limit_hit(-signal.SIGKILL) is None
+    (tmp_path / "memory.events").write_text("low 0\nhigh 0\nmax 4\noom 2\noom_kill 2\n")
+    assert cl.limit_hit(137) == "memory"
+    assert cl.limit_hit(137) is None
+
+
+def test_account_and_describe_thresholds():
+    cl = limits(report_seconds=1.0)
+    fast = cl.account(0.05, 10, 0, cpu=0.01)
+    assert cl.describe(fast) == ""
+    slow = cl.account(2.5, 2048, 0, cpu=2.0, max_rss_kb=51200)
+    line = cl.describe(slow)
+    assert "2.5 s reales" in line and "2.0 s de CPU" in line and "50 MB" in line and "2.0 KB" in line
+    timed_out = cl.account(0.1, 0, None, timed_out=True)
+    assert timed_out["limit"] == "timeout"
+    stats = cl.stats()
+    assert stats["commands"] == 3 and stats["limited"] == 1 and stats["max_rss_mb"] == 50.0
+
+
+@posix_only
+def test_argv_wraps_without_preexec():
+    cl = limits(nice=10, cpu_seconds=5)
+    assert "preexec_fn" not in cl.popen_kwargs()
+    argv = cl.argv(["bash", "-lc", "true"])
+    assert argv[-3:] == ["bash", "-lc", "true"]
+    if cl._prlimit_bin:
+        assert "--cpu=5:10" in argv
+
+
+@posix_only
+def test_cpu_limit_kills_busy_loop_and_reports_usage():
+    cl = limits(cpu_seconds=1, nice=0, ionice=-1)
+    process = subprocess.Popen(cl.argv(["bash", "-c", "while :; do :; done"]), **cl.popen_kwargs())
+    cl.attach(process)
+    returncode, rusage = wait_with_usage(process, timeout=30, on_timeout=lambda: cl.kill_group(process))
+    cpu, max_rss_kb = usage_from_rusage(rusage)
+    assert cl.limit_hit(returncode) == "cpu"
+    # El kernel corta por RLIMIT_CPU con su propio reloj; rusage se muestrea por ticks y con la
+    # máquina cargada puede quedarse por debajo del segundo
+    assert cpu >= 0.5 and max_rss_kb > 0
+
+
+@pytest.mark.skipif(not os.path.isdir("/proc"), reason="necesita /proc")
+def test_timeout_kills_process_group():
+    cl = limits(nice=0, ionice=-1)
+    process = subprocess.Popen(["bash", "-c", "sleep 60 & sleep 60"], **cl.popen_kwargs())
+    with pytest.raises(subprocess.TimeoutExpired):
+        wait_with_usage(process, timeout=0.5, on_timeout=lambda: cl.kill_group(process))
+    # Ningún proceso del grupo sigue vivo (el `sleep` en segundo plano también murió)
+    alive = subprocess.run(["pgrep", "-g", str(process.pid)], capture_output=True, text=True).stdout.split()
+    states = [open(f"/proc/{pid}/stat").read().split(") ")[1][0] for pid in alive if os.path.exists(f"/proc/{pid}")]
+    assert all(state == "Z" for state in states)
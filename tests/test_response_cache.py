@@ -0,0 +1,89 @@
+import time
+
+import pytest
+
+import response_cache as response_cache_module
+from response_cache import ResponseCache, prompt_context
+from tool_cache import tool_cache
+
+SYSTEM = {"role": "system", "content": "Eres un asistente de sistemas."}
+TOOLS = [{"type": "function", "function": {"name": "execute_terminal_command"}}]
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    monkeypatch.setattr(response_cache_module, "environment_hash", lambda: "entorno")
+    return ResponseCache(enabled=True, ttl=60, similarity=0.9)
+
+
+def _put(cache, prompt, answer="respuesta", model="modelo", context=None, **kwargs):
+    return cache.put(prompt, model, answer, tool_cache.generation, context=context, **kwargs)
+
+
+def test_exact_hit_after_normalizing(cache):
+    assert _put(cache, "¿Qué sistema operativo tengo?")
+    hit = cache.get("que  sistema operativo TENGO", "modelo")
+    assert hit["kind"] == "exact" and hit["answer"] == "respuesta"
+
+
+def test_key_separates_model_environment_and_context(cache, monkeypatch):
+    context = prompt_context(SYSTEM, TOOLS)
+    _put(cache, "espacio en disco", context=context)
+    assert cache.get("espacio en disco", "modelo", context=context) is not None
+    assert cache.get("espacio en disco", "otro-modelo", context=context) is None
+    # Otro mensaje de sistema u otras herramientas: ni exacta ni parecida
+    other_system = prompt_context({"role": "system", "content": "Eres un pirata."}, TOOLS)
+    other_tools = prompt_context(SYSTEM, TOOLS + [{"type": "function", "function": {"name": "rm"}}])
+    assert len({context, other_system, other_tools}) == 3
+    assert cache.get("espacio en disco", "modelo", context=other_system) is None
+    assert cache.get("espacio en el disco", "modelo", context=other_tools) is None
+    monkeypatch.setattr(response_cache_module, "environment_hash", lambda: "otra-maquina")
+    assert cache.get("espacio en disco", "modelo", context=context) is None
+
+
+def test_similarity_threshold(cache):
+    _put(cache, "cuanta memoria ram tiene el equipo")
+    near = cache.get("cuanta memoria ram tiene el equipo ahora", "modelo")  # similitud 0.92
+    assert near["kind"] == "near" and 0.9 <= near["similarity"] < 1
+    assert cache.get("cuanta memoria ram tiene este equipo", "modelo") is None  # 0.89: por debajo
+    assert cache.get("que procesos usan mas memoria", "modelo") is None
+    # Misma pregunta con otra ruta: no es la misma pregunta
+    _put(cache, "espacio libre en /home")
+    assert cache.get("espacio libre en /var", "modelo") is None
+
+
+def test_similarity_zero_serves_only_exact(cache):
+    cache.similarity = 0
+    _put(cache, "cuanta memoria ram tiene el equipo")
+    assert cache.get("cuanta memoria ram tiene el equipo ahora", "modelo") is None
+
+
+def test_entries_expire(cache, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(response_cache_module.time, "monotonic", lambda: now[0])
+    _put(cache, "version del kernel")
+    now[0] += 59
+    assert cache.get("version del kernel", "modelo") is not None
+    now[0] += 2
+    assert cache.get("version del kernel", "modelo") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_shorter_command_ttl_wins(cache, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(response_cache_module.time, "monotonic", lambda: now[0])
+    turn = [{"role": "tool", "tool_calls": [{"function": {"name": "execute_terminal_command",
+                                                          "arguments": '{"command": "df -h"}'}}]}]
+    _put(cache, "espacio en disco", turn_messages=turn)
+    now[0] += 16
+    assert cache.get("espacio en disco", "modelo") is None
+
+
+def test_state_changing_command_invalidates(cache):
+    _put(cache, "usuarios conectados")
+    tool_cache.invalidate_commands()
+    assert cache.get("usuarios conectados", "modelo") is None
+    # Un turno que ejecutó algo que no es de solo lectura no se guarda
+    turn = [{"role": "tool", "tool_calls": [{"function": {"name": "execute_terminal_command",
+                                                          "arguments": '{"command": "touch x"}'}}]}]
+    assert not _put(cache, "crea x", turn_messages=turn)
@@ -0,0 +1,44 @@
+import os
+import tempfile
+
+import pytest
+
+
+@pytest.fixture(scope="module")
+def client():
+    # El almacén del servidor se crea al importar server.py: uno temporal para las pruebas
+    os.environ.setdefault("AGENT_STORE_PATH", os.path.join(tempfile.mkdtemp(), "conversations.db"))
+    from fastapi.testclient import TestClient
+    import server
+
+    with TestClient(server.APP) as c:
+        yield c, server
+
+
+def _new_session(c, server):
+    session = server.sessions.get()
+    session.agent.add_message({"role": "user", "content": f"hola {session.id[:4]}"})
+    server.store.flush()
+    return session.id
+
+
+def test_sessions_listing_is_scoped_to_caller(client):
+    c, server = client
+    mine, other = _new_session(c, server), _new_session(c, server)
+    listed = c.get("/api/sessions", headers={"X-Session-Id": mine}).json()["sessions"]
+    assert [s["id"] for s in listed] == [mine]
+    assert other not in c.get("/api/sessions").text
+
+
+def test_export_requires_own_session(client):
+    c, server = client
+    mine, other = _new_session(c, server), _new_session(c, server)
+    assert c.get(f"/api/sessions/{other}/export", headers={"X-Session-Id": mine}).status_code == 404
+    resp = c.get(f"/api/sessions/{mine}/export", headers={"X-Session-Id": mine})
+    assert resp.status_code == 200 and "hola" in resp.text
+
+
+def test_client_chosen_id_is_replaced(client):
+    c, _ = client
+    resp = c.get("/api/context", headers={"X-Session-Id": "mi-id"})
+    assert resp.headers["X-Session-Id"] != "mi-id"
@@ -0,0 +1,57 @@
+import threading
+
+import pytest
+
+from conversation_store import ConversationStore
+from sessions import SessionManager
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = ConversationStore(str(tmp_path / "conversations.db"))
+    yield store
+    store.close()
+
+
+def test_unknown_ids_are_not_adopted():
+    manager = SessionManager("modelo", max_sessions=10)
+    session = manager.get("elegido-por-el-cliente")
+    assert session.id != "elegido-por-el-cliente"
+    assert len(session.id) == 32
+    assert manager.get(session.id) is session
+
+
+def test_resume_from_store_after_eviction(store):
+    manager = SessionManager("modelo", max_sessions=10, store=store)
+    session = manager.get()
+    session.agent.add_message({"role": "user", "content": "hola"})
+    session.agent.add_message({"role": "assistant", "content": "buenas"})
+    assert manager.drop(session.id)
+
+    resumed = manager.get(session.id)
+    assert resumed is not session and resumed.id == session.id
+    contents = [m.get("content") for m in resumed.agent.messages if m["role"] != "system"]
+    assert contents == ["hola", "buenas"]
+
+
+def test_concurrent_resume_returns_one_session(store):
+    manager = SessionManager("modelo", max_sessions=10, store=store)
+    session = manager.get()
+    session.agent.add_message({"role": "user", "content": "hola"})
+    manager.drop(session.id)
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(manager.get(session.id))) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len({id(s) for s in results}) == 1
+    assert manager.stats()["sessions"] == 1
+
+
+def test_lru_eviction_keeps_latest():
+    manager = SessionManager("modelo", max_sessions=2)
+    ids = [manager.get().id for _ in range(3)]
+    assert manager.stats()["sessions"] == 2
+    assert ids[0] not in manager._sessions and ids[2] in manager._sessions
@@ -0,0 +1,72 @@
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+from output_store import BoundedCapture, OutputStore
+from shell_pool import ShellPool
+
+pytestmark = pytest.mark.skipif(sys.platform == "win32" or shutil.which("bash") is None, reason="necesita bash")
+
+
+@pytest.fixture
+def run(tmp_path):
+    store = OutputStore(directory=str(tmp_path / "out"))
+    pools = []
+
+    def run(pool, command, timeout=10):
+        if pool not in pools:
+            pools.append(pool)
+        out, err = BoundedCapture(store=store), BoundedCapture(store=store)
+        code = pool.run(command, timeout, out, err)
+        return code, out.text(), err.text()
+
+    yield run
+    for pool in pools:
+        pool.close()
+
+
+def test_commands_reuse_one_warm_shell(run):
+    pool = ShellPool(size=2, enabled=True)
+    assert run(pool, "echo hola; echo error >&2") == (0, "hola\n", "error\n")
+    assert run(pool, "printf 'sin salto'; exit 3") == (3, "sin salto", "")
+    assert run(pool, "echo __AGENT_DONE_falso__ 0")[1] == "__AGENT_DONE_falso__ 0\n"
+    assert pool.stats()["spawned"] == 1
+
+
+def test_isolated_mode_does_not_leak_state(run):
+    pool = ShellPool(size=1, enabled=True)
+    run(pool, "cd /tmp && export AGENT_X=1")
+    cwd, variable = run(pool, "pwd; echo \"x=$AGENT_X\"")[1].splitlines()
+    assert cwd != "/tmp" and variable == "x="
+
+
+def test_persistent_mode_keeps_cwd_and_env(run):
+    pool = ShellPool(size=1, persistent=True, enabled=True)
+    run(pool, "cd /tmp && export AGENT_X=1")
+    assert run(pool, "pwd; echo \"x=$AGENT_X\"")[1] == "/tmp\nx=1\n"
+
+
+def test_large_output_is_complete(run):
+    pool = ShellPool(size=1, enabled=True)
+    code, out, _ = run(pool, "seq 1 20000 | tail -n 3")
+    assert (code, out) == (0, "19998\n19999\n20000\n")
+    code, out, _ = run(pool, "head -c 300000 /dev/zero | tr '\\0' 'a'; echo")
+    assert code == 0 and "salida truncada: " in out
+
+
+def test_timeout_kills_and_recycles_the_shell(run):
+    pool = ShellPool(size=1, enabled=True)
+    with pytest.raises(subprocess.TimeoutExpired):
+        run(pool, "sleep 30", timeout=0.5)
+    assert run(pool, "echo sigue")[1] == "sigue\n"
+    stats = pool.stats()
+    assert stats["spawned"] == 2 and stats["recycled"] == 1
+
+
+def test_shell_recycled_after_max_uses(run):
+    pool = ShellPool(size=1, max_uses=2, enabled=True)
+    for _ in range(3):
+        assert run(pool, "true")[0] == 0
+    assert pool.stats()["spawned"] == 2
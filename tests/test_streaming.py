@@ -0,0 +1,63 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from agent import Agent
+
+
+def _chunk(content=None, tool_calls=None):
+    return SimpleNamespace(usage=None, choices=[SimpleNamespace(delta=SimpleNamespace(content=content, tool_calls=tool_calls))])
+
+
+def _tool_delta(index, id=None, name=None, arguments=None):
+    return SimpleNamespace(index=index, id=id, function=SimpleNamespace(name=name, arguments=arguments))
+
+
+class ClosingStream(list):
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_tokens_are_emitted_as_they_arrive():
+    agent, events = Agent(), []
+    stream = ClosingStream([_chunk("Hola"), _chunk(", "), _chunk("mundo")])
+    assert agent.process_stream(stream, on_event=events.append) is False
+    assert [e["content"] for e in events if e["type"] == "token"] == ["Hola", ", ", "mundo"]
+    assert events[-1] == {"type": "assistant", "content": "Hola, mundo"}
+    assert agent.messages[-1] == {"role": "assistant", "content": "Hola, mundo"}
+    assert stream.closed
+
+
+def test_tool_call_deltas_are_reassembled_and_run():
+    agent, events = Agent(), []
+    stream = ClosingStream([
+        _chunk(tool_calls=[_tool_delta(0, id="call_1", name="get_system_os", arguments='{"ref')]),
+        _chunk(tool_calls=[_tool_delta(0, arguments='resh": false}')]),
+    ])
+    assert agent.process_stream(stream, on_event=events.append) is True
+    kinds = [e["type"] for e in events]
+    assert kinds == ["tool_start", "tool_end"]
+    assert events[0]["name"] == "get_system_os" and events[0]["args"] == {"refresh": False}
+    assert events[1]["status"] == "ok"
+
+
+def test_async_read_closes_stream_on_error():
+    class Broken:
+        closed = False
+
+        def __aiter__(self):
+            return self
+
+        async def __anext__(self):
+            raise ConnectionError("cortado")
+
+        async def close(self):
+            self.closed = True
+
+    stream = Broken()
+    with pytest.raises(ConnectionError):
+        asyncio.run(Agent().read_stream_async(stream))
+    assert stream.closed
@@ -0,0 +1,90 @@
+import time
+
+import pytest
+
+from tool_cache import ToolCache, command_ttl
+
+
+@pytest.mark.parametrize("command,cacheable", [
+    ("uname -a", True),
+    ("df -h", True),
+    ("ls -la /var/log", True),
+    ("cat /etc/os-release", True),
+    ("ls > lista.txt", False),
+    ("echo $(rm x)", False),
+    ("sed -i s/a/b/ f", False),
+    ("rm -rf /tmp/x", False),
+    ("ls && touch x", False),
+    ("find . -name '*.log'", True),
+    ("find . -execdir rm {} +", False),
+    ("find . -ok rm {} ;", False),
+    ("find . -okdir rm {} ;", False),
+    ("find . -fprint lista.txt", False),
+    ("find . -fprint0 lista.txt", False),
+    ("find . -fls lista.txt", False),
+    ("sed -n '1,5p' f", True),
+    ("sed -n '/hello world/p' f", True),
+    ("sed -n 'w copia' f", False),
+    ("sed -n '/x/w copia' f", False),
+    ("sed -n 's/a/b/gw copia' f", False),
+    ("sed -n '1e rm x' f", False),
+    ("sed -n 's/.*/ls/e' f", False),
+])
+def test_command_ttl(command, cacheable):
+    assert bool(command_ttl(command)) == cacheable
+
+
+def test_key_includes_scope():
+    cache = ToolCache(enabled=True)
+    shared, _ = cache.key_for("execute_terminal_command", {"command": "ls"})
+    mine, _ = cache.key_for("execute_terminal_command", {"command": "ls"}, scope="shell-a")
+    other, _ = cache.key_for("execute_terminal_command", {"command": "ls"}, scope="shell-b")
+    assert len({shared, mine, other}) == 3
+    cache.put(mine, 10, "a.txt")
+    assert cache.get(mine) == "a.txt"
+    assert cache.get(other) is None and cache.get(shared) is None
+
+
+def test_normalized_whitespace_shares_key():
+    cache = ToolCache(enabled=True)
+    a, _ = cache.key_for("execute_terminal_command", {"command": "df  -h"})
+    b, _ = cache.key_for("execute_terminal_command", {"command": " df -h "})
+    assert a == b
+
+
+def test_invalidate_drops_commands_and_bumps_generation():
+    cache = ToolCache(enabled=True)
+    key, ttl = cache.key_for("execute_terminal_command", {"command": "uname -a"})
+    cache.put(key, ttl, "Linux")
+    generation = cache.generation
+    cache.invalidate_commands()
+    assert cache.get(key) is None
+    assert cache.generation == generation + 1
+
+
+def test_ttl_expiry_and_errors_not_cached():
+    cache = ToolCache(enabled=True)
+    key, _ = cache.key_for("execute_terminal_command", {"command": "ls"})
+    cache.put(key, 0.01, "a.txt")
+    time.sleep(0.02)
+    assert cache.get(key) is None
+    cache.put(key, 10, "Error (código 2): no existe")
+    assert cache.get(key) is None
+
+
+def test_background_commands_are_not_cached():
+    assert ToolCache(enabled=True).key_for("execute_terminal_command", {"command": "ls", "background": True}) == (None, None)
+
+
+def test_persistent_shell_agents_get_their_own_scope(monkeypatch):
+    from agent import Agent
+
+    monkeypatch.setenv("AGENT_SHELL_PERSISTENT", "1")
+    first, second = Agent(), Agent()
+    try:
+        assert first.cache_scope and second.cache_scope and first.cache_scope != second.cache_scope
+    finally:
+        first.close()
+        second.close()
+    monkeypatch.setenv("AGENT_SHELL_PERSISTENT", "0")
+    assert Agent().cache_scope is None
@@ -0,0 +1,51 @@
+from agent import Agent
+
+OUTPUT = "\n".join(f"proceso {i:03d} activo" for i in range(60))
+
+
+def _add(agent, command, output):
+    agent.add_tool_result("execute_terminal_command", {"command": command}, output)
+    return agent.messages[-1]
+
+
+def test_repeated_output_becomes_reference_and_first_copy_is_kept():
+    agent = Agent()
+    first = _add(agent, "ps", OUTPUT)
+    original = first["content"]
+    assert OUTPUT in original
+
+    second = _add(agent, "ps", OUTPUT)
+    assert OUTPUT not in second["content"]
+    assert "[Sin cambios" in second["content"]
+    # La primera copia sigue entera en el historial: es a la que apunta la referencia
+    assert first["content"] == original
+    assert any(m is first for m in agent.messages)
+
+    other = _add(agent, "ps aux", OUTPUT)
+    assert '[Salida idéntica a la de la llamada anterior execute_terminal_command {"command":"ps"}]' in other["content"]
+    assert agent.tool_encoder.stats()["dedup_exact"] == 2
+
+
+def test_near_identical_output_sends_only_changed_lines():
+    agent = Agent()
+    _add(agent, "ps", OUTPUT)
+    changed = OUTPUT.replace("proceso 030 activo", "proceso 030 parado")
+    message = _add(agent, "ps", changed)
+    assert "solo cambian estas líneas" in message["content"]
+    assert "- proceso 030 activo" in message["content"] and "+ proceso 030 parado" in message["content"]
+    assert "proceso 010 activo" not in message["content"]
+
+
+def test_reference_needs_first_copy_in_history():
+    agent = Agent()
+    first = _add(agent, "ps", OUTPUT)
+    # El ContextManager recortó la salida: ya no sirve de referencia y se envía entera otra vez
+    first["content"] = first["content"][:100]
+    second = _add(agent, "ps", OUTPUT)
+    assert OUTPUT in second["content"]
+
+
+def test_short_outputs_are_not_deduplicated():
+    agent = Agent()
+    _add(agent, "uptime", "up 3 days")
+    assert "up 3 days" in _add(agent, "uptime", "up 3 days")["content"]
@@ -0,0 +1,156 @@
+import json
+import os
+import re
+import threading
+import time
+
+
+# Comandos de solo lectura cacheables y su TTL en segundos. Cada patrón se compara con cada
+# segmento del comando (separado por |, &&, || o ;); todos los segmentos deben coincidir.
+READ_ONLY_COMMANDS = [
+    (r"uname(\s+-\w+)*", 3600),
+    (r"lsb_release(\s+-\w+)*", 3600),
+    (r"hostname(\s+-\w+)*", 3600),
+    (r"(cat|head)\s+/etc/[\w.-]*release", 3600),
+    (r"(arch|nproc|whoami|id|groups)", 3600),
+    (r"[\w.-]+\s+(--version|-V|version)", 3600),
+    (r"(which|type|command\s+-v)\s+[\w.\s-]+", 600),
+    (r"(lscpu|lsblk|lspci|lsusb)(\s+-\w+)*", 300),
+    (r"(df|free|uptime|du|mount|findmnt)(\s+[^\s;&|]+)*", 15),
+    (r"(ls|pwd|cat|head|tail|wc|stat|file|grep|find|sort|uniq|cut|awk|sed\s+-n)(\s+[^;&|]+)*", 10),
+]
+_READ_ONLY_RULES = [(re.compile(rf"^{pattern}$"), ttl) for pattern, ttl in READ_ONLY_COMMANDS]
+_SEGMENT_SPLIT = re.compile(r"\s*(?:\|\||&&|;|\|)\s*")
+# Redirecciones o sustituciones que pueden escribir o ejecutar otra cosa: nunca cacheables
+# (find -exec/-execdir/-ok/-okdir, -fprint*/-fls, -delete; sed -i; awk system(); sort -o)
+_UNSAFE = re.compile(r">|`|\$\(|\bsudo\b|-(?:exec|ok)(?:dir)?\b|-fprint\w*|-fls\b|-delete\b|\bsed\s+-i\b"
+                     r"|\bsystem\s*\(|\bsort\b.*\s-o\b")
+# Comandos de sed que escriben en ficheros o ejecutan otros (w/W fichero, e comando, s///w, s///e)
+_SED_WRITES = re.compile(r"""(?:^|[/;{}\s'"\d$,])[wWe](?=[\s'";}]|$)|/[gpiImM\d]*[we](?=[\s'";}]|$)""")
+
+# TTL de las herramientas que no son comandos (None = no cacheable)
+TOOL_TTLS = {
+    # get_system_os ya se sirve de la instantánea de environment.py (no hace falta cachearlo)
+}
+
+
+def normalize_command(command):
+    return " ".join((command or "").split())
+
+
+def command_ttl(command):
+    """TTL del comando si es de solo lectura según la lista permitida; None si no es cacheable."""
+    command = normalize_command(command)
+    if not command or _UNSAFE.search(command):
+        return None
+    ttl = None
+    for segment in _SEGMENT_SPLIT.split(command):
+        if segment.startswith("sed ") and _SED_WRITES.search(segment[4:]):
+            return None
+        for rule, rule_ttl in _READ_ONLY_RULES:
+            if rule.match(segment):
+                ttl = rule_ttl if ttl is None else min(ttl, rule_ttl)
+                break
+        else:
+            return None
+    return ttl
+
+
+class ToolCache:
+    """Caché con TTL de resultados de herramientas de solo lectura.
+
+    La clave es nombre de herramienta + argumentos normalizados + ámbito (`scope`: None para los
+    comandos del pool compartido, que corren siempre en el mismo cwd; un valor propio por agente con
+    shell persistente, cuyo cwd cambia con `cd`). Cualquier comando que no sea
+    de solo lectura invalida los resultados de comandos guardados (el estado pudo cambiar).
+    Se desactiva con AGENT_TOOL_CACHE=0 y cada llamada puede saltársela con `no_cache`.
+    """
+
+    def __init__(self, enabled=None, max_entries=512):
+        if enabled is None:
+            enabled = os.environ.get("AGENT_TOOL_CACHE", "1").strip().lower() not in ("0", "false", "no")
+        self.enabled = enabled
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        # Sube con cada comando que puede modificar el sistema (response_cache.py la compara)
+        self.generation = 0
+
+    def key_for(self, tool_name, args, scope=None):
+        """Devuelve (clave, ttl) si la llamada es cacheable, o (None, None)."""
+        if tool_name == "execute_terminal_command":
+            if args.get("background"):
+                # Lanza un trabajo nuevo: la respuesta (su job_id) no se puede reutilizar
+                return None, None
+            command = normalize_command(args.get("command"))
+            ttl = command_ttl(command)
+            return ((tool_name, command, scope), ttl) if ttl else (None, None)
+        ttl = TOOL_TTLS.get(tool_name)
+        if not ttl:
+            return None, None
+        try:
+            normalized = json.dumps(args, sort_keys=True, ensure_ascii=False)
+        except (TypeError, ValueError):
+            return None, None
+        return (tool_name, normalized), ttl
+
+    def get(self, key):
+        if not self.enabled or key is None:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, ttl, result):
+        if not self.enabled or key is None:
+            return
+        # Los errores no se cachean: el siguiente intento debe volver a ejecutarse
+        if isinstance(result, str) and result.startswith("Error"):
+            return
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                now = time.monotonic()
+                self._entries = {k: v for k, v in self._entries.items() if v[0] > now}
+                if len(self._entries) >= self.max_entries:
+                    self._entries.pop(next(iter(self._entries)))
+            self._entries[key] = (time.monotonic() + ttl, result)
+
+    def invalidate_commands(self):
+        """Olvida los resultados de comandos (tras ejecutar algo que puede modificar el sistema)."""
+        with self._lock:
+            self.generation += 1
+            stale = [k for k in self._entries if k[0] == "execute_terminal_command"]
+            for k in stale:
+                del self._entries[k]
+            if stale:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+                "invalidations": self.invalidations,
+            }
+
+
+# Caché compartida por todas las instancias de Agent (los comandos afectan a la misma máquina)
+tool_cache = ToolCache()
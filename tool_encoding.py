@@ -0,0 +1,156 @@
+import difflib
+import hashlib
+import json
+import os
+from collections import OrderedDict
+
+from context import estimate_tokens
+from metrics import metrics
+
+
+# "compact": parámetros en una línea sin espacios; "pretty": JSON indentado (formato anterior)
+TOOL_ENCODING = os.environ.get("AGENT_TOOL_ENCODING", "compact").strip().lower()
+# Deduplicación de salidas repetidas (AGENT_TOOL_DEDUP=0 la desactiva)
+TOOL_DEDUP = os.environ.get("AGENT_TOOL_DEDUP", "1").strip().lower() not in ("0", "false", "no")
+# Salidas más cortas no se deduplican: la referencia ahorraría poco o nada
+DEDUP_MIN_CHARS = int(os.environ.get("AGENT_DEDUP_MIN_CHARS", "256"))
+# Una salida es "casi idéntica" si cambia como mucho esta fracción de sus líneas
+NEAR_MAX_CHANGED = 0.2
+# Salidas recordadas para deduplicar
+MAX_ENTRIES = 256
+
+
+def _digest(text):
+    return hashlib.sha1(text.encode("utf-8", errors="replace")).hexdigest()
+
+
+class ToolOutputEncoder:
+    """Codificación de los mensajes `tool` del historial para que ocupen menos tokens.
+
+    - Modo compacto: los parámetros van en una línea (`{"command":"ls"}`) en lugar de JSON indentado.
+    - Deduplicación por hash de contenido: una salida idéntica a otra que sigue en el historial se
+      sustituye por una referencia corta; si la misma llamada devuelve una salida casi idéntica
+      (p. ej. `systemctl status` con otra hora), solo se envían las líneas que cambian.
+    Solo se referencian salidas completas que siguen en el historial tal cual (una salida recortada
+    o descartada por el ContextManager no sirve de referencia). Los tokens ahorrados se acumulan en
+    `stats()` y en el contador `agent_tool_tokens_saved_total`.
+    """
+
+    def __init__(self, compact=TOOL_ENCODING == "compact", dedup=TOOL_DEDUP, min_chars=DEDUP_MIN_CHARS,
+                 tokenizer=estimate_tokens):
+        self.compact = compact
+        self.dedup = dedup
+        self.min_chars = min_chars
+        self.tokenizer = tokenizer
+        self._by_hash = OrderedDict()   # hash de la salida -> entrada
+        self._by_call = OrderedDict()   # llamada (herramienta + parámetros) -> entrada
+        self._pending = []              # entradas del mensaje que se está formando
+        self.saved = {"encoding": 0, "exact": 0, "near": 0}
+        self.hits = {"exact": 0, "near": 0}
+
+    def params(self, tool_input):
+        if not tool_input:
+            return ""
+        try:
+            if self.compact:
+                return json.dumps(tool_input, ensure_ascii=False, separators=(",", ":"))
+            return json.dumps(tool_input, ensure_ascii=False, indent=2)
+        except (TypeError, ValueError):
+            return str(tool_input)
+
+    def format(self, tool_name, tool_input, out_text, alive):
+        """Texto del mensaje `tool` para una llamada: cabecera, parámetros y salida (o su referencia).
+        `alive(mensaje, longitud)` indica si un mensaje anterior sigue entero en el historial."""
+        params = self.params(tool_input)
+        if self.compact and params:
+            self._save("encoding", self._tokens(json.dumps(tool_input, ensure_ascii=False, indent=2)) - self._tokens(params))
+        header = f"== {tool_name} ==\n" + (f"Parámetros: {params}\n" if params else "")
+        body = out_text
+        if self.dedup and len(out_text) >= self.min_chars:
+            body = self._dedup(f"{tool_name} {params}", out_text, alive)
+        return header + body
+
+    def _dedup(self, call, out_text, alive):
+        digest = _digest(out_text)
+        entry = self._by_hash.get(digest)
+        if entry is not None and alive(entry["message"], entry["length"]):
+            self._by_hash.move_to_end(digest)
+            same_call = entry["call"] == call
+            reference = ("[Sin cambios: la salida es idéntica a la de la llamada anterior con los mismos parámetros]"
+                         if same_call else f"[Salida idéntica a la de la llamada anterior {entry['call']}]")
+            self._hit("exact", out_text, reference)
+            return reference
+
+        base = self._by_call.get(call)
+        if base is not None and alive(base["message"], base["length"]):
+            diff = self._near_diff(base["text"], out_text)
+            if diff is not None:
+                reference = "[Salida casi idéntica a la de la llamada anterior con los mismos parámetros; solo cambian estas líneas]\n" + diff
+                if len(reference) < len(out_text) // 2:
+                    self._hit("near", out_text, reference)
+                    return reference
+
+        # Salida nueva: se envía entera y queda como referencia cuando se añada el mensaje
+        entry = {"call": call, "text": out_text, "message": None, "length": None}
+        self._remember(self._by_hash, digest, entry)
+        self._remember(self._by_call, call, entry)
+        self._pending.append(entry)
+        return out_text
+
+    def _near_diff(self, old, new):
+        old_lines, new_lines = old.splitlines(), new.splitlines()
+        matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+        if matcher.real_quick_ratio() < 1 - NEAR_MAX_CHANGED or matcher.quick_ratio() < 1 - NEAR_MAX_CHANGED:
+            return None
+        changed = 0
+        lines = []
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == "equal":
+                continue
+            changed += max(i2 - i1, j2 - j1)
+            lines.append(f"@@ líneas {j1 + 1}-{max(j1 + 1, j2)} @@")
+            lines.extend(f"- {line}" for line in old_lines[i1:i2])
+            lines.extend(f"+ {line}" for line in new_lines[j1:j2])
+        if not lines or changed > max(1, len(new_lines)) * NEAR_MAX_CHANGED:
+            return None
+        return "\n".join(lines)
+
+    def bind(self, message):
+        """Asocia las salidas nuevas del último `format` al mensaje ya añadido al historial."""
+        length = len(message.get("content") or "")
+        for entry in self._pending:
+            entry["message"], entry["length"] = message, length
+        self._pending = []
+
+    def reset(self):
+        self._by_hash.clear()
+        self._by_call.clear()
+        self._pending = []
+
+    def _remember(self, table, key, entry):
+        table[key] = entry
+        table.move_to_end(key)
+        while len(table) > MAX_ENTRIES:
+            table.popitem(last=False)
+
+    def _tokens(self, text):
+        return self.tokenizer(text) if text else 0
+
+    def _hit(self, kind, out_text, reference):
+        self.hits[kind] += 1
+        self._save(kind, self._tokens(out_text) - self._tokens(reference))
+
+    def _save(self, kind, tokens):
+        if tokens > 0:
+            self.saved[kind] += tokens
+            metrics.inc("agent_tool_tokens_saved_total", tokens, kind=kind)
+
+    def stats(self):
+        return {
+            "tool_encoding": "compact" if self.compact else "pretty",
+            "dedup_exact": self.hits["exact"],
+            "dedup_near": self.hits["near"],
+            "tokens_saved_encoding": self.saved["encoding"],
+            "tokens_saved_dedup": self.saved["exact"] + self.saved["near"],
+            "tokens_saved": sum(self.saved.values()),
+        }